@@ -0,0 +1,194 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Merge the caltables of each SPW directory (e.g. '880.0~933.0MHz/caltables/*.bcal') into wideband caltables in the top level
+'caltables' directory, so that applying, plotting and QA of the concatenated data opens one table rather than nspw tables. The
+rows of each table are appended in order of frequency (the same order used by concat.py), with SPECTRAL_WINDOW_ID remapped to
+the row of its SPW within the merged SPECTRAL_WINDOW subtable. An index of the SPWs within each merged table is written to JSON.
+If 'calqa' is set, the merged tables are then checked for outlying antennas across the whole band (reported, not flagged).
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+
+import config_parser
+from config_parser import validate_args as va
+import bookkeeping
+import cal_qa
+
+from casatasks import *
+logfile=casalog.logfile()
+casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
+from casatools import table
+tb = table()
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Extensions of the per-SPW caltables to merge, where present
+EXTENSIONS = ['kcal', 'bcal', 'gcal', 'fluxscale', 'pcal', 'xcal', 'xdel', 'xycal']
+
+def sortbySPW(spwdir):
+    return float(os.path.basename(spwdir.rstrip('/')).split('~')[0])
+
+def find_tables(dirs, caldir, ext):
+
+    """Return the (SPW directory, caltable) pairs with this extension, in order of frequency."""
+
+    found = []
+    for dd in sorted(dirs, key=sortbySPW):
+        tables = sorted(glob.glob(os.path.join(dd, caldir, '*.{0}'.format(ext))))
+        if len(tables) == 0:
+            logger.warning("Expected to find caltable '{0}/{1}/*.{2}'.".format(dd,caldir,ext))
+            continue
+        if len(tables) > 1:
+            logger.warning("Found {0} caltables '{1}/{2}/*.{3}'. Merging '{4}'.".format(len(tables),dd,caldir,ext,tables[0]))
+        found.append((dd, tables[0]))
+    return found
+
+def append_table(intable, outtable):
+
+    """Append the rows of one caltable (and its SPECTRAL_WINDOW subtable) to another, remapping SPECTRAL_WINDOW_ID.
+
+    Arguments:
+    ----------
+    intable : str
+        Path to caltable to append.
+    outtable : str
+        Path to merged caltable.
+
+    Returns:
+    --------
+    spws : list
+        The SPW IDs within the merged table of the appended SPWs."""
+
+    tb.open(os.path.join(outtable, 'SPECTRAL_WINDOW'))
+    spwoffset = tb.nrows()
+    tb.close()
+
+    tb.open(os.path.join(intable, 'SPECTRAL_WINDOW'))
+    nspw = tb.nrows()
+    tb.copyrows(os.path.join(outtable, 'SPECTRAL_WINDOW'))
+    tb.close()
+
+    tb.open(outtable)
+    startrow = tb.nrows()
+    tb.close()
+
+    tb.open(intable)
+    nrow = tb.nrows()
+    tb.copyrows(outtable)
+    tb.close()
+
+    if nrow > 0:
+        tb.open(outtable, nomodify=False)
+        spwids = tb.getcol('SPECTRAL_WINDOW_ID', startrow=startrow, nrow=nrow)
+        tb.putcol('SPECTRAL_WINDOW_ID', spwids + spwoffset, startrow=startrow, nrow=nrow)
+        tb.close()
+
+    return list(range(spwoffset, spwoffset + nspw))
+
+def freq_range(caltable, spw):
+
+    """Return the [min, max] channel frequency (MHz) of an SPW of a caltable."""
+
+    tb.open(os.path.join(caltable, 'SPECTRAL_WINDOW'))
+    freqs = tb.getcell('CHAN_FREQ', spw) / 1e6
+    tb.close()
+    return [float(freqs.min()), float(freqs.max())]
+
+def merge_caltables(visname, dirs, caldir='caltables'):
+
+    """Merge the per-SPW caltables of each extension into wideband caltables, and write an index of their SPWs.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to the original (i.e. pre-concat) MS, used to name the merged caltables.
+    dirs : list
+        SPW directories.
+    caldir : str, optional
+        Name of the caltable directory, within each SPW directory and the top level directory.
+
+    Returns:
+    --------
+    index : dict
+        For each extension, the merged caltable and the SPW directory, source caltable and frequency range of each SPW."""
+
+    logger.info('Beginning {0}.'.format(sys.argv[0]))
+
+    if not os.path.exists(caldir):
+        os.makedirs(caldir)
+
+    base = os.path.splitext(os.path.basename(visname.rstrip('/ ')))[0]
+    index = {}
+
+    for ext in EXTENSIONS:
+        found = find_tables(dirs, caldir, ext)
+        if len(found) == 0:
+            continue
+
+        out = os.path.join(caldir, '{0}.{1}'.format(base, ext))
+        if os.path.exists(out):
+            shutil.rmtree(out)
+
+        logger.info("Merging {0} caltables '*.{1}' into '{2}'.".format(len(found),ext,out))
+        spws = []
+        for i,(dd,intable) in enumerate(found):
+            #Copy the lowest SPW, then append the others
+            if i == 0:
+                tb.open(intable)
+                tb.copy(out, deep=True)
+                tb.close()
+                tb.open(os.path.join(out, 'SPECTRAL_WINDOW'))
+                ids = list(range(tb.nrows()))
+                tb.close()
+            else:
+                ids = append_table(intable, out)
+
+            spws.extend([{'spw' : spw, 'dir' : dd, 'caltable' : intable, 'freqrange' : freq_range(out, spw)} for spw in ids])
+
+        index[ext] = {'caltable' : out, 'spws' : spws}
+
+    if len(index) == 0:
+        logger.error("Didn't find any caltables in '{0}' to merge.".format(caldir))
+    else:
+        with open(bookkeeping.merged_index(caldir), 'w') as f:
+            json.dump(index, f, indent=1)
+        logger.info("Wrote index of merged caltables to '{0}'.".format(bookkeeping.merged_index(caldir)))
+
+    logger.info('Completed {0}.'.format(sys.argv[0]))
+    return index
+
+def main(args,taskvals):
+
+    visname = va(taskvals, 'run', 'crosscal_vis', str, default=va(taskvals, 'data', 'vis', str))
+    spw = va(taskvals, 'crosscal', 'spw', str, default='')
+    nsigma = va(taskvals, 'crosscal', 'calqa', float, default=0)
+    refant = va(taskvals, 'crosscal', 'refant', str, default='')
+    dirs = config_parser.parse_spw(args['config'])[3]
+
+    if type(dirs) is str:
+        dirs = glob.glob(dirs)
+
+    if ',' in spw:
+        index = merge_caltables(visname, dirs)
+
+        #The flagging and re-solving is done per SPW by xx_yy_solve.py, so only report outliers across the band here
+        if nsigma > 0:
+            cal_qa.check_tables([index[ext]['caltable'] for ext in EXTENSIONS if ext in index], nsigma, refant)
+    else:
+        logger.error("Only found one SPW in '{0}', so will skip merging caltables.".format(args['config']))
+
+if __name__ == '__main__':
+
+    bookkeeping.run_script(main,logfile)
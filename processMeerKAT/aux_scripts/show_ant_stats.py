@@ -3,11 +3,12 @@
 
 #!/usr/bin/env python3
 import sys, os
+import json
 import numpy as np
 import matplotlib.pyplot as plt
 
 args=sys.argv
-fname = 'ant_stats.txt'
+fname = 'ant_stats.json'
 bins = 20
 
 #Cheaps man's argparse
@@ -18,30 +19,38 @@ if len(args) > 1:
         fname = sys.argv[1]
         bins = int(sys.argv[2])
 
-dat=open(fname).read()
-lines = dat.split('\n')[1:-1] #skip header and remove last line
-ants=np.empty(len(lines),dtype=np.int)
-flags=np.zeros(len(lines))
+#Antennas are ranked by score, so the first is the reference antenna
+stats = json.load(open(fname))['antennas']
+names = np.array([ant['name'] for ant in stats])
+ants = np.array([ant['id'] for ant in stats])
+flags = np.array([ant['flags'] for ant in stats])
+score = np.array([ant['score'] if ant['score'] is not None else np.nan for ant in stats])
+refant = names[0]
 
-for i,line in enumerate(lines):
-    split = line.split()
-    ants[i] = split[0]
-    flags[i] = split[-1]
-
-refant = ants[np.argmin(flags)]
+fig,axes = plt.subplots(1,2,figsize=(12,5))
 mask = (flags < 1) & (flags > 0)
 label='Flagged % over {0} antennas\n({1} flagged out)'.format(flags[mask].size,flags[~mask].size)
-plt.hist(flags[mask]*100,bins=bins,label=label)
+axes[0].hist(flags[mask]*100,bins=bins,label=label)
 refant_label='Reference antenna ({0})'.format(refant)
-plt.hist(flags[refant]*100,label=refant_label,color='r')
-plt.xlabel('Flagged Percentage')
-plt.ylabel('N')
-plt.legend()
+axes[0].hist(flags[:1]*100,label=refant_label,color='r')
+allflags = np.array([ant['flags_all'] if ant.get('flags_all') is not None else np.nan for ant in stats])
+if np.any(np.isfinite(allflags)):
+    axes[0].hist(allflags[np.isfinite(allflags)]*100,bins=bins,histtype='step',color='k',label='Flagged % over whole observation')
+axes[0].set_xlabel('Flagged Percentage')
+axes[0].set_ylabel('N')
+axes[0].legend()
+
+axes[1].bar(np.arange(names.size),score,tick_label=names,color=['r'] + ['C0']*(names.size-1))
+axes[1].set_xlabel('Antenna (ranked)')
+axes[1].set_ylabel('Score (lower is better)')
+axes[1].tick_params(axis='x',labelrotation=90,labelsize=6)
+
+plt.tight_layout()
 plt.savefig('{0}_hist.png'.format(os.path.splitext(fname)[0]))
 plt.close()
 
 plt.scatter(ants[mask],flags[mask]*100,label=label)
-plt.scatter(ants[refant],flags[refant]*100,label=refant_label,color='r')
+plt.scatter(ants[:1],flags[:1]*100,label=refant_label,color='r')
 plt.xlabel('Antenna')
 plt.ylabel('Flagged Percentage')
 plt.legend()
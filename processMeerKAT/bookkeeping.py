@@ -11,6 +11,9 @@ from collections import namedtuple
 import os
 import glob
 import re
+import json
+import shutil
+import hashlib
 
 import logging
 from time import gmtime
@@ -42,6 +45,149 @@ def bookkeeping(visname):
 
     return calfiles, caldir
 
+#Content-addressed store of calibration tables, kept outside 'caltables' so it survives reruns
+CALCACHE_DIR = 'calcache'
+CALCACHE_REGISTRY = os.path.join(CALCACHE_DIR, 'registry.json')
+_fingerprints = {}
+
+def hash_path(path):
+
+    """Return a SHA1 digest of the contents of a file, or of every file within a directory (e.g. a CASA table), ignoring lock files."""
+
+    sha = hashlib.sha1()
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted([os.path.join(root,f) for root,dirs,fnames in os.walk(path) for f in fnames if f != 'table.lock'])
+    for fname in files:
+        sha.update(os.path.relpath(fname,path).encode())
+        with open(fname,'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def modified_time(visname):
+
+    """Return the latest modification time of any file within an MS (including the sub-MSs of an MMS), ignoring lock files."""
+
+    return max([os.path.getmtime(os.path.join(root,f)) for root,dirs,fnames in os.walk(visname) for f in fnames if f != 'table.lock'] + [0])
+
+def forget_fingerprint(visname):
+
+    """Discard the memoised fingerprint of an MS, e.g. after its flags are written."""
+
+    _fingerprints.pop(visname, None)
+
+def ms_fingerprint(visname, refresh=False):
+
+    """Return a digest identifying the state of the MS relevant to calibration: its layout (rows, fields, antennas, channels),
+    any virtual model written by setjy, and its flags. Memoised per process until any file within the MS is modified, unless
+    refresh=True."""
+
+    mtime = modified_time(visname)
+    if visname in _fingerprints and _fingerprints[visname][0] == mtime and not refresh:
+        return _fingerprints[visname][1]
+
+    import flag_versions
+    from casatools import msmetadata,table
+    msmd = msmetadata()
+    tb = table()
+
+    msmd.open(visname)
+    layout = [os.path.realpath(visname), msmd.nrows(), list(msmd.fieldnames()), list(msmd.antennanames())]
+    for spw in range(msmd.nspw()):
+        freqs = msmd.chanfreqs(spw)
+        layout.append([len(freqs), float(freqs[0]), float(freqs[-1])])
+    msmd.done()
+
+    #Virtual models are stored as keywords of the main table or within the SOURCE subtable
+    tb.open(visname)
+    layout.append({key : str(tb.getkeyword(key)) for key in tb.keywordnames() if 'model' in key.lower()})
+    tb.close()
+    if os.path.exists(os.path.join(visname,'SOURCE')):
+        layout.append(hash_path(os.path.join(visname,'SOURCE')))
+
+    #The flags themselves, rather than the list of saved flag versions
+    layout.append(flag_versions.flag_digest(visname))
+
+    _fingerprints[visname] = (mtime, hashlib.sha1(json.dumps(layout, sort_keys=True, default=str).encode()).hexdigest())
+    return _fingerprints[visname][1]
+
+def load_registry():
+
+    if os.path.exists(CALCACHE_REGISTRY):
+        with open(CALCACHE_REGISTRY) as f:
+            return json.load(f)
+    return {}
+
+def save_registry(registry):
+
+    if not os.path.exists(CALCACHE_DIR):
+        os.makedirs(CALCACHE_DIR)
+    tmp = CALCACHE_REGISTRY + '.tmp'
+    with open(tmp,'w') as f:
+        json.dump(registry, f, indent=1, sort_keys=True)
+    os.replace(tmp, CALCACHE_REGISTRY)
+
+def caltable_inputs(task, kwargs):
+
+    """Return the inputs that determine a calibration solution: the task, MS fingerprint, all task parameters (including field selection,
+    refant and solver parameters), and the contents of any upstream tables passed via gaintable."""
+
+    inputs = {key : kwargs[key] for key in kwargs if key not in ['vis','caltable']}
+    inputs['task'] = task
+    inputs['vis'] = ms_fingerprint(kwargs['vis'])
+
+    gaintable = kwargs.get('gaintable', [])
+    if type(gaintable) is str:
+        gaintable = [gaintable] if gaintable != '' else []
+    inputs['gaintable'] = [hash_path(table) for table in gaintable]
+
+    return inputs
+
+def cached_solve(task, nchunks=1, **kwargs):
+
+    """Run a CASA solver task (e.g. 'gaincal', 'bandpass' or 'polcal'), unless a table solved with identical inputs exists in the
+    caltable registry, in which case copy that table into place. Solves that append to an existing table are always run.
+
+    Arguments:
+    ----------
+    task : str
+        Name of CASA task in ``casatasks``.
+    nchunks : int, optional
+        Number of chunks of channels to solve in parallel, for channel-based solves (see ``parallel_solve``).
+    kwargs : dict
+        Keyword arguments passed into the task, including vis and caltable."""
+
+    import parallel_solve
+    caltable = kwargs['caltable']
+
+    if kwargs.get('append', False):
+        parallel_solve.solve(task, 1, **kwargs)
+        return
+
+    inputs = caltable_inputs(task, kwargs)
+    key = hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+    stored = os.path.join(CALCACHE_DIR, key, os.path.basename(caltable))
+    registry = load_registry()
+
+    if key in registry and os.path.exists(stored):
+        logger.info('Reusing calibration table "{0}" solved with identical inputs, instead of running {1}.'.format(stored,task))
+        if os.path.exists(caltable):
+            shutil.rmtree(caltable)
+        shutil.copytree(stored, caltable)
+        return
+
+    parallel_solve.solve(task, nchunks, **kwargs)
+
+    if os.path.exists(caltable):
+        if os.path.exists(stored):
+            shutil.rmtree(stored)
+        shutil.copytree(caltable, stored)
+        registry[key] = {'caltable' : os.path.basename(caltable), 'inputs' : inputs}
+        save_registry(registry)
+        logger.debug('Registered calibration table "{0}" as "{1}".'.format(caltable,stored))
+
 def get_field_ids(fields):
     """
     Given an input list of source names, finds the associated field
@@ -71,6 +217,23 @@ def get_field_ids(fields):
     return FieldIDs(targetfield, fluxfield, bpassfield, secondaryfield,
             kcorrfield, xdelfield, dpolfield, xpolfield, gainfields, extrafields)
 
+#Known calibrators and their aliases, in order of preference
+FLUXCAL_NAMES = ["J0408-6545", "0408-6545"]
+POLCAL_NAMES = [["3c286", "1328+307", "1331+305", "J1331+3030"],
+                ["3c138", "0518+165", "0521+166", "J0521+1638"],
+                ["3c48", "0134+329", "0137+331", "J0137+3309"],
+                ["J1130-1449"]]
+
+def find_known_field(fieldnames, aliases):
+
+    """Return the first field name that matches (case-insensitive) one of the input aliases, otherwise ''."""
+
+    lower = [alias.lower() for alias in aliases]
+    for name in fieldnames:
+        if name.lower() in lower:
+            return name
+    return ''
+
 def polfield_name(visname):
 
     from casatools import msmetadata
@@ -80,14 +243,10 @@ def polfield_name(visname):
     msmd.done()
 
     polfield = ''
-    if any([ff in ["3c286", "1328+307", "1331+305", "J1331+3030"] for ff in fieldnames]):
-        polfield= list(set(["3c286", "1328+307", "1331+305", "J1331+3030"]).intersection(set(fieldnames)))[0]
-    elif any([ff in ["3c138", "0518+165", "0521+166", "J0521+1638"] for ff in fieldnames]):
-        polfield = list(set(["3c138", "0518+165", "0521+166", "J0521+1638"]).intersection(set(fieldnames)))[0]
-    elif any([ff in ["3c48", "0134+329", "0137+331", "J0137+3309"] for ff in fieldnames]):
-        polfield = list(set(["3c48", "0134+329", "0137+331", "J0137+3309"]).intersection(set(fieldnames)))[0]
-    elif "J1130-1449" in fieldnames:
-        polfield = "J1130-1449"
+    for aliases in POLCAL_NAMES:
+        polfield = find_known_field(fieldnames, aliases)
+        if polfield != '':
+            break
     else:
         logger.warning("No valid polarization field found. Defaulting to use the phase calibrator to solve for XY phase.")
         logger.warning("The polarization solutions found will likely be wrong. Please check the results carefully.")
@@ -108,13 +267,413 @@ def check_file(filepath):
     else:
         logger.info('Calibration table "{0}" successfully written.'.format(filepath))
 
+def check_model(visname, field):
+
+    """Check that a calibrator field has a model to solve against, either the virtual model written by setjy(usescratch=False)
+    or a MODEL_DATA column, and log which is used.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS or MMS.
+    field : str
+        Field name or ID.
+
+    Returns:
+    --------
+    virtual : bool
+        Whether the field has a virtual model."""
+
+    from casatools import msmetadata,table
+    msmd = msmetadata()
+    tb = table()
+
+    msmd.open(visname)
+    fieldid = int(field) if str(field).isdigit() else msmd.fieldsforname(field)[0]
+    msmd.done()
+
+    #Virtual models are only written to the sub-MSs of an MMS that hold the field's scans, so accept a model in any sub-MS
+    vislist = [visname]
+    if os.path.exists('{0}/SUBMSS'.format(visname)):
+        vislist = sorted(glob.glob('{0}/SUBMSS/*'.format(visname)))
+
+    virtual = column = False
+    for vis in vislist:
+        tb.open(vis)
+        virtual |= 'definedmodel_field_{0}'.format(fieldid) in tb.keywordnames()
+        column |= 'MODEL_DATA' in tb.colnames()
+        tb.close()
+
+    if virtual and column:
+        logger.warning('Field "{0}" has a virtual model, but "{1}" also has a MODEL_DATA column. Remove it with delmod(scr=True) to avoid ambiguity.'.format(field,visname))
+    elif virtual:
+        logger.info('Solving against virtual model of field "{0}".'.format(field))
+    elif column:
+        logger.info('Solving against MODEL_DATA column of field "{0}".'.format(field))
+    else:
+        logger.error('Field "{0}" has no model in "{1}". Please check setjy ran successfully.'.format(field,visname))
+        raise ValueError('No model for field "{0}".'.format(field))
+
+    return virtual
+
+#Calibration applied to a set of fields, as passed into applycal or written into a cal library
+ApplyEntry = namedtuple('ApplyEntry', ['name', 'field', 'gaintable', 'gainfield', 'interp', 'parang'])
+
+def unique_fields(fieldlist):
+
+    """Return a comma-separated string of the non-empty fields in a list of (comma-separated) fields, without duplicates."""
+
+    return ','.join(set([i for i in (','.join(fieldlist).split(',')) if i]))
+
+def apply_plan(visname, fields, calfiles, caldir, dopol=False):
+
+    """Return the calibration to apply to each set of fields, after the parallel-hand (dopol=False) or full-polarisation
+    (dopol=True) solves.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    fields : namedtuple
+        Field IDs, from ``get_field_ids``.
+    calfiles : namedtuple
+        Calibration tables, from ``get_calfiles``.
+    caldir : str
+        Directory of calibration tables.
+    dopol : bool, optional
+        Apply the polarisation calibration (with parallactic angle correction)?
+
+    Returns:
+    --------
+    plan : list
+        List of ``ApplyEntry``."""
+
+    if len(fields.gainfields.split(',')) > 1:
+        fluxfile = calfiles.fluxfile
+    else:
+        fluxfile = calfiles.gainfile
+
+    others = unique_fields([fields.secondaryfield, fields.targetfield, fields.extrafields])
+
+    if not dopol:
+        gaintable = [calfiles.kcorrfile, calfiles.bpassfile, fluxfile]
+        interp = 'linear,linearflag'
+        plan = [ApplyEntry('primary calibrator', fields.fluxfield, gaintable,
+                           [fields.kcorrfield, fields.bpassfield, fields.fluxfield], interp, False),
+                ApplyEntry('phase calibrator, targets and extra fields', others, gaintable,
+                           [fields.kcorrfield, fields.bpassfield, fields.secondaryfield], interp, False)]
+        if fields.xpolfield != '':
+            plan.append(ApplyEntry('polarization calibrator', fields.xpolfield, gaintable,
+                                   [fields.kcorrfield, fields.bpassfield, fields.secondaryfield], interp, False))
+        return plan
+
+    polfield = polfield_name(visname)
+    if polfield == '':
+        polfield = fields.secondaryfield
+
+    base = visname.replace('.ms', '')
+    xyfile = os.path.join(caldir, base+'.xycal')
+    gaintable = [calfiles.bpassfile, fluxfile, calfiles.dpolfile, xyfile]
+
+    plan = [ApplyEntry('primary calibrator', fields.fluxfield, gaintable,
+                       [fields.bpassfield, fields.fluxfield, fields.bpassfield, polfield], 'nearest,linearflag,nearest,nearest', True)]
+    if polfield != fields.secondaryfield:
+        plan.append(ApplyEntry('polarization calibrator', polfield, gaintable,
+                               [fields.bpassfield, polfield, fields.bpassfield, polfield], 'nearest,linearflag,nearest,nearest', True))
+    plan.append(ApplyEntry('phase calibrator, targets and extra fields', others, gaintable,
+                           [fields.bpassfield, fields.secondaryfield, fields.bpassfield, polfield], 'nearest,nearest,nearest,nearest', True))
+    return plan
+
+def without_targets(field, fields):
+
+    """Return a comma-separated field selection excluding the target field(s)."""
+
+    targets = fields.targetfield.split(',')
+    return ','.join([f for f in field.split(',') if f != '' and f not in targets])
+
+def callib_file(visname, caldir, name=''):
+
+    base = os.path.splitext(os.path.basename(visname.rstrip('/ ')))[0]
+    return os.path.join(caldir, '{0}{1}.callib'.format(base, '.' + name if name != '' else ''))
+
+def write_callib(plan, filename):
+
+    """Write an apply plan as a CASA cal library, to apply calibration on the fly (e.g. in mstransform(docallib=True)).
+
+    Arguments:
+    ----------
+    plan : list
+        List of ``ApplyEntry``, from ``apply_plan``. The parallactic angle correction isn't part of a cal library, so must be
+        passed separately (i.e. applycal(parang=True)), and can't be applied on the fly by mstransform.
+    filename : str
+        Path to cal library."""
+
+    lines = []
+    for entry in plan:
+        if entry.field == '':
+            continue
+
+        #interp is either 'time,freq' for all tables, or one time interpolation per table
+        interp = entry.interp.split(',')
+        for i,(caltable,gainfield) in enumerate(zip(entry.gaintable, entry.gainfield)):
+            tinterp,finterp = (interp[i],'') if len(interp) == len(entry.gaintable) else (interp + [''])[:2]
+            line = "caltable='{0}' calwt=False field='{1}' tinterp='{2}'".format(caltable,entry.field,tinterp)
+            if finterp != '':
+                line += " finterp='{0}'".format(finterp)
+            if gainfield != '':
+                line += " fldmap='{0}'".format(gainfield)
+            lines.append(line)
+
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    logger.info('Wrote cal library "{0}" with {1} entries.'.format(filename,len(lines)))
+
+def merged_index(caldir):
+
+    return os.path.join(caldir, 'index.json')
+
+def merged_caltable(caldir, ext):
+
+    """Return the path and SPW IDs of the wideband caltable with this extension written by merge_caltables.py, or ('', []) if
+    there is none."""
+
+    fname = merged_index(caldir)
+    if os.path.exists(fname):
+        with open(fname) as f:
+            index = json.load(f)
+        if ext in index and os.path.exists(index[ext]['caltable']):
+            return index[ext]['caltable'], [spw['spw'] for spw in index[ext]['spws']]
+    return '', []
+
+def field_scans(visname, field):
+
+    """Return the sorted scan numbers of a (comma-separated) selection of field names or IDs."""
+
+    from casatools import msmetadata
+    msmd = msmetadata()
+
+    scans = set()
+    msmd.open(visname)
+    for f in unique_fields([field]).split(','):
+        if f != '':
+            scans.update([int(scan) for scan in msmd.scansforfield(int(f) if f.isdigit() else f)])
+    msmd.done()
+
+    return sorted(scans)
+
+def latest_flag_version(visname):
+
+    """Return the name of the most recent flag version saved by ``flag_versions``, or '' if there are none."""
+
+    import flag_versions
+    versions = flag_versions.read_manifest(visname)
+    return versions[-1]['name'] if len(versions) > 0 else ''
+
+def incremental_file(visname, caldir):
+
+    return os.path.join(caldir, '{0}.incremental.json'.format(os.path.splitext(os.path.basename(visname.rstrip('/ ')))[0]))
+
+def load_incremental(visname, caldir):
+
+    """Return the state of incremental solving (the scans solved and applied so far), or {} if there is none."""
+
+    fname = incremental_file(visname, caldir)
+    if os.path.exists(fname):
+        with open(fname) as f:
+            return json.load(f)
+    return {}
+
+def save_incremental(visname, caldir, state):
+
+    fname = incremental_file(visname, caldir)
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(fname + '.tmp', fname)
+
+class SelfcalContext(object):
+
+    """Setup shared by every self-calibration step within a process (tclean, predict, sky, bdsf, mask), built once and memoised.
+
+    Arguments:
+    ----------
+    args : dict, optional
+        Parsed command-line arguments. Parsed here if not input.
+
+    Attributes:
+    -----------
+    args : dict
+        Parsed command-line arguments.
+    config : str
+        Path to config file.
+    taskvals : dict
+        Parsed config file."""
+
+    def __init__(self, args=None):
+
+        self.args = args if args is not None else config_parser.parse_args()
+        self.config = self.args['config']
+        self.taskvals, _ = config_parser.parse_config(self.config)
+        self._vis = None
+        self._target = None
+        self._meta = None
+        self._rms = {}
+
+    def set_vis(self, vis):
+
+        """Reset the memoised MS metadata if a different MS is input."""
+
+        if vis != self._vis:
+            self._vis = vis
+            self._target = None
+            self._meta = None
+
+    @property
+    def tmpvis(self):
+
+        """Input MS, or its first sub-MS if an MMS (for speed)."""
+
+        if os.path.exists('{0}/SUBMSS'.format(self._vis)):
+            return glob.glob('{0}/SUBMSS/*'.format(self._vis))[0]
+        return self._vis
+
+    def _resolve_target(self):
+
+        """Resolve the target field to its ID and name, once per MS."""
+
+        if self._target is not None:
+            return self._target
+
+        from casatools import msmetadata
+        msmd = msmetadata()
+
+        targetfields = self.taskvals['fields']['targetfields']
+
+        #Force taking first target field (relevant for writing outliers.txt at beginning of pipeline)
+        if type(targetfields) is str and ',' in targetfields:
+            targetfield = targetfields.split(',')[0]
+            msg = 'Multiple target fields input ("{0}"), but only one position can be used to identify outliers (for outlier imaging). Using "{1}".'
+            logger.warning(msg.format(targetfields,targetfield))
+        else:
+            targetfield = targetfields
+
+        msmd.open(self.tmpvis)
+
+        #Make sure it's an integer
+        try:
+            targetfield = int(targetfield)
+        except ValueError: # It's not an int, but a str
+            targetfield = msmd.fieldsforname(targetfield)[0]
+
+        self._target = (targetfield, msmd.namesforfields(targetfield)[0])
+        msmd.done()
+        return self._target
+
+    def _read_metadata(self):
+
+        from casatools import msmetadata,quanta
+        from read_ms import check_spw
+        msmd = msmetadata()
+        qa = quanta()
+
+        msmd.open(self.tmpvis)
+
+        #Derive primary beam FWHM, assuming channel 0 (of SPW 0) is lowest frequency and therefore largest FWHM
+        SPW = check_spw(self.config,msmd)
+        low_freq = float(SPW.replace('*:','').split('~')[0]) * 1e6 #MHz to Hz
+        rads=1.025*qa.constants(v='c')['value']/low_freq/ msmd.antennadiameter()['0']['value']
+
+        self._meta = {'spw' : SPW,
+                      'fwhm' : qa.convert(qa.quantity(rads,'rad'),'deg')['value']}
+        msmd.done()
+
+    def _get(self, key):
+
+        if self._meta is None:
+            self._read_metadata()
+        return self._meta[key]
+
+    @property
+    def usescratch(self):
+
+        """Whether models are written to the MODEL_DATA column, rather than stored as virtual models."""
+
+        return self.taskvals['crosscal'].get('usescratch', False)
+
+    @property
+    def targetfield(self):
+        return self._resolve_target()[0]
+
+    @property
+    def target_str(self):
+        return self._resolve_target()[1]
+
+    @property
+    def spw(self):
+        return self._get('spw')
+
+    @property
+    def beam_fwhm(self):
+        return self._get('fwhm')
+
+    @property
+    def basename(self):
+
+        visbase = os.path.split(self._vis.rstrip('/ '))[1] # Get only vis name, not entire path
+        visbase = re.sub('\.\d+\.*\d*\~\d+\.*\d*[a-z,A-Z]?[Hz,hz,hZ,HZ]*\.','.',visbase) # Strip any SPWs from basename (when running outlier imaging separately per SPW)
+
+        if '.ms' in visbase and self.target_str not in visbase:
+            return visbase.replace('.ms','.{0}'.format(self.target_str))
+        return visbase.replace('.mms', '')
+
+    @property
+    def caltables(self):
+
+        """Self-calibration tables currently present. Not memoised, since gaincal writes a new table each loop."""
+
+        return sorted(glob.glob('*.gcal?'))
+
+    def rms_min(self, rmsfile):
+
+        """Minimum of an RMS map, computed once per map."""
+
+        if rmsfile not in self._rms:
+            from casatasks import imstat
+            self._rms[rmsfile] = imstat(imagename=rmsfile)['min'][0]
+        return self._rms[rmsfile]
+
+_selfcal_context = None
+
+def get_selfcal_context(vis=None, args=None):
+
+    """Return the self-calibration context for this process, building it on first call.
+
+    Arguments:
+    ----------
+    vis : str, optional
+        Input MS. If input, the context is pointed at this MS.
+    args : dict, optional
+        Parsed command-line arguments, used if the context is built by this call.
+
+    Returns:
+    --------
+    context : class ``SelfcalContext``
+        The memoised context."""
+
+    global _selfcal_context
+    if _selfcal_context is None:
+        _selfcal_context = SelfcalContext(args)
+    if vis is not None:
+        _selfcal_context.set_vis(vis)
+    return _selfcal_context
+
 def get_selfcal_params():
 
     #Flag for input errors
     exit = False
 
     # Get the name of the config file
-    args = config_parser.parse_args()
+    context = get_selfcal_context()
+    args = context.args
 
     # Parse config file
     taskvals, config = config_parser.parse_config(args['config'])
@@ -182,41 +741,9 @@ def get_selfcal_params():
 
 def get_selfcal_args(vis,loop,nloops,nterms,deconvolver,discard_nloops,calmode,outlier_threshold,outlier_radius,threshold,step):
 
-    from casatools import msmetadata,quanta
-    from read_ms import check_spw
-    msmd = msmetadata()
-    qa = quanta()
-
-    if os.path.exists('{0}/SUBMSS'.format(vis)):
-        tmpvis = glob.glob('{0}/SUBMSS/*'.format(vis))[0]
-    else:
-        tmpvis = vis
-
-    msmd.open(tmpvis)
-
-    visbase = os.path.split(vis.rstrip('/ '))[1] # Get only vis name, not entire path
-    visbase = re.sub('\.\d+\.*\d*\~\d+\.*\d*[a-z,A-Z]?[Hz,hz,hZ,HZ]*\.','.',visbase) # Strip any SPWs from basename (when running outlier imaging separately per SPW)
-    targetfields = config_parser.get_key(config_parser.parse_args()['config'], 'fields', 'targetfields')
-
-    #Force taking first target field (relevant for writing outliers.txt at beginning of pipeline)
-    if type(targetfields) is str and ',' in targetfields:
-        targetfield = targetfields.split(',')[0]
-        msg = 'Multiple target fields input ("{0}"), but only one position can be used to identify outliers (for outlier imaging). Using "{1}".'
-        logger.warning(msg.format(targetfields,targetfield))
-    else:
-        targetfield = targetfields
-    #Make sure it's an integer
-    try:
-        targetfield = int(targetfield)
-    except ValueError: # It's not an int, but a str
-        targetfield = msmd.fieldsforname(targetfield)[0]
-
-    target_str = msmd.namesforfields(targetfield)[0]
-
-    if '.ms' in visbase and target_str not in visbase:
-        basename = visbase.replace('.ms','.{0}'.format(target_str))
-    else:
-        basename = visbase.replace('.mms', '')
+    context = get_selfcal_context(vis)
+    targetfield = context.targetfield
+    basename = context.basename
 
     imbase = basename + '_im_%d' # Images will be produced in $CWD
     imagename = imbase % loop
@@ -225,7 +752,7 @@ def get_selfcal_args(vis,loop,nloops,nterms,deconvolver,discard_nloops,calmode,o
     maskfile = imagename + ".islmask"
     rmsfile = imagename + ".rms"
     caltable = basename + '.gcal%d' % loop
-    prev_caltables = sorted(glob.glob('*.gcal?'))
+    prev_caltables = context.caltables
     cfcache = basename + '.cf'
     thresh = 10
 
@@ -258,11 +785,7 @@ def get_selfcal_args(vis,loop,nloops,nterms,deconvolver,discard_nloops,calmode,o
 
         #Derive sky model radius for outliers, assuming channel 0 (of SPW 0) is lowest frequency and therefore largest FWHM
         if outlier_radius == 0.0 or outlier_radius == '' and step == 'sky':
-            SPW = check_spw(config_parser.parse_args()['config'],msmd)
-            low_freq = float(SPW.replace('*:','').split('~')[0]) * 1e6 #MHz to Hz
-            rads=1.025*qa.constants(v='c')['value']/low_freq/ msmd.antennadiameter()['0']['value']
-            FWHM=qa.convert(qa.quantity(rads,'rad'),'deg')['value']
-            sky_model_radius = 1.5*FWHM #degrees
+            sky_model_radius = 1.5*context.beam_fwhm #degrees
             logger.warning('Using calculated search radius of {0:.1f} degrees.'.format(sky_model_radius))
         else:
             if step == 'sky':
@@ -272,14 +795,10 @@ def get_selfcal_args(vis,loop,nloops,nterms,deconvolver,discard_nloops,calmode,o
         outlierfile = ''
         sky_model_radius = 0.0
 
-    msmd.done()
-
     if not (type(threshold[loop]) is str and 'Jy' in threshold[loop]) and threshold[loop] > 1:
         if step in ['tclean','predict']:
             if os.path.exists(rmsfile):
-                from casatasks import imstat
-                stats = imstat(imagename=rmsfile)
-                threshold[loop] *= stats['min'][0]
+                threshold[loop] *= context.rms_min(rmsfile)
             else:
                 logger.error("'{0}' doesn't exist. Can't do thresholding at S/N > {1}. Loop 0 must use an absolute threshold value. Check the logs to see why RMS map not created.".format(rmsfile,threshold[loop]))
                 sys.exit(1)
@@ -324,8 +843,16 @@ def get_imaging_params():
 
     return args,params
 
+def list_outputs(dirs=['.','caltables']):
+
+    """Return the set of paths within the given directories (non-recursively)."""
+
+    return set([os.path.join(dir,f) for dir in dirs if os.path.isdir(dir) for f in os.listdir(dir)])
+
 def run_script(func,logfile=''):
 
+    import run_state
+
     # Get the name of the config file
     args = config_parser.parse_args()
 
@@ -334,24 +861,31 @@ def run_script(func,logfile=''):
 
     continue_run = config_parser.validate_args(taskvals, 'run', 'continue', bool, default=True)
     spw = config_parser.validate_args(taskvals, 'crosscal', 'spw', str)
-    nspw = config_parser.validate_args(taskvals, 'crosscal', 'nspw', int)
+    step = os.path.split(sys.argv[2])[1] if len(sys.argv) > 2 else func.__module__
+    abort_message = run_state.aborted()
 
-    if continue_run:
+    if continue_run and abort_message == '':
+        step_id = run_state.step_started(step, spw)
+        before = list_outputs()
         try:
             func(args,taskvals)
+            run_state.step_finished(step_id, 'COMPLETED', artifacts=sorted(list_outputs() - before))
             rename_logs(logfile)
         except Exception as err:
             logger.error('Exception found in the pipeline of type {0}: {1}'.format(type(err),err))
             logger.error(traceback.format_exc())
-            config_parser.overwrite_config(args['config'], conf_dict={'continue' : False}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
-            if nspw > 1:
-                for SPW in spw.split(','):
-                    spw_config = '{0}/{1}'.format(SPW.replace('*:',''),args['config'])
-                    config_parser.overwrite_config(spw_config, conf_dict={'continue' : False}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+            #Abort all subsequent steps of this run, including those in other SPW directories
+            message = '{0} failed in "{1}" with {2}: {3}'.format(step,os.getcwd(),type(err).__name__,err)
+            run_state.step_finished(step_id, 'FAILED', message=message, artifacts=sorted(list_outputs() - before))
+            run_state.abort(message)
             rename_logs(logfile)
             sys.exit(1)
     else:
-        logger.error('Exception found in previous pipeline job, which set "continue=False" in [run] section of "{0}". Skipping "{1}".'.format(args['config'],os.path.split(sys.argv[2])[1]))
+        if abort_message != '':
+            logger.error('Exception found in previous pipeline job ({0}). Skipping "{1}".'.format(abort_message,step))
+        else:
+            logger.error('"continue=False" set in [run] section of "{0}". Skipping "{1}".'.format(args['config'],step))
+        run_state.step_finished(run_state.step_started(step, spw), 'SKIPPED', message=abort_message)
         #os.system('./killJobs.sh') # and cancelling remaining jobs (scancel not found since /opt overwritten)
         rename_logs(logfile)
         sys.exit(1)
@@ -0,0 +1,225 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Models of known flux and polarisation calibrators, with each coefficient table stored once. Stokes I, Q and U are evaluated
+over the channel frequencies of every SPW, and fit to give the parameters of one manual setjy call per SPW, referenced to the
+centre of that SPW, so the model remains correct across the band (e.g. for nspw > 1 or after concatenation).
+"""
+
+import numpy as np
+
+import bookkeeping
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+
+#Stokes I coefficients of log10(S/Jy) as a polynomial in log10(freq/GHz), in ascending order (Perley & Butler 2013)
+#J0408-6545 is modelled as 17.066 Jy at 1.284 GHz with spectral index -1.179
+STOKES_I = {'J0408-6545' : [np.log10(17.066) + 1.179*np.log10(1.284), -1.179],
+            '3c286' : [1.2515, -0.4605, -0.1715, 0.0336],
+            '3c138' : [1.0332, -0.5608, -0.1197, 0.041],
+            '3c48' : [1.3324, -0.7690, -0.1950, 0.059]}
+
+#Fractional linear polarisation and polarisation angle (deg) at frequencies (GHz), from Perley & Butler 2013
+#J1130-1449 is a manual model from Russ Taylor, taken from the MeerKAT polarisation calibrator project
+POLARISATION = {'3c286' : ([1.02, 1.47, 1.87, 2.57, 3.57, 4.89, 6.68, 8.43, 11.3],
+                           [0.086, 0.098, 0.101, 0.106, 0.112, 0.115, 0.119, 0.121, 0.123],
+                           [33.0]*8 + [34.0]),
+                '3c138' : ([1.05, 1.45, 1.64, 1.95, 2.45, 2.95, 3.25],
+                           [0.056, 0.075, 0.084, 0.09, 0.104, 0.107, 0.10],
+                           [-14.0, -11.0, -10.0, -10.0, -10.0, -10.0, -10.0]),
+                '3c48' : ([1.05, 1.45, 1.64],
+                          [0.003, 0.005, 0.007],
+                          [25.0, 140.0, -5.0]),
+                'J1130-1449' : ([1.05, 1.45, 1.64],
+                                [0.038, 0.050, 0.056],
+                                [145.0, 66.0, 45.0])}
+
+#Degree of the polynomials fit to the polarisation tables, and of the expansions passed into setjy
+POLY_DEG = 2
+
+#Fits to the polarisation tables (descending order in freq/GHz), done once
+POL_FITS = {source : (np.polyfit(freqs, frac, POLY_DEG), np.polyfit(freqs, angle, POLY_DEG))
+            for source,(freqs,frac,angle) in POLARISATION.items()}
+
+#Models per (source, SPW layout), memoised per process
+_models = {}
+
+def source_name(fieldname):
+
+    """Return the name of a known calibrator (as used in this module) matching a field name or any of its aliases, otherwise ''."""
+
+    for aliases in [bookkeeping.FLUXCAL_NAMES] + bookkeeping.POLCAL_NAMES:
+        if bookkeeping.find_known_field([fieldname], aliases) != '':
+            return aliases[0]
+    return ''
+
+def stokes_spectra(source, freqs):
+
+    """Evaluate the model of a known calibrator at a set of frequencies.
+
+    Arguments:
+    ----------
+    source : str
+        Calibrator name, from ``source_name``.
+    freqs : array_like
+        Frequencies in GHz.
+
+    Returns:
+    --------
+    I, Q, U : class ``numpy.ndarray``
+        Stokes parameters in Jy, or fractional Q and U (i.e. with I=1) if the calibrator has no Stokes I model."""
+
+    freqs = np.asarray(freqs, dtype=float)
+
+    I = np.ones(freqs.shape)
+    if source in STOKES_I:
+        I = 10**np.polynomial.polynomial.polyval(np.log10(freqs), STOKES_I[source])
+
+    Q = np.zeros(freqs.shape)
+    U = np.zeros(freqs.shape)
+    if source in POL_FITS:
+        frac = np.polyval(POL_FITS[source][0], freqs)
+        angle = np.deg2rad(np.polyval(POL_FITS[source][1], freqs))
+        Q = I * frac * np.cos(2*angle)
+        U = I * frac * np.sin(2*angle)
+
+    return I, Q, U
+
+def setjy_params(source, freqs):
+
+    """Return the parameters of a manual setjy call that reproduces the model over one SPW.
+
+    Arguments:
+    ----------
+    source : str
+        Calibrator name, from ``source_name``.
+    freqs : array_like
+        Channel frequencies of the SPW in Hz.
+
+    Returns:
+    --------
+    params : dict
+        fluxdensity, spix, reffreq, polindex and polangle (in radians), referenced to the mean frequency of the SPW."""
+
+    freqs = np.asarray(freqs, dtype=float) / 1e9
+    reffreq = np.mean(freqs)
+    deg = min(POLY_DEG, freqs.size - 1)
+    I, Q, U = stokes_spectra(source, np.append(freqs, reffreq))
+    I0 = I[-1]
+    I, Q, U = I[:-1], Q[:-1], U[:-1]
+
+    params = {'fluxdensity' : [float(I0), 0.0, 0.0, 0.0], 'spix' : [], 'reffreq' : '{0}GHz'.format(reffreq),
+              'polindex' : [], 'polangle' : []}
+
+    #spix expands ln(I/I0) in ln(freq/reffreq), while polindex and polangle expand in (freq-reffreq)/reffreq
+    if deg > 0:
+        params['spix'] = list(np.polynomial.polynomial.polyfit(np.log(freqs/reffreq), np.log(I/I0), deg)[1:])
+        if source in POL_FITS:
+            x = (freqs - reffreq) / reffreq
+            params['polindex'] = list(np.polynomial.polynomial.polyfit(x, np.hypot(Q, U) / I, deg))
+            params['polangle'] = list(np.polynomial.polynomial.polyfit(x, 0.5*np.unwrap(np.arctan2(U, Q)), deg))
+
+    return params
+
+def spw_models(source, msmd):
+
+    """Return the setjy parameters of a known calibrator for each SPW, memoised per (source, SPW layout).
+
+    Arguments:
+    ----------
+    source : str
+        Calibrator name, from ``source_name``.
+    msmd : class ``casatools.msmetadata``
+        Open msmetadata object.
+
+    Returns:
+    --------
+    models : list
+        setjy parameters (from ``setjy_params``) for each SPW."""
+
+    chanfreqs = [msmd.chanfreqs(spw) for spw in range(msmd.nspw())]
+    key = (source, tuple([(freqs.size, float(freqs[0]), float(freqs[-1])) for freqs in chanfreqs]))
+
+    if key not in _models:
+        _models[key] = [setjy_params(source, freqs) for freqs in chanfreqs]
+    return _models[key]
+
+def set_models(visname, field, msmd, usescratch=False):
+
+    """Set the model of a known calibrator with one manual setjy call per SPW.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    field : str
+        Field name of a known calibrator with a Stokes I model.
+    msmd : class ``casatools.msmetadata``
+        Open msmetadata object of this MS.
+    usescratch : bool, optional
+        Write the model to the MODEL_DATA column, rather than storing a virtual model?"""
+
+    from casatasks import setjy
+
+    source = source_name(field)
+    if source not in STOKES_I:
+        raise ValueError('No Stokes I model for field "{0}".'.format(field))
+
+    for spw,params in enumerate(spw_models(source, msmd)):
+        logger.info('Setting manual model of "{0}" in SPW {1}: fluxdensity={fluxdensity}, spix={spix}, reffreq={reffreq}, polindex={polindex}, polangle={polangle}'.format(field,spw,**params))
+        setjy(vis=visname, field=field, spw=str(spw), scalebychan=True, standard='manual', rotmeas=0, usescratch=usescratch, **params)
+
+def set_field_models(visname, fluxfield, spw, standard, dopol=False, usescratch=False):
+
+    """Set the models of the flux calibrator, and of any known polarisation calibrators if dopol=True. J0408-6545 is modelled
+    per SPW, and other flux calibrators use the flux density standard.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    fluxfield : str
+        Flux calibrator field name(s) or ID(s). Only the first is used.
+    spw : str
+        SPW selection passed into setjy when using the flux density standard.
+    standard : str
+        Flux density standard (e.g. 'Perley-Butler 2017').
+    dopol : bool, optional
+        Also set the polarised models of known polarisation calibrators?
+    usescratch : bool, optional
+        Write the models to the MODEL_DATA column, rather than storing virtual models?"""
+
+    from casatasks import setjy
+    from casatools import msmetadata
+    msmd = msmetadata()
+
+    msmd.open(visname)
+    fieldnames = msmd.fieldnames()
+    setjyname = fluxfield.split(",")[0]
+    if setjyname.isdigit():
+        setjyname = msmd.namesforfields(int(setjyname))[0]
+
+    #Only the flux calibrators without a model in the flux density standards (i.e. J0408-6545) are modelled manually
+    if source_name(setjyname) == bookkeeping.FLUXCAL_NAMES[0]:
+        logger.info("Using manual flux density scale for {0}".format(setjyname))
+        set_models(visname, setjyname, msmd, usescratch)
+    else:
+        setjy(vis=visname, field=setjyname, spw=spw, scalebychan=True, standard=standard, usescratch=usescratch)
+
+    if dopol:
+        #Set the polarised models of each known polarisation calibrator present in the data, overwriting the (unpolarised)
+        #flux density standard model if it is also the flux calibrator
+        for aliases in bookkeeping.POLCAL_NAMES:
+            polname = bookkeeping.find_known_field(fieldnames, aliases)
+            if polname != '' and source_name(polname) in STOKES_I:
+                logger.info("Detected calibrator name(s):  %s" % polname)
+                logger.info("Flux density from Perley & Butler 2013, and polarization index and position angle of polarized emission fit to Perley & Butler 2013 (https://ui.adsabs.harvard.edu/abs/2013ApJS..204...19P/abstract)")
+                set_models(visname, polname, msmd, usescratch)
+
+    msmd.done()
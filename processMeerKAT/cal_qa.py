@@ -0,0 +1,208 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Quality assessment of caltables, to find bad antennas straight after a solve rather than in the plots after the run. Per-antenna
+metrics are computed from all solutions at once: the fractional amplitude scatter and the phase RMS (about the mean phasor of
+each antenna) of complex solutions, and the delay scatter (about the mean delay of each antenna) of delay solutions. Absolute
+delays legitimately differ between antennas, so only their stability is assessed. Antennas are outliers when a metric exceeds
+the median over antennas by nsigma robust standard deviations (from the median absolute deviation), and also exceeds a minimum
+deviation, so that very stable arrays don't flag antennas for tiny differences.
+
+Usage: cal_qa.py caltable [caltable ...]
+"""
+
+import os
+import sys
+import numpy as np
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Minimum deviation from the median over antennas for an outlier, per metric
+MIN_DEVIATION = {'amp scatter' : 0.1, 'phase rms' : np.deg2rad(10.0), 'delay scatter' : 2.0}
+
+#If more than this fraction of antennas are outliers, the solutions (not the antennas) are likely at fault, so none are flagged
+MAX_FRACTION = 0.2
+
+def antenna_metrics(caltable):
+
+    """Compute per-antenna metrics from all unflagged solutions of a caltable.
+
+    Arguments:
+    ----------
+    caltable : str
+        Path to caltable, with either complex (CPARAM) or delay (FPARAM) solutions.
+
+    Returns:
+    --------
+    names : list
+        Antenna names, indexed by antenna ID.
+    metrics : dict
+        Array of each metric per antenna and polarisation (shape nant x npol), with NaN where an antenna has no solutions."""
+
+    from casatools import table
+    tb = table()
+
+    tb.open(os.path.join(caltable, 'ANTENNA'))
+    names = list(tb.getcol('NAME'))
+    tb.close()
+    nant = len(names)
+
+    tb.open(caltable)
+    ant = tb.getcol('ANTENNA1')
+    flag = tb.getcol('FLAG')
+    cols = tb.colnames()
+    if 'CPARAM' in cols:
+        sol = tb.getcol('CPARAM')
+    else:
+        sol = tb.getcol('FPARAM')
+    tb.close()
+
+    #Flatten (pol, chan, row) into (pol, solution), keeping the antenna of each solution
+    npol = sol.shape[0]
+    sol = sol.reshape(npol, -1)
+    good = ~flag.reshape(npol, -1)
+    ant = np.broadcast_to(ant, flag.shape[1:]).ravel()
+
+    def antenna_mean(values):
+        #Mean over the good solutions of each antenna, per polarisation
+        total = np.array([np.bincount(ant, weights=np.where(good[pol], values[pol], 0), minlength=nant) for pol in range(npol)])
+        count = np.array([np.bincount(ant, weights=good[pol].astype(float), minlength=nant) for pol in range(npol)])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (total / count).T
+
+    metrics = {}
+    if np.iscomplexobj(sol):
+        amp = np.abs(sol)
+        mean_amp = antenna_mean(amp)
+        var_amp = antenna_mean(amp**2) - mean_amp**2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            metrics['amp scatter'] = np.sqrt(np.clip(var_amp, 0, None)) / mean_amp
+
+        #Phase of each solution about the mean phasor of its antenna
+        unit = np.exp(1j*np.angle(sol))
+        mean_phasor = antenna_mean(unit.real) + 1j*antenna_mean(unit.imag)
+        offset = np.angle(unit * np.conj(mean_phasor.T[:, ant]))
+        metrics['phase rms'] = np.sqrt(antenna_mean(offset**2))
+    else:
+        mean_delay = antenna_mean(sol)
+        var_delay = antenna_mean(sol**2) - mean_delay**2
+        metrics['delay scatter'] = np.sqrt(np.clip(var_delay, 0, None))
+
+    return names, metrics
+
+def outliers(values, metric, nsigma):
+
+    """Return a mask of the outlying antennas (in any polarisation) of one metric, given as an array of shape nant x npol.
+    Each metric is a scatter or RMS, so antennas are only outliers when larger than the median."""
+
+    median = np.nanmedian(values, axis=0)
+    deviation = values - median
+
+    sigma = 1.4826 * np.nanmedian(np.abs(values - median), axis=0)
+    with np.errstate(invalid='ignore'):
+        bad = (deviation > nsigma * sigma) & (deviation > MIN_DEVIATION[metric])
+    return np.any(bad, axis=1)
+
+def refant_names(caltable, refant):
+
+    """Return the antenna names of the reference antenna(s), which may be given as names, stations (as written by
+    calc_refant.py) or IDs."""
+
+    from casatools import table
+    tb = table()
+
+    tb.open(os.path.join(caltable, 'ANTENNA'))
+    names = list(tb.getcol('NAME'))
+    stations = list(tb.getcol('STATION'))
+    tb.close()
+
+    refants = []
+    for ant in [ant.strip(" '\"") for ant in refant.split(',') if ant.strip(" '\"") != '']:
+        if ant in stations:
+            refants.append(names[stations.index(ant)])
+        elif ant.isdigit() and int(ant) < len(names):
+            refants.append(names[int(ant)])
+        else:
+            refants.append(ant)
+    return refants
+
+def check_tables(caltables, nsigma=5.0, refant=''):
+
+    """Find the bad antennas in each caltable.
+
+    Arguments:
+    ----------
+    caltables : list
+        Paths to caltables. Those that don't exist are skipped.
+    nsigma : float, optional
+        Number of robust standard deviations beyond which an antenna is an outlier.
+    refant : str, optional
+        Reference antenna name(s), station(s) or ID(s), which are never reported as bad.
+
+    Returns:
+    --------
+    bad : dict
+        For each caltable with bad antennas, a dictionary of antenna name to a list of the metrics in which it is an outlier."""
+
+    bad = {}
+    for caltable in caltables:
+        if not os.path.exists(caltable):
+            continue
+
+        names, metrics = antenna_metrics(caltable)
+        refants = refant_names(caltable, refant)
+        reasons = {}
+        for metric,values in metrics.items():
+            for i in np.where(outliers(values, metric, nsigma))[0]:
+                if names[i] not in refants:
+                    reasons.setdefault(names[i], []).append(metric)
+
+        if len(reasons) > MAX_FRACTION * len(names):
+            logger.warning("{0} of {1} antennas are outliers in '{2}', so the solutions are likely at fault. Not flagging them.".format(len(reasons),len(names),caltable))
+        elif len(reasons) > 0:
+            for name in sorted(reasons.keys()):
+                logger.warning("Antenna {0} is an outlier in '{1}' ({2}).".format(name, caltable, ', '.join(reasons[name])))
+            bad[caltable] = reasons
+        else:
+            logger.info("No outlying antennas in '{0}'.".format(caltable))
+
+    return bad
+
+def flag_antennas(vislist, antennas, version='cal_qa'):
+
+    """Flag all data of a list of antennas in each MS, saving the flags beforehand as a flag version.
+
+    Arguments:
+    ----------
+    vislist : list
+        Paths to MSs (e.g. the full MS and any calibrator-only datasets solved against).
+    antennas : list
+        Antenna names.
+    version : str, optional
+        Name of the flag version saved beforehand."""
+
+    from casatasks import flagdata
+    import flag_versions
+    import bookkeeping
+
+    antenna = ','.join(sorted(antennas))
+    for vis in vislist:
+        flag_versions.save(vis, version, comment='Before flagging bad antennas {0} found in caltables'.format(antenna))
+        logger.info("Flagging antennas '{0}' in '{1}'.".format(antenna, vis))
+        flagdata(vis=vis, mode='manual', antenna=antenna, action='apply', flagbackup=False)
+        bookkeeping.forget_fingerprint(vis)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] == '-h':
+        print(__doc__)
+        sys.exit(0)
+
+    check_tables(sys.argv[1:])
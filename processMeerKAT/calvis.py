@@ -0,0 +1,92 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Compact calibrator-only datasets to solve against, so that each solve doesn't read every row of the target-heavy MS. The
+calibrator fields are split out and averaged in time (within scans), keeping the original field and SPW IDs, so the solutions
+apply back to the full MS. Optionally, a channel-averaged copy is written for the (frequency-independent) gain solves. Each
+dataset is rebuilt whenever the flags or layout of the full MS, or the inputs of the calibrator models, have changed, after
+which the calibrator models are set again.
+"""
+
+import os
+import json
+import shutil
+
+import bookkeeping
+import cal_models
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+
+def calibrator_vis(visname, fields, timebin='', chanbin=1, polfield='', spw='', standard='Perley-Butler 2017', dopol=False, usescratch=False):
+
+    """Return the datasets to solve against, building (or rebuilding) them if needed.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to full MS.
+    fields : namedtuple
+        Field IDs, from ``bookkeeping.get_field_ids``.
+    timebin : str, optional
+        Averaging time within each scan (e.g. '60s'). Use '' to solve against the full MS.
+    chanbin : int, optional
+        Number of channels to average for the gain solves. Use 1 for no channel averaging.
+    polfield : str, optional
+        Polarisation calibrator to include, if not one of the input fields.
+    spw, standard, dopol, usescratch : optional
+        Inputs to ``cal_models.set_field_models``, used to set the models of the calibrator dataset.
+
+    Returns:
+    --------
+    solvevis : str
+        Path to the dataset for delay, bandpass, leakage and cross-hand phase solves.
+    gainvis : str
+        Path to the dataset for gain solves."""
+
+    if timebin == '':
+        return visname, visname
+
+    from casatasks import mstransform
+
+    basename = os.path.splitext(os.path.basename(visname.rstrip('/ ')))[0]
+    calfields = ','.join(sorted(set([i for i in (','.join([fields.gainfields, fields.bpassfield, fields.xpolfield, fields.extrafields, polfield]).split(',')) if i])))
+    fingerprint = bookkeeping.ms_fingerprint(visname, refresh=True)
+
+    solvevis = '{0}.calibrators.ms'.format(basename)
+    gainvis = '{0}.calibrators.chanavg.ms'.format(basename) if chanbin > 1 else solvevis
+    inputs = {'vis' : fingerprint, 'fields' : calfields, 'timebin' : timebin, 'chanbin' : chanbin,
+              'fluxfield' : fields.fluxfield, 'spw' : spw, 'standard' : standard, 'dopol' : dopol, 'usescratch' : usescratch}
+
+    sidecar = '{0}.json'.format(solvevis)
+    if os.path.exists(sidecar) and os.path.exists(gainvis) and json.load(open(sidecar)) == inputs:
+        logger.info('Solving against existing calibrator dataset(s) "{0}" and "{1}".'.format(solvevis,gainvis))
+        return solvevis, gainvis
+
+    for vis in set([solvevis, gainvis]):
+        if os.path.exists(vis):
+            shutil.rmtree(vis)
+
+    #Keep field and SPW IDs so solutions apply back to the full MS, and drop fully flagged rows
+    logger.info('Splitting calibrator fields "{0}" of "{1}" into "{2}", averaged to {3} within scans.'.format(calfields,visname,solvevis,timebin))
+    mstransform(vis=visname, outputvis=solvevis, field=calfields, datacolumn='data', timeaverage=True, timebin=timebin,
+                keepflags=False, usewtspectrum=True, reindex=False)
+
+    if chanbin > 1:
+        logger.info('Averaging {0} channels of "{1}" into "{2}" for gain solves.'.format(chanbin,solvevis,gainvis))
+        mstransform(vis=solvevis, outputvis=gainvis, datacolumn='data', chanaverage=True, chanbin=chanbin,
+                    keepflags=False, usewtspectrum=True, reindex=False)
+
+    #Models are not copied into the new datasets
+    for vis in set([solvevis, gainvis]):
+        cal_models.set_field_models(vis, fields.fluxfield, spw, standard, dopol, usescratch)
+
+    with open(sidecar, 'w') as f:
+        json.dump(inputs, f)
+
+    return solvevis, gainvis
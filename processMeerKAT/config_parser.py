@@ -6,6 +6,9 @@ import argparse
 import configparser
 import ast
 
+import logging
+logger = logging.getLogger(__name__)
+
 # Might need this for config validation
 
 # def validate_args(kwdict, section, key, dtype, default=None):
@@ -114,24 +117,22 @@ def remove_section(filename, section):
     config.write(config_file)
     config_file.close()
 
-# Keep the below around in case we need it
-
-# def overwrite_config(filename, conf_dict={}, conf_sec='', sec_comment=''):
+def overwrite_config(filename, conf_dict={}, conf_sec='', sec_comment=''):
 
-#     config_dict,config = parse_config(filename)
+    config_dict,config = parse_config(filename)
 
-#     if conf_sec not in config.sections():
-#         processATA.logger.debug('Writing [{0}] section in config file "{1}" with:\n{2}.'.format(conf_sec,filename,conf_dict))
-#         config.add_section(conf_sec)
-#     else:
-#         processATA.logger.debug('Overwritting [{0}] section in config file "{1}" with:\n{2}.'.format(conf_sec,filename,conf_dict))
+    if conf_sec not in config.sections():
+        logger.debug('Writing [{0}] section in config file "{1}" with:\n{2}.'.format(conf_sec,filename,conf_dict))
+        config.add_section(conf_sec)
+    else:
+        logger.debug('Overwritting [{0}] section in config file "{1}" with:\n{2}.'.format(conf_sec,filename,conf_dict))
 
-#     if sec_comment != '':
-#         config.set(conf_sec, sec_comment)
+    if sec_comment != '':
+        config.set(conf_sec, sec_comment)
 
-#     for key in conf_dict.keys():
-#         config.set(conf_sec, key, str(conf_dict[key]))
+    for key in conf_dict.keys():
+        config.set(conf_sec, key, str(conf_dict[key]))
 
-#     config_file = open(filename, 'w')
-#     config.write(config_file)
-#     config_file.close()
\ No newline at end of file
+    config_file = open(filename, 'w')
+    config.write(config_file)
+    config_file.close()
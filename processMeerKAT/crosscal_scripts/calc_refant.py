@@ -7,9 +7,13 @@ Calculates the reference antenna
 import config_parser
 from config_parser import validate_args as va
 import bookkeeping
+import flag_stats
 
 import os
+import glob
+import json
 import numpy as np
+from multiprocessing import Pool
 
 from casatasks import *
 logfile=casalog.logfile()
@@ -24,7 +28,197 @@ logging.Formatter.converter = gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
-def get_ref_ant(visname, fluxfield):
+#Memory budget (bytes) of the rows read at once by each process
+CHUNK_BYTES = 256 * 1024**2
+
+#Bytes per sampled visibility of a chunk, from complex64 DATA and boolean FLAG, plus the float64 and complex128 working arrays
+VIS_BYTES = 9 + 24
+
+#Number of channel bins over which phase and amplitude stability are measured
+NBINS = 16
+
+#Maximum number of channels of each parallel hand read per row for the stability metrics
+MAX_CHANNELS = 256
+
+#Weights for combining the (normalised) metrics into a single score, where lower is better
+SCORE_WEIGHTS = {'flags' : 0.4, 'phase' : 0.3, 'amp' : 0.2, 'distance' : 0.1}
+
+def sample_slice(ncorr, nchan):
+
+    """Return the (blc, trc, incr) of the cell slice read for the stability metrics, taking the first and last (i.e. parallel hand)
+    correlations, and every n'th channel such that no more than MAX_CHANNELS are read."""
+
+    return [0, 0], [ncorr-1, nchan-1], [max(ncorr-1, 1), int(np.ceil(nchan / MAX_CHANNELS))]
+
+def chunk_rows(ncorr, nchan, countflags=True, chunkbytes=CHUNK_BYTES):
+
+    """Return the number of rows whose sampled visibilities (and full FLAG cells, when counting flags) fit within a memory budget."""
+
+    blc, trc, incr = sample_slice(ncorr, nchan)
+    nsample = len(range(0, ncorr, incr[0])) * len(range(0, nchan, incr[1]))
+    return max(1, int(chunkbytes // (ncorr * nchan * int(countflags) + nsample * VIS_BYTES)))
+
+def accumulate_stats(visname, fieldid, nant, countflags=True, chunkbytes=CHUNK_BYTES):
+
+    """Accumulate flag counts and amplitude/phase stability sums for a single field, in one chunked pass over the MS.
+
+    Flags are counted per antenna, unless already summarised by flag_stats.py. For stability, the unflagged parallel-hand
+    visibilities of each row are sampled (in channel) from a slice of the DATA column, averaged within NBINS channel bins,
+    and the phase (as a unit phasor) and amplitude of each bin are summed over time per baseline.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS (or sub-MS).
+    fieldid : int
+        Field ID to select.
+    nant : int
+        Number of antennas in the MS.
+    countflags : bool, optional
+        Count flags per antenna? If False, only the FLAG slice matching the sampled visibilities is read.
+    chunkbytes : int, optional
+        Memory budget (bytes) of the rows read at once.
+
+    Returns:
+    --------
+    sums : dict
+        Arrays 'rows', 'flagged' and 'total' (per antenna), and 'n', 're', 'im', 'amp' and 'amp2' (per baseline and bin),
+        which can be summed over sub-MSs."""
+
+    tb = table()
+    tb.open(visname)
+    sub = tb.query('FIELD_ID=={0} AND ANTENNA1!=ANTENNA2'.format(fieldid))
+    nrows = sub.nrows()
+
+    sums = {'rows' : np.zeros(nant), 'flagged' : np.zeros(nant), 'total' : np.zeros(nant)}
+    for key in ['n','re','im','amp','amp2']:
+        sums[key] = np.zeros((nant*nant, 0))
+
+    #Sub-MSs of a scan-partitioned MMS may have no rows of this field
+    if nrows == 0:
+        sub.close()
+        tb.close()
+        return sums
+
+    ncorr, nchan = sub.getcell('FLAG', 0).shape
+    blc, trc, incr = sample_slice(ncorr, nchan)
+    nchunk = chunk_rows(ncorr, nchan, countflags, chunkbytes)
+
+    for startrow in range(0, nrows, nchunk):
+        nrow = min(nchunk, nrows - startrow)
+        ant1 = sub.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+        ant2 = sub.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+
+        #Each baseline counts towards both of its antennas
+        for ant in [ant1, ant2]:
+            sums['rows'] += np.bincount(ant, minlength=nant)
+
+        if countflags:
+            flag = sub.getcol('FLAG', startrow=startrow, nrow=nrow)
+            nflags = flag.reshape(-1, nrow).sum(axis=0)
+            for ant in [ant1, ant2]:
+                sums['flagged'] += np.bincount(ant, weights=nflags, minlength=nant)
+                sums['total'] += np.bincount(ant, minlength=nant) * ncorr * nchan
+            flag = flag[::incr[0], ::incr[1]]
+        else:
+            flag = sub.getcolslice('FLAG', blc, trc, incr, startrow=startrow, nrow=nrow)
+
+        #Read the sampled parallel hands only, matching the flags
+        data = sub.getcolslice('DATA', blc, trc, incr, startrow=startrow, nrow=nrow)
+
+        #Average unflagged parallel hands within channel bins, giving shape (2*nbins, nrow)
+        nsample = data.shape[1]
+        starts = np.unique(np.arange(min(NBINS, nsample)) * nsample // min(NBINS, nsample))
+        good = (~flag[[0,-1]]).astype(int)
+        amp = np.abs(data[[0,-1]])
+        phasor = np.where((good > 0) & (amp > 0), data[[0,-1]] / np.where(amp > 0, amp, 1), 0)
+        ngood = np.add.reduceat(good, starts, axis=1).reshape(-1, nrow)
+        binned = np.add.reduceat(phasor, starts, axis=1).reshape(-1, nrow)
+        binamp = np.add.reduceat(np.where(good > 0, amp, 0), starts, axis=1).reshape(-1, nrow)
+
+        valid = (ngood > 0) & (np.abs(binned) > 0)
+        binned = np.where(valid, binned / np.where(valid, np.abs(binned), 1), 0)
+        binamp = np.where(valid, binamp / np.maximum(ngood, 1), 0)
+
+        if sums['n'].shape[1] == 0:
+            for key in ['n','re','im','amp','amp2']:
+                sums[key] = np.zeros((nant*nant, binned.shape[0]))
+
+        baseline = ant1 * nant + ant2
+        for i in range(binned.shape[0]):
+            sums['n'][:,i] += np.bincount(baseline, weights=valid[i].astype(float), minlength=nant*nant)
+            sums['re'][:,i] += np.bincount(baseline, weights=binned[i].real, minlength=nant*nant)
+            sums['im'][:,i] += np.bincount(baseline, weights=binned[i].imag, minlength=nant*nant)
+            sums['amp'][:,i] += np.bincount(baseline, weights=binamp[i], minlength=nant*nant)
+            sums['amp2'][:,i] += np.bincount(baseline, weights=binamp[i]**2, minlength=nant*nant)
+
+    sub.close()
+    tb.close()
+
+    return sums
+
+def merge_stats(stats):
+
+    """Sum the output of accumulate_stats over several sub-MSs."""
+
+    merged = {}
+    for key in stats[0].keys():
+        arrays = [sums[key] for sums in stats if sums[key].size > 0]
+        merged[key] = np.sum(arrays, axis=0) if len(arrays) > 0 else stats[0][key]
+    return merged
+
+def antenna_metrics(sums, nant):
+
+    """Return per-antenna flag fraction, amplitude coefficient of variation and phase circular variance. The stability
+    metrics are the mean over every baseline and channel bin including that antenna, with more than one sample in time."""
+
+    flags = np.where(sums['total'] > 0, sums['flagged'] / np.maximum(sums['total'], 1), 1)
+    ampcv = np.full(nant, np.nan)
+    phasevar = np.full(nant, np.nan)
+
+    if sums['n'].size > 0:
+        n = sums['n']
+        use = n > 1
+        mean = np.where(use, sums['amp'] / np.maximum(n, 1), np.nan)
+        var = np.where(use, sums['amp2'] / np.maximum(n, 1) - mean**2, np.nan)
+        cv = np.sqrt(np.maximum(var, 0)) / np.where(mean > 0, mean, np.nan)
+        circvar = np.where(use, 1 - np.hypot(sums['re'], sums['im']) / np.maximum(n, 1), np.nan)
+
+        cv = cv.reshape(nant, nant, -1)
+        circvar = circvar.reshape(nant, nant, -1)
+        for ant in range(nant):
+            antcv = np.concatenate([cv[ant,:].ravel(), cv[:,ant].ravel()])
+            antvar = np.concatenate([circvar[ant,:].ravel(), circvar[:,ant].ravel()])
+            if np.any(np.isfinite(antcv)):
+                ampcv[ant] = np.nanmean(antcv)
+            if np.any(np.isfinite(antvar)):
+                phasevar[ant] = np.nanmean(antvar)
+
+    return flags, ampcv, phasevar
+
+def array_distance(visname):
+
+    """Return the distance (m) of each antenna from the array centre, taken as the mean of the antenna positions."""
+
+    tb = table()
+    tb.open('{0}/ANTENNA'.format(visname.rstrip('/ ')))
+    positions = tb.getcol('POSITION')
+    tb.close()
+
+    return np.linalg.norm(positions - positions.mean(axis=1)[:,np.newaxis], axis=0)
+
+def normalise(metric):
+
+    """Scale a metric to [0,1] across antennas, treating missing values as worst."""
+
+    metric = np.where(np.isfinite(metric), metric, np.nan)
+    if np.all(np.isnan(metric)):
+        return np.zeros(metric.size)
+    low, high = np.nanmin(metric), np.nanmax(metric)
+    scaled = (metric - low) / (high - low) if high > low else np.zeros(metric.size)
+    return np.where(np.isnan(scaled), 1, scaled)
+
+def get_ref_ant(visname, fluxfield, outfile='ant_stats.json'):
 
     msmd.open(visname)
     if type(fluxfield) is str:
@@ -32,46 +226,67 @@ def get_ref_ant(visname, fluxfield):
     fluxscans = msmd.scansforfield(int(fluxfield))
     logger.info("Flux field scan no: %d" % fluxscans[0])
     antennas = msmd.antennasforscan(fluxscans[0])
+    nant = msmd.nantennas()
 
-    header = '{0: <3} {1: <4}'.format('ant', 'flags')
-    logger.info("Antenna statistics on total flux calibrator")
-    logger.info(header)
+    #Use the flag summary if it already exists, rather than counting flags again
+    stats = flag_stats.load(visname) if flag_stats.exists(visname) else None
+    countflags = stats is None
 
-    tb.open(visname)
+    #Accumulate over each sub-MS of an MMS in parallel, sharing the memory budget between processes
+    if os.path.exists('{0}/SUBMSS'.format(visname)):
+        vislist = sorted(glob.glob('{0}/SUBMSS/*'.format(visname.rstrip('/ '))))
+    else:
+        vislist = [visname]
 
-    fptr = open('ant_stats.txt', 'w')
-    fptr.write(header + '\n')
+    if len(vislist) > 1:
+        nproc = min(len(vislist), len(os.sched_getaffinity(0)))
+        with Pool(processes=nproc) as pool:
+            sums = merge_stats(pool.starmap(accumulate_stats, [(vis, int(fluxfield), nant, countflags, CHUNK_BYTES // nproc) for vis in vislist]))
+    else:
+        sums = accumulate_stats(visname, int(fluxfield), nant, countflags)
 
-    antflags = []
-    for ant in antennas:
-        antdat = tb.query('ANTENNA1==%d AND FIELD_ID==%d' % (ant, int(fluxfield))).getcol('FLAG')
+    flags, ampcv, phasevar = antenna_metrics(sums, nant)
+    distance = array_distance(visname)
 
-        if antdat.size == 0:
-            flags = 1
-            fptr.write('{0: <3} {1:.4f}\n'.format(ant, np.nan))
-            logger.info('{0: <3} {1:.4f}'.format(ant, np.nan))
-            antflags.append(flags)
-            continue
+    #Flagged fraction on this field, and over the whole observation, if already summarised
+    if stats is not None:
+        flags = np.nan_to_num(stats.antenna_fraction(int(fluxfield)), nan=1.0)
+        allflags = stats.antenna_fraction()
+    else:
+        allflags = np.full(nant, np.nan)
 
-        flags = np.count_nonzero(antdat)/float(antdat.size)
+    score = SCORE_WEIGHTS['flags'] * flags + SCORE_WEIGHTS['amp'] * normalise(ampcv) + \
+            SCORE_WEIGHTS['phase'] * normalise(phasevar) + SCORE_WEIGHTS['distance'] * normalise(distance)
+    score[sums['rows'] == 0] = np.inf
 
-        fptr.write('{0: <3} {1:.4f}\n'.format(ant, flags))
-        logger.info('{0: <3} {1:.4f}'.format(ant, flags))
-        antflags.append(flags)
+    ranked = sorted(antennas, key=lambda ant: score[ant])
+    names = msmd.antennanames()
+    stations = [msmd.antennastations(ant)[0] for ant in range(nant)]
 
-    tb.close()
-    tb.done()
-    fptr.close()
+    header = '{0: <4} {1: <6} {2: <6} {3: <7} {4: <7} {5: <8} {6: <6}'.format('rank', 'ant', 'flags', 'ampcv', 'phasevar', 'distance', 'score')
+    logger.info("Antenna statistics on total flux calibrator")
+    logger.info(header)
+
+    rows = []
+    for rank,ant in enumerate(ranked):
+        row = {'rank' : rank, 'id' : int(ant), 'name' : names[ant], 'station' : stations[ant],
+               'flags' : float(flags[ant]), 'flags_all' : float(allflags[ant]), 'ampcv' : float(ampcv[ant]), 'phasevar' : float(phasevar[ant]),
+               'distance' : float(distance[ant]), 'score' : float(score[ant])}
+        rows.append(row)
+        logger.info('{rank: <4} {name: <6} {flags:<6.4f} {ampcv:<7.4f} {phasevar:<7.4f} {distance:<8.1f} {score:<6.4f}'.format(**row))
 
-    badants = []
-    for idx, ant in enumerate(antflags):
-        if ant > 0.8:
-            badants.append(antennas[idx])
+    #NaN and inf aren't valid JSON, so write them as null
+    with open(outfile, 'w') as f:
+        json.dump({'vis' : visname, 'field' : int(fluxfield), 'weights' : SCORE_WEIGHTS,
+                   'antennas' : [{key : (val if type(val) is not float or np.isfinite(val) else None) for key,val in row.items()} for row in rows]},
+                  f, indent=1)
+    logger.info("Antenna statistics written to '{0}'.".format(outfile))
 
-    refidx = np.argmin(antflags)
+    badants = [int(ant) for ant in antennas if flags[ant] > 0.8]
 
-    logger.info('{0: <3} {1:.4f} (best antenna)'.format(antennas[refidx], antflags[refidx]))
-    referenceant = msmd.antennastations(refidx)[0] # or msmd.antennanames(np.where(msmd.antennaids() == refidx)[0][0])[0]
+    refant = ranked[0]
+    logger.info('{0: <3} {1:.4f} (best antenna)'.format(refant, score[refant]))
+    referenceant = stations[refant] # or names[refant]
     logger.info("setting reference antenna to: %s" % referenceant)
 
     logger.info("Bad antennas: {0}".format(badants))
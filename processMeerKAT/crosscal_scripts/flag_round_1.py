@@ -6,56 +6,50 @@ import os
 
 import config_parser
 import bookkeeping
+import flagging
+import flag_stats
+import flag_versions
+import preflag
 # sys.path.append('/home/cchoza/pipelines/processMeerKAT/')
 from crosscal_scripts.config import CONFIG_PATH
 
+import casampi
+
 def do_pre_flag(visname, fields, badfreqranges, badants):
 
     clip = [0., 50.]
-
-    if badfreqranges!='[]':
-        badspw = '*:' + ',*:'.join(badfreqranges)
-        flagdata(vis=visname, mode='manual', spw=badspw)
-
-    if badants != '[]':
-        badants = badants.split("#")[0].strip(" ").strip("[").strip("]")
-        flagdata(vis=visname, mode='manual', antenna=badants)
-
-    flagdata(vis=visname, mode='manual', autocorr=True, action='apply',
-            flagbackup=True, savepars=False, writeflags=True)
+    flag_versions.save(visname, 'flag_round_1', comment='Before pre-flagging and tfcrop')
 
     #Manually clip all fields in config
     allfields = ','.join(set([i for i in (','.join([fields.gainfields] + [fields.targetfield] + [fields.extrafields]).split(',')) if i])) #remove duplicate and empty fields
 
-    flagdata(vis=visname, mode="clip", field=allfields,
-            clipminmax=clip, datacolumn="DATA",clipoutside=True,
-            clipzeros=True, extendpols=True, action="apply",flagbackup=True,
-            savepars=False, overwrite=True, writeflags=True)
-    
+    #Bad frequency ranges, bad antennas, autocorrelations, zeros and clipping don't need flagdata's agents
+    preflag.preflag(visname, badfreqranges=badfreqranges, badants=badants, fields=allfields, clip=clip)
+
+    cmds = []
+
     #tfcrop calfields and targetfield with different cutoffs / fits
     calfields = ','.join(set([i for i in (','.join([fields.gainfields] + [fields.extrafields]).split(',')) if i])) #remove duplicate and empty fields
 
-    flagdata(vis=visname, mode='tfcrop', field=calfields,
+    cmds.append(flagging.flag_cmd('tfcrop', field=calfields,
             ntime='scan', timecutoff=5.0, freqcutoff=5.0, timefit='line',
             freqfit='line', extendflags=False, timedevscale=5., freqdevscale=5.,
-            extendpols=True, growaround=False, action='apply', flagbackup=True,
-            overwrite=True, writeflags=True, datacolumn='DATA')
+            extendpols=True, growaround=False, datacolumn='DATA'))
 
-    flagdata(vis=visname, mode='tfcrop', field=fields.targetfield,
+    cmds.append(flagging.flag_cmd('tfcrop', field=fields.targetfield,
             ntime='scan', timecutoff=6.0, freqcutoff=6.0, timefit='poly',
             freqfit='poly', extendflags=False, timedevscale=5., freqdevscale=5.,
-            extendpols=True, growaround=False, action='apply', flagbackup=True,
-            overwrite=True, writeflags=True, datacolumn='DATA')
+            extendpols=True, growaround=False, datacolumn='DATA'))
 
     # Conservatively extend flags for all fields in config
-    flagdata(vis=visname, mode='extend', field=allfields,
+    cmds.append(flagging.flag_cmd('extend', field=allfields,
             datacolumn='data', clipzeros=True, ntime='scan', extendflags=False,
             extendpols=True, growtime=80., growfreq=80., growaround=False,
-            flagneartime=False, flagnearfreq=False, action='apply',
-            flagbackup=True, overwrite=True, writeflags=True)
+            flagneartime=False, flagnearfreq=False))
 
-    flagdata(vis=visname, mode='summary', datacolumn='DATA',
-            name=visname+'.flag.summary')
+    #One pass for tfcrop and one for extend, then summarise the flags for later steps
+    flagging.run_flag_cmds(visname, cmds)
+    flag_stats.compute(visname)
 
 
 
@@ -64,10 +58,13 @@ def do_pre_flag(visname, fields, badfreqranges, badants):
 taskvals,config = config_parser.parse_config(filename=CONFIG_PATH)
 visname = config['data']['vis'].strip("'")
 
+#Flag in parallel over scans, partitioning a plain MS into an MMS (and pointing the config to it)
+visname = flagging.partition_by_scan(visname, CONFIG_PATH)
+
 calfiles, caldir = bookkeeping.bookkeeping(visname)
 fields = bookkeeping.get_field_ids(config['fields'])
 
-badfreqranges = config['crosscal']['badfreqranges']
-badants = config['crosscal']['badants']
+badfreqranges = taskvals['crosscal']['badfreqranges']
+badants = taskvals['crosscal']['badants']
 
 do_pre_flag(visname, fields, badfreqranges, badants)
@@ -7,66 +7,60 @@ import os
 import config_parser
 from crosscal_scripts.config import CONFIG_PATH
 import bookkeeping
+import flagging
+import flag_stats
 
 from casatasks import *
 logfile=casalog.logfile()
+import casampi
 
-def do_pre_flag_2(visname, fields):
+def do_pre_flag_2(visname, fields, onthefly=False):
 
     calfields = ','.join(set([i for i in (','.join([fields.gainfields] + [fields.extrafields]).split(',')) if i])) #remove duplicate and empty fields
+    cmds = []
 
     # Flag using 'tfcrop' option for flux, phase cal and extra fields tight flagging
-    flagdata(vis=visname, mode="tfcrop", datacolumn="corrected",
+    cmds.append(flagging.flag_cmd("tfcrop", datacolumn="corrected",
             field=calfields, ntime="scan", timecutoff=6.0,
             freqcutoff=5.0, timefit="line", freqfit="line",
             flagdimension="freqtime", extendflags=False, timedevscale=5.0,
-            freqdevscale=5.0, extendpols=False, growaround=False,
-            action="apply", flagbackup=True, overwrite=True, writeflags=True)
+            freqdevscale=5.0, extendpols=False, growaround=False))
 
     # now flag using 'rflag' option  for flux, phase cal and extra fields tight flagging
-    flagdata(vis=visname, mode="rflag", datacolumn="corrected",
+    cmds.append(flagging.flag_cmd("rflag", datacolumn="corrected",
             field=calfields, timecutoff=5.0, freqcutoff=5.0,
             timefit="poly", freqfit="line", flagdimension="freqtime",
             extendflags=False, timedevscale=4.0, freqdevscale=4.0,
             spectralmax=500.0, extendpols=False, growaround=False,
-            flagneartime=False, flagnearfreq=False, action="apply",
-            flagbackup=True, overwrite=True, writeflags=True)
+            flagneartime=False, flagnearfreq=False))
 
     ## Now extend the flags (70% more means full flag, change if required)
-    flagdata(vis=visname, mode="extend", field=calfields,
+    cmds.append(flagging.flag_cmd("extend", field=calfields,
             datacolumn="corrected", clipzeros=True, ntime="scan",
             extendflags=False, extendpols=False, growtime=90.0, growfreq=90.0,
-            growaround=False, flagneartime=False, flagnearfreq=False,
-            action="apply", flagbackup=True, overwrite=True, writeflags=True)
+            growaround=False, flagneartime=False, flagnearfreq=False))
 
     # Now flag for target - moderate flagging, more flagging in self-cal cycles
-    flagdata(vis=visname, mode="tfcrop", datacolumn="corrected",
-            field=fields.targetfield, ntime="scan", timecutoff=6.0, freqcutoff=5.0,
-            timefit="poly", freqfit="line", flagdimension="freqtime",
-            extendflags=False, timedevscale=5.0, freqdevscale=5.0,
-            extendpols=False, growaround=False, action="apply", flagbackup=True,
-            overwrite=True, writeflags=True)
-
-    # now flag using 'rflag' option
-    flagdata(vis=visname, mode="rflag", datacolumn="corrected",
-            field=fields.targetfield, timecutoff=5.0, freqcutoff=5.0, timefit="poly",
-            freqfit="poly", flagdimension="freqtime", extendflags=False,
-            timedevscale=5.0, freqdevscale=5.0, spectralmax=500.0,
-            extendpols=False, growaround=False, flagneartime=False,
-            flagnearfreq=False, action="apply", flagbackup=True, overwrite=True,
-            writeflags=True)
+    # When calibration is applied on the fly during split, the targets have no CORRECTED_DATA, so are flagged after split
+    if not onthefly:
+        cmds.extend(flagging.target_flag_cmds(fields.targetfield, datacolumn="corrected"))
 
-    # Now summary
-    flagdata(vis=visname, mode="summary", datacolumn="corrected",
-            extendflags=True, name=visname + 'summary.split', action="apply",
-            flagbackup=True, overwrite=True, writeflags=True)
+    #One pass for tfcrop and rflag and one for extend, with a single flag backup, then summarise the flags for later steps
+    flagging.run_flag_cmds(visname, cmds, version='flag_round_2')
+    flag_stats.compute(visname)
 
 
 
 taskvals,config = config_parser.parse_config(filename=CONFIG_PATH)
 visname = config['data']['vis'].strip("'")
 
+#Flag in parallel over scans, partitioning a plain MS into an MMS (and pointing the config to it)
+visname = flagging.partition_by_scan(visname, CONFIG_PATH)
+
 calfiles, caldir = bookkeeping.bookkeeping(visname)
 fields = bookkeeping.get_field_ids(config['fields'])
 
-do_pre_flag_2(visname, fields)
+#On-the-fly calibration isn't used with polarisation calibration, which writes CORRECTED_DATA for the targets
+onthefly = taskvals['crosscal'].get('onthefly', False) and not taskvals['run']['dopol']
+
+do_pre_flag_2(visname, fields, onthefly)
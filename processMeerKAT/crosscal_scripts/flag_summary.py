@@ -0,0 +1,40 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+"""
+Summarises the flags of the input MS once, before the partition job array, so each partition job can drop flagged data
+without reading the FLAG column itself
+"""
+import os
+
+import config_parser
+from config_parser import validate_args as va
+import bookkeeping
+import flag_stats
+
+from casatasks import *
+logfile=casalog.logfile()
+casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_JOB_ID}.casa'.format(**os.environ))
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+def main(args,taskvals):
+
+    visname = va(taskvals, 'data', 'vis', str)
+    dropflagged = va(taskvals, 'crosscal', 'dropflagged', bool, default=False)
+    antflagthreshold = va(taskvals, 'crosscal', 'antflagthreshold', float, default=0)
+
+    if not dropflagged and antflagthreshold <= 0:
+        logger.info("Skipping flag summary, as 'dropflagged=False' and 'antflagthreshold=0' in '{0}'.".format(args['config']))
+    elif flag_stats.exists(visname):
+        logger.info("Using existing flag statistics '{0}'.".format(flag_stats.stats_file(visname)))
+    else:
+        flag_stats.compute(visname)
+
+if __name__ == '__main__':
+
+    bookkeeping.run_script(main,logfile)
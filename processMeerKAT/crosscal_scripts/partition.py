@@ -6,12 +6,16 @@ Runs partition on the input MS
 """
 import sys
 import os
+import numpy as np
 
 import config_parser
 from config_parser import validate_args as va
 import read_ms
 import pipelines.processMeerKAT.processATA as processATA
 import bookkeeping
+import rfi_masks
+import preflag
+import flag_stats
 
 from casatasks import *
 logfile=casalog.logfile()
@@ -19,7 +23,34 @@ from casatools import msmetadata
 import casampi
 msmd = msmetadata()
 
-def do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwname):
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Flagged fraction above which channels are treated as entirely flagged
+FULLY_FLAGGED = 0.999
+
+def flagged_ranges(stats):
+
+    """Return the entirely flagged channels of each SPW as contiguous ranges, in the format of an RFI mask (low MHz, high MHz,
+    contamination, description), padded by a quarter of a channel so the channel frequencies fall within them."""
+
+    ranges = []
+    for spw in range(stats.nspw):
+        freqs, fraction = stats.channel_fraction(spw)
+        if freqs.size == 0:
+            continue
+        pad = np.abs(np.median(np.diff(freqs))) / 4 if freqs.size > 1 else 0
+        flagged = np.nan_to_num(fraction, nan=1.0) >= FULLY_FLAGGED
+        edges = np.diff(np.concatenate([[0], flagged.astype(int), [0]]))
+        for lo,hi in zip(np.where(edges == 1)[0], np.where(edges == -1)[0]):
+            low, high = sorted([freqs[lo], freqs[hi-1]])
+            ranges.append(((low - pad) / 1e6, (high + pad) / 1e6, 'full', 'Entirely flagged'))
+    return ranges
+
+def do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwname, rfimask='', badants=[], dropflagged=False, antflagthreshold=0):
     # Get the .ms bit of the filename, case independent
     basename, ext = os.path.splitext(visname)
     filebase = os.path.split(basename)[1]
@@ -30,8 +61,42 @@ def do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwna
     chanaverage = True if preavg > 1 else False
     correlation = '' if include_crosshand else 'XX,YY'
 
+    #Don't write channels that are always contaminated by RFI
+    mask = rfi_masks.get_mask(rfimask, msmd)
+
+    #Don't write bad antennas, nor (optionally) mostly flagged antennas, or entirely flagged rows and channels
+    antids = list(preflag.resolve_ids(visname, 'ANTENNA', badants))
+
+    #The flag statistics are written once by flag_summary.py, before the partition job array
+    if (dropflagged or antflagthreshold > 0) and not flag_stats.exists(visname):
+        logger.warning("No flag statistics '{0}' (written by flag_summary.py), so not dropping flagged channels or antennas.".format(flag_stats.stats_file(visname)))
+    elif dropflagged or antflagthreshold > 0:
+        stats = flag_stats.load(visname)
+        if antflagthreshold > 0:
+            fraction = np.nan_to_num(stats.antenna_fraction(), nan=1.0)
+            for ant in np.where(fraction >= antflagthreshold)[0]:
+                if ant not in antids:
+                    logger.info("Dropping antenna '{0}', which is {1:.1f}% flagged.".format(stats.antnames[ant], 100*fraction[ant]))
+                    antids.append(int(ant))
+        if dropflagged:
+            mask = mask + flagged_ranges(stats)
+
+    spw = rfi_masks.masked_spw_selection(visname, spw, mask)
+
+    taql = ''
+    if len(antids) > 0:
+        ants = ','.join(map(str,sorted(antids)))
+        taql = 'ANTENNA1 NOT IN [{0}] && ANTENNA2 NOT IN [{0}]'.format(ants)
+        logger.info("Dropping the baselines of antenna IDs [{0}].".format(ants))
+
     mstransform(vis=visname, outputvis=mvis, spw=spw, createmms=createmms, datacolumn='DATA', chanaverage=chanaverage, chanbin=preavg,
-                numsubms=nscan, separationaxis='scan', keepflags=True, usewtspectrum=True, nthreads=CPUs, antenna='*&', correlation=correlation)
+                numsubms=nscan, separationaxis='scan', keepflags=not dropflagged, usewtspectrum=True, nthreads=CPUs, antenna='*&',
+                correlation=correlation, taql=taql)
+
+    #Flag channels that are sometimes contaminated, and fully contaminated channels within the selection, only touching the FLAG column
+    badfreqranges = rfi_masks.freqranges(mask, 'partial') + rfi_masks.freqranges(mask, 'full')
+    if len(badfreqranges) > 0:
+        preflag.preflag(mvis, badfreqranges=badfreqranges, clip=None, autocorr=False, zeros=False)
 
     return mvis
 
@@ -46,6 +111,10 @@ def main(args,taskvals):
     preavg = va(taskvals, 'crosscal', 'chanbin', int, default=1)
     include_crosshand = va(taskvals, 'run', 'dopol', bool, default=False)
     createmms = va(taskvals, 'crosscal', 'createmms', bool, default=True)
+    rfimask = va(taskvals, 'crosscal', 'rfimask', str, default='')
+    badants = taskvals['crosscal'].get('badants', [])
+    dropflagged = va(taskvals, 'crosscal', 'dropflagged', bool, default=False)
+    antflagthreshold = va(taskvals, 'crosscal', 'antflagthreshold', float, default=0)
 
     if nspw > 1:
         casalog.setlogfile('logs/{SLURM_JOB_NAME}-{SLURM_ARRAY_JOB_ID}_{SLURM_ARRAY_TASK_ID}.casa'.format(**os.environ))
@@ -66,7 +135,7 @@ def main(args,taskvals):
         npol = 2
     CPUs = npol if tasks*npol <= processATA.CPUS_PER_NODE_LIMIT else 1 #hard-code for number of polarisations
 
-    mvis = do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwname)
+    mvis = do_partition(visname, spw, preavg, CPUs, include_crosshand, createmms, spwname, rfimask, badants, dropflagged, antflagthreshold)
     mvis = "'{0}'".format(mvis)
     vis = "'{0}'".format(visname)
 
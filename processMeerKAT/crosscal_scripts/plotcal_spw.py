@@ -57,17 +57,23 @@ def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=Non
         raise ValueError("Invalid plotstr.")
 
 
-    tables = []
-    cwd = os.getcwd()
-    for dd in dirs:
-        tmpdir = os.path.join(dd, caldir)
-        if not os.path.exists(tmpdir):
-            logger.warning("Path {} not found. Skipping.".format(tmpdir))
-
-        os.chdir(tmpdir)
-        tmp = glob.glob("*.{}".format(table_ext))
-        tables.extend([os.path.join(tmpdir, tt) for tt in tmp if os.path.exists(tt)])
-        os.chdir(cwd)
+    #Prefer the merged (wideband) caltable from merge_caltables.py, reading one SPW at a time
+    merged, spws = bookkeeping.merged_caltable(caldir, table_ext)
+    if merged != '':
+        logger.info("Plotting merged caltable '{0}'.".format(merged))
+        tables = [(merged, spw) for spw in spws]
+    else:
+        tables = []
+        cwd = os.getcwd()
+        for dd in dirs:
+            tmpdir = os.path.join(dd, caldir)
+            if not os.path.exists(tmpdir):
+                logger.warning("Path {} not found. Skipping.".format(tmpdir))
+
+            os.chdir(tmpdir)
+            tmp = glob.glob("*.{}".format(table_ext))
+            tables.extend([(os.path.join(tmpdir, tt), None) for tt in tmp if os.path.exists(tt)])
+            os.chdir(cwd)
 
     if len(tables) == 0:
         logger.warning("No valid caltables with extention {} found.".format(table_ext))
@@ -86,27 +92,31 @@ def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=Non
     field = 0
 
 
-    for tt in tables:
+    for tt,spw in tables:
         tb.open(tt+'/ANTENNA')
         ant_name = tb.getcol('NAME')
         tb.close()
 
         nant = ant_name.size
 
+        if 'freq' in xstr.lower():
+            tb.open(tt+'/SPECTRAL_WINDOW')
+            if spw is None:
+                chanfreq = np.squeeze(tb.getcol('CHAN_FREQ'))/1E6
+            else:
+                chanfreq = tb.getcell('CHAN_FREQ', spw)/1E6
+            tb.close()
+
         tb.open(tt)
-        field = tb.getcol('FIELD_ID')
+        sel = tb if spw is None else tb.query('SPECTRAL_WINDOW_ID=={0}'.format(spw))
+        field = sel.getcol('FIELD_ID')
         if np.unique(field).size == 1:
             do_field_sel = False
         else:
             do_field_sel = True
             fields.append(field)
 
-        tb.close()
-
         if 'freq' in xstr.lower():
-            tb.open(tt+'/SPECTRAL_WINDOW')
-            chanfreq = np.squeeze(tb.getcol('CHAN_FREQ'))/1E6
-            tb.close()
             xlabel = 'Frequency (MHz)'
 
             if 'delay' in ystr.lower():
@@ -115,15 +125,13 @@ def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=Non
                 xdat.extend(chanfreq)
 
         elif 'time' in xstr.lower():
-            tb.open(tt)
-            time = np.squeeze(tb.getcol('TIME'))
+            time = np.squeeze(sel.getcol('TIME'))
             xdat = lengthen(xdat, time)
 
             xlabel = 'Time'
 
         elif 'real' in xstr.lower():
-            tb.open(tt)
-            real = np.squeeze(tb.getcol('CPARAM')).real
+            real = np.squeeze(sel.getcol('CPARAM')).real
             xdat = lengthen(xdat, real[0])
             xdaty = lengthen(xdaty, real[1])
             #xdat.extend(real[0])
@@ -133,11 +141,10 @@ def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=Non
             # This should never happen
             raise ValueError("Unknown option {}.".format(xstr.lower()))
 
-        tb.open(tt)
         if 'delay' in ystr.lower():
-            dat = np.squeeze(tb.getcol('FPARAM'))
+            dat = np.squeeze(sel.getcol('FPARAM'))
         else:
-            dat = np.squeeze(tb.getcol('CPARAM'))
+            dat = np.squeeze(sel.getcol('CPARAM'))
 
         if len(dat.shape) == 1:
             npol = 1
@@ -151,6 +158,8 @@ def plotcal(plotstr, field_id, dirs, caldir, table_ext, title, outname, xlim=Non
             datx = dat[0]
             daty = dat[-1]
 
+        if spw is not None:
+            sel.close()
         tb.close()
 
 
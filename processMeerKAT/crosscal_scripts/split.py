@@ -3,9 +3,14 @@
 
 import sys
 import os
+import shutil
+import numpy as np
+
+from multiprocessing import Pool
 
 import config_parser
 import bookkeeping
+import flagging
 from config_parser import validate_args as va
 
 from casatasks import *
@@ -15,13 +20,114 @@ from casatools import msmetadata
 import casampi
 msmd = msmetadata()
 
-def split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants):
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Rotation rate of the Earth (rad/s)
+OMEGA_EARTH = 7.2921e-5
+
+#Multiples of timeavg over which shorter baselines are averaged with baseline-dependent averaging
+BDA_FACTORS = [1, 2, 4, 8, 16]
+
+def bda_groups(visname, timeavg, tolerance):
+
+    """Return the baselines to average for longer times, so that time smearing stays within a tolerance.
+
+    Averaging for a time t reduces the amplitude of a source at the edge of the field of view by approximately (pi f t)^2 / 6,
+    for a fringe rate f = OMEGA_EARTH * (baseline length / lambda_min) * (lambda_max / dish diameter). Each baseline is assigned
+    as a whole to a group by its physical length (an upper limit on its uv distance), so all of its rows share one averaging
+    time. The averaging time of each group is the longest multiple of timeavg (from BDA_FACTORS) within the tolerance, and never
+    less than timeavg.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS, from which the antenna positions are read.
+    timeavg : str
+        Averaging time of the longest baselines (e.g. '8s'). Use '' or '0s' for the integration time of the MS.
+    tolerance : float
+        Maximum fractional amplitude loss due to time smearing at the edge of the field of view.
+
+    Returns:
+    --------
+    groups : list
+        List of (taql, factor), from the longest to the shortest baselines, where taql selects the baselines of the group and
+        factor is its multiple of timeavg. Groups without any baselines are excluded.
+    t0 : float
+        Averaging time (s) of the longest baselines."""
+
+    from casatools import quanta, table
+    qa = quanta()
+    tb = table()
+
+    if timeavg in ['', '0s']:
+        t0 = msmd.exposuretime(scan=int(msmd.scannumbers()[0]))['value']
+    else:
+        t0 = qa.convert(qa.quantity(timeavg), 's')['value']
+
+    freqs = np.concatenate([msmd.chanfreqs(spw) for spw in range(msmd.nspw())])
+    wavelengths = 299792458.0 / np.array([freqs.max(), freqs.min()])
+
+    tb.open(os.path.join(visname, 'ANTENNA'))
+    positions = tb.getcol('POSITION')
+    diameter = np.min(tb.getcol('DISH_DIAMETER'))
+    tb.close()
+    nant = positions.shape[1]
+    ant1, ant2 = np.triu_indices(nant)
+    lengths = np.linalg.norm(positions[:,ant1] - positions[:,ant2], axis=0)
+
+    #Longest uv distance (m) that can be averaged for a time t within the tolerance
+    maxuv = lambda t : np.sqrt(6 * tolerance) * wavelengths[0] * diameter / (np.pi * OMEGA_EARTH * t * wavelengths[1])
+
+    groups = []
+    for i,factor in enumerate(BDA_FACTORS):
+        upper = maxuv(factor * t0) if i > 0 else np.inf
+        lower = maxuv(BDA_FACTORS[i+1] * t0) if i < len(BDA_FACTORS) - 1 else -1
+        baselines = (lengths > lower) & (lengths <= upper)
+        if np.any(baselines):
+            ids = ','.join(map(str, ant1[baselines] * nant + ant2[baselines]))
+            taql = 'ANTENNA1*{0}+ANTENNA2 IN [{1}] || ANTENNA2*{0}+ANTENNA1 IN [{1}]'.format(nant, ids)
+            groups.append((taql, factor))
+            logger.info('Baseline-dependent averaging with tolerance {0}: {1} baselines of {2:.1f}~{3:.1f} m over {4}s.'.format(tolerance,
+                        np.count_nonzero(baselines), lengths[baselines].min(), lengths[baselines].max(), factor * t0))
+
+    return groups, t0
+
+def split_field(task, kwargs):
+
+    import casatasks
+    getattr(casatasks, task)(**kwargs)
+    return kwargs['outputvis']
+
+def run_jobs(visname, jobs, nproc=0):
+
+    """Run a list of (task, kwargs) in parallel. Each process only reads the rows of its own output. Under casampi, each task
+    already runs in parallel over the sub-MSs."""
+
+    nproc = min(len(jobs), nproc if nproc > 0 else len(os.sched_getaffinity(0)))
+    if nproc > 1 and not flagging.mpi_enabled():
+        logger.info('Splitting {0} outputs from "{1}" with {2} processes.'.format(len(jobs),visname,nproc))
+        with Pool(processes=nproc) as pool:
+            pool.starmap(split_field, jobs)
+    else:
+        for task,kwargs in jobs:
+            split_field(task, kwargs)
+
+def split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants, callib='', nproc=0, bdatolerance=0):
 
     outputbase = os.path.splitext(os.path.split(visname)[1])[0]
     extn = 'mms' if keepmms else 'ms'
     newvis = visname
     antenna = '!{0}'.format(','.join(map(str,badants))) if len(badants) > 0 else ''
+    targets = [msmd.namesforfields(int(f))[0] if f.isdigit() else f for f in fields.targetfield.split(',') if f != '']
 
+    #Build the inputs of every output first, so the fields can be split at once
+    jobs = []
+    bda = {}
+    newtargets = []
     for field in fields:
         if field != '':
             for fname in field.split(','):
@@ -29,15 +135,65 @@ def split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants):
                     fname = msmd.namesforfields(int(fname))[0]
 
                 outname = '%s.%s.%s' % (outputbase, fname, extn)
-                if not os.path.exists(outname):
-
-                    split(vis=visname, outputvis=outname, datacolumn='corrected',
-                                field=fname, spw=spw, keepflags=True, keepmms=keepmms,
-                                width=specavg, timebin=timeavg, antenna=antenna)
+                if not os.path.exists(outname) and outname not in [kwargs['outputvis'] for task,kwargs in jobs] + list(bda.keys()):
+                    if fname in targets:
+                        newtargets.append(outname)
+
+                    if bdatolerance > 0 and fname in targets:
+                        #Split (and calibrate) once over timeavg, then average groups of baselines further from this smaller output
+                        tmpname = '%s.%s.bda.%s' % (outputbase, fname, extn)
+                        kwargs = dict(vis=visname, outputvis=tmpname, datacolumn='corrected', field=fname, spw=spw,
+                                      keepflags=True, createmms=keepmms, chanaverage=specavg > 1, chanbin=specavg,
+                                      timeaverage=timeavg not in ['', '0s'], timebin=timeavg, antenna=antenna)
+                        if callib != '':
+                            kwargs.update(docallib=True, callib=callib)
+                        jobs.append(('mstransform', kwargs))
+                        bda[outname] = tmpname
+
+                    elif callib != '':
+                        #Apply calibration on the fly while averaging, rather than reading CORRECTED_DATA
+                        jobs.append(('mstransform', dict(vis=visname, outputvis=outname, datacolumn='corrected', docallib=True, callib=callib,
+                                    field=fname, spw=spw, keepflags=True, createmms=keepmms, chanaverage=specavg > 1,
+                                    chanbin=specavg, timeaverage=timeavg not in ['', '0s'], timebin=timeavg, antenna=antenna)))
+                    else:
+                        jobs.append(('split', dict(vis=visname, outputvis=outname, datacolumn='corrected',
+                                    field=fname, spw=spw, keepflags=True, keepmms=keepmms,
+                                    width=specavg, timebin=timeavg, antenna=antenna)))
 
                 if fname == fields.targetfield.split(',')[0]:
                     newvis = outname
 
+    run_jobs(visname, jobs, nproc)
+
+    #Outputs with baseline-dependent averaging have variable integration times per baseline
+    jobs = []
+    parts = {}
+    for outname,tmpname in bda.items():
+        parts[outname] = []
+        groups, t0 = bda_groups(tmpname, timeavg, bdatolerance)
+        for i,(taql,factor) in enumerate(groups):
+            partname = '%s.bda%d.%s' % (os.path.splitext(outname)[0], i, extn)
+            jobs.append(('mstransform', dict(vis=tmpname, outputvis=partname, datacolumn='data', taql=taql, keepflags=True,
+                                             createmms=keepmms, timeaverage=factor > 1, timebin='{0}s'.format(factor * t0))))
+            parts[outname].append(partname)
+    run_jobs(visname, jobs, nproc)
+
+    for outname,tmpname in bda.items():
+        outparts = [part for part in parts[outname] if os.path.exists(part)]
+        logger.info('Concatenating {0} baseline-dependent averaged parts into "{1}".'.format(len(outparts),outname))
+        if keepmms:
+            virtualconcat(vis=outparts, concatvis=outname, keepcopy=False)
+        else:
+            concat(vis=outparts, concatvis=outname, timesort=True)
+            for part in outparts:
+                shutil.rmtree(part)
+        shutil.rmtree(tmpname)
+
+    #With calibration applied on the fly, flag_round_2 doesn't flag the targets, so flag their calibrated outputs instead
+    if callib != '':
+        for outname in newtargets:
+            flagging.run_flag_cmds(outname, flagging.target_flag_cmds('', datacolumn='data'), version='flag_round_2_target')
+
     return newvis
 
 def main(args,taskvals):
@@ -53,9 +209,16 @@ def main(args,taskvals):
     specavg = va(taskvals, 'crosscal', 'width', int, default=1)
     timeavg = va(taskvals, 'crosscal', 'timeavg', str, default='8s')
     keepmms = va(taskvals, 'crosscal', 'keepmms', bool)
+    onthefly = va(taskvals, 'crosscal', 'onthefly', bool, default=False) and not va(taskvals, 'run', 'dopol', bool, default=False)
+    bdatolerance = va(taskvals, 'crosscal', 'bdatolerance', float, default=0)
+
+    #The cal library is removed once the polarisation calibration (which needs CORRECTED_DATA) is applied
+    callib = bookkeeping.callib_file(visname, caldir)
+    if not onthefly or not os.path.exists(callib):
+        callib = ''
 
     msmd.open(visname)
-    newvis = split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants)
+    newvis = split_vis(visname, spw, fields, specavg, timeavg, keepmms, badants, callib, bdatolerance=bdatolerance)
 
     config_parser.overwrite_config(args['config'], conf_dict={'vis' : "'{0}'".format(newvis)}, conf_sec='data')
     config_parser.overwrite_config(args['config'], conf_dict={'crosscal_vis': "'{0}'".format(visname)}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
@@ -17,26 +17,36 @@ logging.Formatter.converter = gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
-def do_parallel_cal_apply(visname, fields, calfiles):
+def do_parallel_cal_apply(visname, fields, calfiles, caldir, onthefly=False, incremental=False):
 
-    if len(fields.gainfields.split(',')) > 1:
-        fluxfile = calfiles.fluxfile
-    else:
-        fluxfile = calfiles.gainfile
+    plan = bookkeeping.apply_plan(visname, fields, calfiles, caldir)
+    callib = bookkeeping.callib_file(visname, caldir)
+    bookkeeping.write_callib(plan, callib)
 
-    logger.info(" applying calibration -> primary calibrator")
-    applycal(vis=visname, field=fields.fluxfield,
-            selectdata=False, calwt=False, gaintable=[calfiles.kcorrfile, calfiles.bpassfile, fluxfile],
-            gainfield=[fields.kcorrfield, fields.bpassfield, fields.fluxfield], parang=False, interp='linear,linearflag')
+    #Split can apply the cal library on the fly, so only write CORRECTED_DATA for calibrators (e.g. for flag_round_2)
+    field = bookkeeping.unique_fields([entry.field for entry in plan])
+    if onthefly:
+        field = bookkeeping.without_targets(field, fields)
 
-    logger.info(" applying calibration -> phase calibrator, targets and extra fields")
-    field = ','.join(set([i for i in (','.join([fields.secondaryfield] + [fields.targetfield] + [fields.extrafields]).split(',')) if i])) #remove duplicate and empty fields
-    applycal(vis=visname, field=field, selectdata=False, calwt=False, gaintable=[calfiles.kcorrfile, calfiles.bpassfile, fluxfile],
-            gainfield=[fields.kcorrfield, fields.bpassfield, fields.secondaryfield], parang=False, interp='linear,linearflag')
+    #In incremental mode, only apply to scans that haven't been calibrated yet
+    scan = ''
+    if incremental:
+        state = bookkeeping.load_incremental(visname, caldir)
+        scans = bookkeeping.field_scans(visname, field)
+        new = [s for s in scans if s not in state.get('applied_scans', [])]
+        if len(new) == 0:
+            logger.info(" no new scans to apply calibration to")
+            return
+        scan = ','.join(map(str,new))
+        logger.info(" applying calibration incrementally to new scans {0}".format(scan))
 
-    if fields.xpolfield != '':
-        applycal(vis=visname, field=fields.xpolfield, selectdata=False, calwt=False, gaintable=[calfiles.kcorrfile, calfiles.bpassfile, fluxfile],
-            gainfield=[fields.kcorrfield, fields.bpassfield, fields.secondaryfield], parang=False, interp='linear,linearflag')
+    #One pass over all fields, with the per-field tables and interpolation encoded in the cal library
+    logger.info(" applying calibration -> {0}".format(', '.join([entry.name for entry in plan])))
+    applycal(vis=visname, field=field, selectdata=scan != '', scan=scan, docallib=True, callib=callib, parang=False)
+
+    if incremental:
+        state['applied_scans'] = scans
+        bookkeeping.save_incremental(visname, caldir, state)
 
 #################### RUN IT DOWN HERE ########################
 
@@ -50,5 +60,9 @@ print(fields)
 minbaselines = taskvals['crosscal']['minbaselines']
 refant = taskvals['crosscal']['refant']
 
-do_parallel_cal_apply(visname, fields, calfiles)
+onthefly = taskvals['crosscal'].get('onthefly', False) and not taskvals['run']['dopol']
+
+incremental = taskvals['crosscal'].get('incremental', False)
+
+do_parallel_cal_apply(visname, fields, calfiles, caldir, onthefly, incremental)
 
@@ -7,6 +7,8 @@ import shutil
 
 import config_parser
 import bookkeeping
+import calvis
+import cal_qa
 
 from casatasks import *
 logfile=casalog.logfile()
@@ -18,49 +20,102 @@ logging.Formatter.converter = gmtime
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
 
+#Solves in order, each depending on the tables before it
+STEPS = ['kcal', 'bcal', 'gcal']
+
+def rotate_caldir(caldir, incremental=False):
+
+    #Keep the first round of solutions, once, before the second round is solved
+    if os.path.isdir(caldir) and not incremental and not os.path.isdir(caldir+'_round1'):
+        os.rename(caldir,caldir+'_round1')
+        os.makedirs(caldir)
+
 def do_parallel_cal(visname, fields, calfiles, referenceant, caldir,
-        minbaselines, standard):
+        minbaselines, standard, solvevis='', gainvis='', incremental=False, nchunks=1, first_step='kcal', resolve=False):
+
+    #Solves may use a calibrator-only dataset, and gain solves a channel-averaged one
+    if solvevis == '':
+        solvevis = visname
+    if gainvis == '':
+        gainvis = solvevis
 
     if not os.path.isdir(caldir):
         os.makedirs(caldir)
-    elif not os.path.isdir(caldir+'_round1'):
-        os.rename(caldir,caldir+'_round1')
-        os.makedirs(caldir)
 
-    logger.info(" starting antenna-based delay (kcorr)\n -> %s" % calfiles.kcorrfile)
-    gaincal(vis=visname, caltable = calfiles.kcorrfile, field
-            = fields.kcorrfield, refant = referenceant,
-            minblperant = minbaselines, solnorm = False,  gaintype = 'K',
-            solint = 'inf', combine = '', parang = False, append = False)
-    bookkeeping.check_file(calfiles.kcorrfile)
-
-    logger.info(" starting bandpass -> %s" % calfiles.bpassfile)
-    bandpass(vis=visname, caltable = calfiles.bpassfile,
-            field = fields.bpassfield, refant = referenceant,
-            minblperant = minbaselines, solnorm = False,  solint = 'inf',
-            combine = 'scan', bandtype = 'B', fillgaps = 8,
-            gaintable = calfiles.kcorrfile, gainfield = fields.kcorrfield,
-            parang = False, append = False)
-    bookkeeping.check_file(calfiles.bpassfile)
-
-    logger.info(" starting gain calibration\n -> %s" % calfiles.gainfile)
-    gaincal(vis=visname, caltable = calfiles.gainfile,
-            field = fields.gainfields, refant = referenceant,
-            minblperant = minbaselines, solnorm = False,  gaintype = 'G',
-            solint = 'inf', combine = '', calmode='ap',
-            gaintable=[calfiles.kcorrfile, calfiles.bpassfile],
-            gainfield=[fields.kcorrfield, fields.bpassfield],
-            parang = False, append = False)
-    bookkeeping.check_file(calfiles.gainfile)
-
-    # Only run fluxscale if bootstrapping
+    for vis in set([solvevis, gainvis]):
+        bookkeeping.check_model(vis, fields.fluxfield.split(',')[0])
+
+    #In incremental mode, only solve delays and gains for new scans (appending to the existing tables), and reuse the
+    #bandpass, as long as the bandpass scans and flagging round are unchanged
+    append = False
+    if incremental:
+        state = bookkeeping.load_incremental(visname, caldir)
+        flagversion = bookkeeping.latest_flag_version(visname)
+        bpass_scans = bookkeeping.field_scans(visname, fields.bpassfield)
+        kcorr_scans = bookkeeping.field_scans(visname, fields.kcorrfield)
+        gain_scans = bookkeeping.field_scans(visname, fields.gainfields)
+
+        #A re-solve after flagging bad antennas always solves for all scans
+        if (not resolve and state.get('flagversion') == flagversion and state.get('bpass_scans') == bpass_scans and
+                all([os.path.exists(table) for table in [calfiles.kcorrfile, calfiles.bpassfile, calfiles.gainfile]])):
+            append = True
+            kcorr_new = [scan for scan in kcorr_scans if scan not in state['kcorr_scans']]
+            gain_new = [scan for scan in gain_scans if scan not in state['gain_scans']]
+            if len(kcorr_new) == 0 and len(gain_new) == 0:
+                logger.info("No new scans to solve for. Keeping existing solutions in '{0}'.".format(caldir))
+                return
+            logger.info("Solving incrementally for new scans {0}, reusing bandpass '{1}'.".format(sorted(set(kcorr_new + gain_new)), calfiles.bpassfile))
+        else:
+            logger.info("Solving for all scans, since there are no previous solutions, or the bandpass scans or flags have changed.")
+            state = {'applied_scans' : []}
+
+        state.update({'flagversion' : flagversion, 'bpass_scans' : bpass_scans, 'kcorr_scans' : kcorr_scans, 'gain_scans' : gain_scans})
+
+    #Re-solves start from first_step, keeping the existing tables before it
+    if (not append or len(kcorr_new) > 0) and first_step == 'kcal':
+        selection = {'scan' : ','.join(map(str,kcorr_new))} if append else {}
+        logger.info(" starting antenna-based delay (kcorr)\n -> %s" % calfiles.kcorrfile)
+        bookkeeping.cached_solve('gaincal', vis=solvevis, caltable = calfiles.kcorrfile, field
+                = fields.kcorrfield, refant = referenceant,
+                minblperant = minbaselines, solnorm = False,  gaintype = 'K',
+                solint = 'inf', combine = '', parang = False, append = append, **selection)
+        bookkeeping.check_file(calfiles.kcorrfile)
+
+    if not append and first_step in ['kcal', 'bcal']:
+        logger.info(" starting bandpass -> %s" % calfiles.bpassfile)
+        bookkeeping.cached_solve('bandpass', nchunks, vis=solvevis, caltable = calfiles.bpassfile,
+                field = fields.bpassfield, refant = referenceant,
+                minblperant = minbaselines, solnorm = False,  solint = 'inf',
+                combine = 'scan', bandtype = 'B', fillgaps = 8,
+                gaintable = calfiles.kcorrfile, gainfield = fields.kcorrfield,
+                parang = False, append = False)
+        bookkeeping.check_file(calfiles.bpassfile)
+
+    if not append or len(gain_new) > 0:
+        selection = {'scan' : ','.join(map(str,gain_new))} if append else {}
+        logger.info(" starting gain calibration\n -> %s" % calfiles.gainfile)
+        bookkeeping.cached_solve('gaincal', vis=gainvis, caltable = calfiles.gainfile,
+                field = fields.gainfields, refant = referenceant,
+                minblperant = minbaselines, solnorm = False,  gaintype = 'G',
+                solint = 'inf', combine = '', calmode='ap',
+                gaintable=[calfiles.kcorrfile, calfiles.bpassfile],
+                gainfield=[fields.kcorrfield, fields.bpassfield],
+                parang = False, append = append, **selection)
+        bookkeeping.check_file(calfiles.gainfile)
+
+    # Only run fluxscale if bootstrapping. This only reads the gain table, so is rerun over all scans in incremental mode
     if len(fields.gainfields.split(',')) > 1:
-        fluxscale(vis=visname, caltable=calfiles.gainfile,
+        if os.path.exists(calfiles.fluxfile):
+            rmtables(calfiles.fluxfile)
+        fluxscale(vis=gainvis, caltable=calfiles.gainfile,
                 reference=[fields.fluxfield], transfer='',
                 fluxtable=calfiles.fluxfile, append=False, display=False,
                 listfile = os.path.join(caldir,'fluxscale_xx_yy.txt'))
         bookkeeping.check_file(calfiles.fluxfile)
 
+    if incremental:
+        bookkeeping.save_incremental(visname, caldir, state)
+
 ################### RUN IT DOWN HERE ###################
 
 taskvals,config = config_parser.parse_config(filename=CONFIG_PATH)
@@ -73,4 +128,26 @@ minbaselines = taskvals['crosscal']['minbaselines']
 standard = taskvals['crosscal']['standard']
 refant = taskvals['crosscal']['refant']
 
-do_parallel_cal(visname, fields, calfiles, f"'{refant}'", caldir, minbaselines, standard)
+#Optionally solve against a compact, time-averaged dataset of the calibrators, and apply back to the full MS
+solvevis, gainvis = calvis.calibrator_vis(visname, fields, taskvals['crosscal'].get('solvetimebin', ''),
+        taskvals['crosscal'].get('solvechanbin', 1), spw=taskvals['crosscal']['spw'], standard=standard,
+        dopol=taskvals['run']['dopol'], usescratch=taskvals['crosscal'].get('usescratch', False))
+
+incremental = taskvals['crosscal'].get('incremental', False)
+nchunks = taskvals['crosscal'].get('solvechunks', 1)
+
+rotate_caldir(caldir, incremental)
+do_parallel_cal(visname, fields, calfiles, f"'{refant}'", caldir, minbaselines, standard, solvevis, gainvis, incremental, nchunks)
+
+#Flag antennas with outlying solutions and re-solve once, from the first affected table
+nsigma = taskvals['crosscal'].get('calqa', 0)
+if nsigma > 0:
+    tables = [calfiles.kcorrfile, calfiles.bpassfile, calfiles.gainfile]
+    bad = cal_qa.check_tables(tables, nsigma, refant)
+    if len(bad) > 0:
+        vislist = set([visname, solvevis, gainvis])
+        cal_qa.flag_antennas(vislist, set([ant for reasons in bad.values() for ant in reasons]))
+
+        first_step = STEPS[min([tables.index(table) for table in bad])]
+        logger.info("Re-solving from '{0}' after flagging bad antennas.".format(first_step))
+        do_parallel_cal(visname, fields, calfiles, f"'{refant}'", caldir, minbaselines, standard, solvevis, gainvis, incremental, nchunks, first_step, resolve=True)
@@ -21,47 +21,21 @@ logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=lo
 
 def do_cross_cal_apply(visname, fields, calfiles, caldir):
 
-    if len(fields.gainfields.split(',')) > 1:
-        fluxfile = calfiles.fluxfile
-    else:
-        fluxfile = calfiles.gainfile
-
-    polfield = bookkeeping.polfield_name(visname)
-    if polfield == '':
-        polfield = fields.secondaryfield
-
-    base = visname.replace('.ms', '')
-    xy0ambpfile = os.path.join(caldir, base+'.xyambcal')
-    xy0pfile    = os.path.join(caldir, base+'.xycal')
-
-    #if polfield == fields.secondaryfield:
-    #    # Cannot resolve XY ambiguity so write into final file directly
-    #    xyfile = xy0ambpfile
-
-    xyfile = xy0pfile
-
-    calfiles = calfiles._replace(xpolfile=xyfile)
-
-    logger.info(" applying calibration: primary calibrator")
-    applycal(vis=visname, field=fields.fluxfield,
-            selectdata=False, calwt=False, gaintable=[calfiles.bpassfile, fluxfile, calfiles.dpolfile,calfiles.xpolfile],
-            gainfield=[fields.bpassfield, fields.fluxfield, fields.bpassfield, polfield],
-            parang=True, interp='nearest,linearflag,nearest,nearest')
-
-    if polfield != fields.secondaryfield:
-        logger.info(" applying calibration: polarization calibrator")
-        print("This is the fluxfield: ", fluxfile, ", and this is the polfield: ", polfield)
-        applycal(vis=visname, field=polfield,
-                selectdata=False, calwt=False, gaintable=[calfiles.bpassfile, fluxfile, calfiles.dpolfile,calfiles.xpolfile],
-                gainfield=[fields.bpassfield, polfield, fields.bpassfield, polfield],
-                parang=True, interp='nearest,linearflag,nearest,nearest')
-
-    logger.info(" applying calibrations: phase calibrator, targets and extra fields")
-    field = ','.join(set([i for i in (','.join([fields.secondaryfield] + [fields.targetfield] + [fields.extrafields]).split(',')) if i])) #remove duplicate and empty fields
-    applycal(vis=visname, field=field, selectdata=False, calwt=False,
-            gaintable=[calfiles.bpassfile, fluxfile, calfiles.dpolfile, calfiles.xpolfile],
-            gainfield=[fields.bpassfield,fields.secondaryfield,fields.bpassfield,polfield],
-            parang=True, interp='nearest,nearest,nearest,nearest')
+    plan = bookkeeping.apply_plan(visname, fields, calfiles, caldir, dopol=True)
+
+    #Parallactic angle correction can't be applied on the fly, so split must read CORRECTED_DATA
+    callib = bookkeeping.callib_file(visname, caldir)
+    if os.path.exists(callib):
+        logger.info("Removing cal library '{0}', since the polarisation calibration is applied to CORRECTED_DATA.".format(callib))
+        os.remove(callib)
+
+    #One pass over all fields, with the per-field tables and interpolation encoded in the cal library
+    polcallib = bookkeeping.callib_file(visname, caldir, 'pol')
+    bookkeeping.write_callib(plan, polcallib)
+
+    logger.info(" applying calibration: {0}".format(', '.join([entry.name for entry in plan])))
+    applycal(vis=visname, field=bookkeeping.unique_fields([entry.field for entry in plan]), selectdata=False,
+            docallib=True, callib=polcallib, parang=True)
 
 
 ################### RUN IT DOWN HERE ###################
@@ -7,6 +7,8 @@ import shutil
 
 import config_parser
 import bookkeeping
+import calvis
+import cal_models
 from crosscal_scripts.config import CONFIG_PATH
 from casarecipes.almapolhelpers import xyamb
 import numpy as np
@@ -24,60 +26,33 @@ logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=lo
 
 def qu_polfield(polfield, visname):
     """
-    Given the pol source name and the reference frequency, returns the fractional Q and U
-    calculated from Perley & Butler 2013
+    Given the pol source name, returns the fractional Q and U averaged over the channels of
+    every SPW, from the models in cal_models (Perley & Butler 2013)
     """
 
-    msmd.open(visname)
-    meanfreq = msmd.meanfreq(0, unit='GHz')
-    msmd.done()
-
-    if polfield in ["3c286", "1328+307", "1331+305", "J1331+3030"]:
-        #f_coeff=[1.2515,-0.4605,-0.1715,0.0336]    # coefficients for model Stokes I spectrum from Perley and Butler 2013
-        perley_frac = np.array([0.086, 0.098, 0.101, 0.106, 0.112, 0.115, 0.119, 0.121, 0.123])
-        perley_f = np.array([1.02, 1.47, 1.87, 2.57, 3.57, 4.89, 6.68, 8.43, 11.3])
-        pa_polcal = np.array([33.0]*8 + [34.0])
-    elif polfield in ["3C138", "0518+165", "0521+166", "J0521+1638"]:
-        #f_coeff=[1.0332,-0.5608,-0.1197,0.041]    # coefficients for model Stokes I spectrum from Perley and Butler 2013
-        perley_frac = np.array([0.056,0.075,0.084,0.09,0.104,0.107,0.10])
-        perley_f = np.array([1050,1450,1640,1950,2450,2950,3250])
-        pa_polcal = np.array([-14.0,-11.0,-10.0,-10.0,-10.0,-10.0,-10.0])
-    elif polfield in ["3c48", "0134+329", "0137+331", "J0137+3309"]:
-        perley_frac = np.array([0.003, 0.005, 0.007])
-        perley_f = np.array([1050,1450,1640])
-        pa_polcal = np.array([25, 140, -5])
-    elif polfield == "J1130-1449": #Manual model from Russ Taylor, taken from MeerKAT polarisation calibrator project
-        perley_frac = np.array([0.038, 0.050, 0.056])
-        perley_f = np.array([1050, 1450, 1640])
-        pa_polcal = np.array([145, 66, 45])
-    else:
+    source = cal_models.source_name(polfield)
+    if source not in cal_models.POLARISATION:
         # This should never happen.
         raise ValueError("Invalid polarization field. Exiting.")
 
-    p = np.polyfit(perley_f, perley_frac, deg=2)
-    p = np.poly1d(p)
-
-    pa = np.polyfit(perley_f, pa_polcal, deg=2)
-    pa = np.poly1d(pa)
-
-    #polpoly = np.poly1d(polcoeffs)
-    #polval = polpoly(meanfreq)
-
-    # BEWARE: Stokes I coeffs are in log-log space, so care must be taken while converting to linear.
-    # They are in np.log10 space, not np.log space!
-    # Coefficients are from Perley-Butler 2013 (An Accurate Flux Density Scale from 1 to 50 GHz)
-    #stokesIpoly = np.poly1d(stokesIcoeffs)
-    #stokesIval = stokesIpoly(np.log10(meanfreq))
-    ## in Jy
-    #stokesIval = np.power(10, stokesIval)
+    msmd.open(visname)
+    freqs = np.concatenate([msmd.chanfreqs(spw) for spw in range(msmd.nspw())]) / 1e9
+    msmd.done()
 
-    q = p(meanfreq) * np.cos(2*np.deg2rad(pa(meanfreq)))
-    u = p(meanfreq) * np.sin(2*np.deg2rad(pa(meanfreq)))
+    I, Q, U = cal_models.stokes_spectra(source, freqs)
+    q = np.mean(Q / I)
+    u = np.mean(U / I)
 
     return q, u
 
 def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
-        minbaselines, standard):
+        minbaselines, standard, solvevis='', gainvis='', nchunks=1):
+
+    #Solves may use a calibrator-only dataset, and gain solves a channel-averaged one
+    if solvevis == '':
+        solvevis = visname
+    if gainvis == '':
+        gainvis = solvevis
 
     polfield = bookkeeping.polfield_name(visname)
     print(fields)
@@ -87,6 +62,9 @@ def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
     else:
         polqu = qu_polfield(polfield, visname)
 
+    for vis in set([solvevis, gainvis]):
+        bookkeeping.check_model(vis, fields.fluxfield.split(',')[0])
+
     if not os.path.isdir(caldir):
         os.makedirs(caldir)
     elif not os.path.isdir(caldir+'_round1'):
@@ -102,7 +80,7 @@ def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
 
 
     logger.info(" starting bandpass -> %s" % calfiles.bpassfile)
-    bandpass(vis=visname, caltable = calfiles.bpassfile,
+    bookkeeping.cached_solve('bandpass', nchunks, vis=solvevis, caltable = calfiles.bpassfile,
             field = fields.bpassfield, refant = referenceant,
             minblperant = minbaselines, solnorm = False,  solint = '10min',
             combine = 'scan', bandtype = 'B', fillgaps = 8,
@@ -111,7 +89,7 @@ def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
     flagdata(vis=calfiles.bpassfile, datacolumn='CPARAM', mode='rflag', timedevscale=5.0, freqdevscale=5.0, action='apply')
 
     logger.info("starting \'Dflls\' polcal -> %s"  % calfiles.dpolfile)
-    polcal(vis=visname, caltable = calfiles.dpolfile, field = fields.bpassfield,
+    bookkeeping.cached_solve('polcal', nchunks, vis=solvevis, caltable = calfiles.dpolfile, field = fields.bpassfield,
             refant = '', solint = 'inf', combine = 'scan',
             poltype = 'Dflls', preavg= 200.0,
             gaintable = [calfiles.bpassfile],
@@ -121,7 +99,7 @@ def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
     flagdata(vis=calfiles.dpolfile, datacolumn='CPARAM', mode='rflag', timedevscale=5.0, freqdevscale=5.0, action='apply')
 
     logger.info(" starting gain calibration\n -> %s" % calfiles.gainfile)
-    gaincal(vis=visname, caltable = calfiles.gainfile,
+    bookkeeping.cached_solve('gaincal', vis=gainvis, caltable = calfiles.gainfile,
             field = fields.gainfields, refant = referenceant,
             minblperant = minbaselines, solnorm = False,  gaintype = 'T',
             solint = 'inf', combine = '', calmode='ap',
@@ -133,7 +111,7 @@ def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
     print("The polfield is: ", polfield)
     if polfield != fields.secondaryfield:
         logger.info(" starting pol calibrator gain calibration\n -> %s" % calfiles.gainfile)
-        gaincal(vis=visname, caltable = calfiles.gainfile,
+        bookkeeping.cached_solve('gaincal', vis=gainvis, caltable = calfiles.gainfile,
                 field = polfield, refant = referenceant,
                 minblperant = minbaselines, solnorm = False,  gaintype = 'T',
                 solint = 'inf', combine = '', calmode='ap',
@@ -147,7 +125,7 @@ def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
     if len(fields.gainfields.split(',')) > 1:
         logger.info(" starting fluxscale -> %s", calfiles.fluxfile)
         rmtables(os.path.join(caldir, calfiles.fluxfile))
-        fluxscale(vis=visname, caltable=calfiles.gainfile,
+        fluxscale(vis=gainvis, caltable=calfiles.gainfile,
                 reference=[fields.fluxfield], transfer='',
                 fluxtable=calfiles.fluxfile, append=False, display=False,
                 listfile = os.path.join(caldir,'fluxscale_xy_yx.txt'))
@@ -185,7 +163,7 @@ def do_cross_cal(visname, fields, calfiles, referenceant, caldir,
         xyfile = xy0ambpfile
 
     logger.info("\n Starting x-y phase calibration\n -> %s" % xy0ambpfile)
-    gaincal(vis=visname, caltable = xyfile, field = polfield,
+    bookkeeping.cached_solve('gaincal', vis=solvevis, caltable = xyfile, field = polfield,
             refant = referenceant, solint = 'inf', combine = 'scan',
             gaintype = 'XYf+QU', minblperant = minbaselines,
             preavg = 120.0,
@@ -215,6 +193,15 @@ minbaselines = taskvals['crosscal']['minbaselines']
 standard = taskvals['crosscal']['standard']
 refant = taskvals['crosscal']['refant']
 
-do_cross_cal(visname, fields, calfiles, f"'{refant}'", caldir, minbaselines, standard)
+#Optionally solve against a compact, time-averaged dataset of the calibrators, and apply back to the full MS
+solvevis, gainvis = calvis.calibrator_vis(visname, fields, taskvals['crosscal'].get('solvetimebin', ''),
+        taskvals['crosscal'].get('solvechanbin', 1), polfield=bookkeeping.polfield_name(visname),
+        spw=taskvals['crosscal']['spw'], standard=standard, dopol=True,
+        usescratch=taskvals['crosscal'].get('usescratch', False))
+
+#Solve bandpass and leakage over chunks of channels in parallel
+nchunks = taskvals['crosscal'].get('solvechunks', 1)
+
+do_cross_cal(visname, fields, calfiles, f"'{refant}'", caldir, minbaselines, standard, solvevis, gainvis, nchunks)
 
 
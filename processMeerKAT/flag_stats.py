@@ -0,0 +1,250 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Flag-occupancy statistics of an MS, computed in one streaming pass over the FLAG column and stored next to the MS as
+<vis>.flagstats.npz. The flagged and total number of visibilities are stored per antenna, baseline, channel (per SPW), scan,
+field and field x antenna, so later steps can query flagged fractions without touching the visibilities again.
+
+Usage: flag_stats.py vis
+"""
+
+import os
+import sys
+import glob
+import numpy as np
+from multiprocessing import Pool
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Number of rows of the main table read at once, to bound memory
+CHUNK_ROWS = 50000
+
+def stats_file(visname):
+
+    return '{0}.flagstats.npz'.format(visname.rstrip('/ '))
+
+def exists(visname):
+
+    return os.path.exists(stats_file(visname))
+
+def accumulate(visname, nant, nfield, nscan, nchans):
+
+    """Count the flagged and total visibilities of a single MS (or sub-MS) along each axis.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    nant : int
+        Number of antennas.
+    nfield : int
+        Number of fields.
+    nscan : int
+        Maximum scan number + 1.
+    nchans : list
+        Number of channels of each SPW.
+
+    Returns:
+    --------
+    counts : dict
+        Arrays of flagged ('<axis>_flagged') and total ('<axis>_total') counts, which can be summed over sub-MSs."""
+
+    from casatools import table
+    tb = table()
+
+    counts = {}
+    for axis,shape in [('ant',nant), ('baseline',(nant,nant)), ('scan',nscan), ('field',nfield), ('fieldant',(nfield,nant))]:
+        counts[axis + '_flagged'] = np.zeros(shape)
+        counts[axis + '_total'] = np.zeros(shape)
+    for spw,nchan in enumerate(nchans):
+        counts['chan{0}_flagged'.format(spw)] = np.zeros(nchan)
+        counts['chan{0}_total'.format(spw)] = np.zeros(nchan)
+
+    tb.open('{0}/DATA_DESCRIPTION'.format(visname))
+    spws = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    tb.open(visname)
+    for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+        sub = tb.query('DATA_DESC_ID=={0}'.format(ddid))
+        nrows = sub.nrows()
+        spw = spws[ddid]
+
+        for startrow in range(0, nrows, CHUNK_ROWS):
+            nrow = min(CHUNK_ROWS, nrows - startrow)
+            ant1 = sub.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+            ant2 = sub.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+            field = sub.getcol('FIELD_ID', startrow=startrow, nrow=nrow)
+            scan = sub.getcol('SCAN_NUMBER', startrow=startrow, nrow=nrow)
+            flag = sub.getcol('FLAG', startrow=startrow, nrow=nrow)
+
+            #Per-row counts, then per-channel counts
+            nflags = flag.reshape(-1, nrow).sum(axis=0)
+            nvis = np.full(nrow, flag.shape[0] * flag.shape[1])
+            counts['chan{0}_flagged'.format(spw)] += flag.sum(axis=(0,2))
+            counts['chan{0}_total'.format(spw)] += flag.shape[0] * nrow
+
+            for key,weights in [('flagged',nflags), ('total',nvis)]:
+                counts['scan_' + key] += np.bincount(scan, weights=weights, minlength=nscan)
+                counts['field_' + key] += np.bincount(field, weights=weights, minlength=nfield)
+                counts['baseline_' + key] += np.bincount(ant1 * nant + ant2, weights=weights, minlength=nant*nant).reshape(nant,nant)
+                #Cross-correlations count towards both antennas, autocorrelations once
+                for ant,rows in [(ant1, slice(None)), (ant2, ant1 != ant2)]:
+                    counts['ant_' + key] += np.bincount(ant[rows], weights=weights[rows], minlength=nant)
+                    counts['fieldant_' + key] += np.bincount(field[rows] * nant + ant[rows], weights=weights[rows], minlength=nfield*nant).reshape(nfield,nant)
+
+        sub.close()
+    tb.close()
+
+    return counts
+
+def compute(visname, nproc=0, write=True):
+
+    """Compute the flag statistics of an MS (in parallel over sub-MSs of an MMS) and write them to <vis>.flagstats.npz.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS or MMS.
+    nproc : int, optional
+        Number of processes. Use 0 for one per available CPU.
+    write : bool, optional
+        Write the statistics to <vis>.flagstats.npz? Use False when several jobs may read the same MS at once.
+
+    Returns:
+    --------
+    stats : class ``FlagStats``
+        The computed statistics."""
+
+    from casatools import msmetadata
+    msmd = msmetadata()
+
+    visname = visname.rstrip('/ ')
+    msmd.open(visname)
+    antnames = np.array(msmd.antennanames())
+    fieldnames = np.array(msmd.fieldnames())
+    nscan = int(np.max(msmd.scannumbers())) + 1
+    chanfreqs = [msmd.chanfreqs(spw) for spw in range(msmd.nspw())]
+    msmd.done()
+
+    if os.path.exists('{0}/SUBMSS'.format(visname)):
+        vislist = sorted(glob.glob('{0}/SUBMSS/*'.format(visname)))
+    else:
+        vislist = [visname]
+
+    args = [(vis, antnames.size, fieldnames.size, nscan, [freqs.size for freqs in chanfreqs]) for vis in vislist]
+    if len(vislist) > 1:
+        nproc = min(len(vislist), nproc if nproc > 0 else len(os.sched_getaffinity(0)))
+        with Pool(processes=nproc) as pool:
+            counts = pool.starmap(accumulate, args)
+    else:
+        counts = [accumulate(*args[0])]
+
+    arrays = {key : np.sum([count[key] for count in counts], axis=0) for key in counts[0].keys()}
+    arrays['antnames'] = antnames
+    arrays['fieldnames'] = fieldnames
+    for spw,freqs in enumerate(chanfreqs):
+        arrays['chan{0}_freq'.format(spw)] = freqs
+
+    stats = FlagStats(arrays)
+    if write:
+        np.savez_compressed(stats_file(visname), **arrays)
+        logger.info("Flag statistics written to '{0}'. {1:.2f}% of the data are flagged.".format(stats_file(visname), 100*stats.total_fraction()))
+    else:
+        logger.info("{0:.2f}% of the data in '{1}' are flagged.".format(100*stats.total_fraction(), visname))
+
+    return stats
+
+def load(visname):
+
+    """Load the flag statistics written by ``compute``."""
+
+    with np.load(stats_file(visname)) as f:
+        return FlagStats({key : f[key] for key in f.files})
+
+class FlagStats(object):
+
+    """Query flagged fractions along each axis. Fractions of axes with no data are NaN.
+
+    Arguments:
+    ----------
+    arrays : dict
+        Arrays of counts, as written by ``compute``."""
+
+    def __init__(self, arrays):
+
+        self.arrays = arrays
+        self.antnames = list(arrays['antnames'])
+        self.fieldnames = list(arrays['fieldnames'])
+        self.nspw = len([key for key in arrays.keys() if key.endswith('_freq')])
+
+    def _fraction(self, axis):
+
+        total = self.arrays[axis + '_total']
+        return np.where(total > 0, self.arrays[axis + '_flagged'] / np.where(total > 0, total, 1), np.nan)
+
+    def _field_id(self, field):
+
+        return self.fieldnames.index(field) if field in self.fieldnames else int(field)
+
+    def total_fraction(self):
+
+        return np.sum(self.arrays['field_flagged']) / max(np.sum(self.arrays['field_total']), 1)
+
+    def antenna_fraction(self, field=None):
+
+        """Flagged fraction per antenna, optionally for a single field (name or ID)."""
+
+        if field is None:
+            return self._fraction('ant')
+        return self._fraction('fieldant')[self._field_id(field)]
+
+    def baseline_fraction(self):
+
+        """Flagged fraction per baseline, as an (nant, nant) array indexed by ANTENNA1, ANTENNA2."""
+
+        return self._fraction('baseline')
+
+    def scan_fraction(self):
+
+        """Flagged fraction per scan number."""
+
+        return self._fraction('scan')
+
+    def field_fraction(self):
+
+        """Flagged fraction per field ID."""
+
+        return self._fraction('field')
+
+    def channel_fraction(self, spw=0):
+
+        """Channel frequencies (Hz) and flagged fraction per channel of an SPW."""
+
+        return self.arrays['chan{0}_freq'.format(spw)], self._fraction('chan{0}'.format(spw))
+
+    def frequency_fraction(self, low, high):
+
+        """Flagged fraction between two frequencies (Hz), over all SPWs. Returns NaN if there are no data in this range."""
+
+        flagged = total = 0
+        for spw in range(self.nspw):
+            freqs = self.arrays['chan{0}_freq'.format(spw)]
+            chans = (freqs >= low) & (freqs <= high)
+            flagged += np.sum(self.arrays['chan{0}_flagged'.format(spw)][chans])
+            total += np.sum(self.arrays['chan{0}_total'.format(spw)][chans])
+        return flagged / total if total > 0 else np.nan
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] == '-h':
+        print(__doc__)
+        sys.exit(0)
+    compute(sys.argv[1])
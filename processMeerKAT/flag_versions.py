@@ -0,0 +1,245 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Flag-version manager, replacing the full copies of the FLAG column written into <vis>.flagversions by flagdata(flagbackup=True).
+The first version (and every MAX_CHAIN versions thereafter) is a full snapshot of the flags, packed into bits. Each later
+version is stored as the XOR of its packed flags with those of the previous version, which is almost all zeros and therefore
+compresses to a tiny fraction of the size. Versions are written to <vis>.flagdiffs/, described by manifest.json, and any
+version can be restored by applying its chain of diffs to the nearest snapshot.
+
+Usage: flag_versions.py vis [list|save name|restore name]
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import zipfile
+import numpy as np
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+#Number of rows of the main table read at once, to bound memory
+CHUNK_ROWS = 50000
+
+#Maximum number of diffs applied to a snapshot, beyond which a new snapshot is written
+MAX_CHAIN = 10
+
+def version_dir(visname):
+
+    return '{0}.flagdiffs'.format(visname.rstrip('/ '))
+
+def read_manifest(visname):
+
+    """Return the list of versions (in order of creation) stored for this MS."""
+
+    manifest = os.path.join(version_dir(visname), 'manifest.json')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            return json.load(f)
+    return []
+
+def write_manifest(visname, versions):
+
+    manifest = os.path.join(version_dir(visname), 'manifest.json')
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump(versions, f, indent=1)
+    os.replace(manifest + '.tmp', manifest)
+
+def iter_chunks(tb):
+
+    """Yield (key, table, startrow, nrow) for each chunk of rows, separately per DATA_DESC_ID, since the shape of the FLAG
+    column may differ between spectral windows."""
+
+    for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+        sub = tb.query('DATA_DESC_ID=={0}'.format(ddid))
+        for startrow in range(0, sub.nrows(), CHUNK_ROWS):
+            yield 'd{0}_r{1}'.format(ddid, startrow), sub, startrow, min(CHUNK_ROWS, sub.nrows() - startrow)
+        sub.close()
+
+def chunk_shapes(tb):
+
+    """Return the shape of the FLAG column of each chunk of rows, without reading the flags."""
+
+    return {key : list(sub.getcell('FLAG', startrow).shape) + [nrow] for key,sub,startrow,nrow in iter_chunks(tb)}
+
+def flag_digest(visname):
+
+    """Return a SHA1 digest of the flags of an MS, computed from the same packed chunks as the saved versions."""
+
+    from casatools import table
+    tb = table()
+
+    sha = hashlib.sha1()
+    tb.open(visname)
+    for key,sub,startrow,nrow in iter_chunks(tb):
+        flags = sub.getcol('FLAG', startrow=startrow, nrow=nrow)
+        sha.update('{0}{1}'.format(key, flags.shape).encode())
+        sha.update(np.packbits(flags.ravel()).tobytes())
+    tb.close()
+    return sha.hexdigest()
+
+def forget_fingerprint(visname):
+
+    """Discard the memoised calibration fingerprint of an MS (see ``bookkeeping.ms_fingerprint``), since its flags may change."""
+
+    import bookkeeping
+    bookkeeping.forget_fingerprint(visname)
+
+def chain(versions, name):
+
+    """Return the versions (snapshot first) needed to rebuild the named version."""
+
+    byname = {version['name'] : version for version in versions}
+    if name not in byname:
+        raise ValueError("Flag version '{0}' doesn't exist. Versions are: {1}".format(name, [version['name'] for version in versions]))
+
+    links = [byname[name]]
+    while links[0]['parent'] != '':
+        links.insert(0, byname[links[0]['parent']])
+    return links
+
+class VersionReader(object):
+
+    """Rebuild the packed flags of a version, one chunk at a time."""
+
+    def __init__(self, visname, name):
+
+        self.files = [np.load(os.path.join(version_dir(visname), version['file'])) for version in chain(read_manifest(visname), name)]
+
+    def packed(self, key):
+
+        bits = self.files[0][key]
+        for diff in self.files[1:]:
+            bits = np.bitwise_xor(bits, diff[key])
+        return bits
+
+    def close(self):
+
+        for f in self.files:
+            f.close()
+
+def save(visname, name, comment=''):
+
+    """Save the current flags of an MS as a new version, as a diff against the previous version where possible.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    name : str
+        Name of this version. An existing version of this name is replaced.
+    comment : str, optional
+        Description of this version."""
+
+    from casatools import table
+    tb = table()
+
+    if not os.path.exists(version_dir(visname)):
+        os.makedirs(version_dir(visname))
+
+    #Replacing a version discards it and all later versions, which may depend on it
+    versions = read_manifest(visname)
+    names = [version['name'] for version in versions]
+    discarded = []
+    if name in names:
+        logger.warning("Replacing flag version '{0}' and discarding later versions {1}.".format(name, names[names.index(name)+1:]))
+        discarded = versions[names.index(name):]
+        versions = versions[:names.index(name)]
+
+    tb.open(visname)
+
+    #Write a snapshot if there are no versions, the chain is too long, or the layout of the MS (i.e. any chunk shape) has changed
+    parent = versions[-1]['name'] if len(versions) > 0 else ''
+    if parent != '' and (len(chain(versions, parent)) >= MAX_CHAIN or versions[-1]['shapes'] != chunk_shapes(tb)):
+        parent = ''
+
+    previous = VersionReader(visname, parent) if parent != '' else None
+    shapes = {}
+
+    #Stream each chunk into the (npz) archive, so only one chunk is held in memory
+    fname = '{0}.npz'.format(name)
+    path = os.path.join(version_dir(visname), fname)
+    with zipfile.ZipFile(path + '.tmp', mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for key,sub,startrow,nrow in iter_chunks(tb):
+            flags = sub.getcol('FLAG', startrow=startrow, nrow=nrow)
+            shapes[key] = list(flags.shape)
+            packed = np.packbits(flags.ravel())
+            if previous is not None:
+                packed = np.bitwise_xor(packed, previous.packed(key))
+            with archive.open('{0}.npy'.format(key), mode='w', force_zip64=True) as f:
+                np.lib.format.write_array(f, packed)
+    tb.close()
+
+    if previous is not None:
+        previous.close()
+
+    os.replace(path + '.tmp', path)
+    versions.append({'name' : name, 'parent' : parent, 'file' : fname, 'comment' : comment, 'shapes' : shapes,
+                     'time' : time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())})
+    write_manifest(visname, versions)
+
+    #Remove the files of replaced or discarded versions
+    for version in discarded:
+        if version['file'] not in [kept['file'] for kept in versions] and os.path.exists(os.path.join(version_dir(visname), version['file'])):
+            os.remove(os.path.join(version_dir(visname), version['file']))
+
+    logger.info("Saved flag version '{0}' of '{1}' as a {2}.".format(name, visname, 'diff against {0}'.format(parent) if parent != '' else 'snapshot'))
+    forget_fingerprint(visname)
+
+def restore(visname, name):
+
+    """Restore the flags of an MS to a saved version.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    name : str
+        Name of version to restore."""
+
+    from casatools import table
+    tb = table()
+
+    shapes = chain(read_manifest(visname), name)[-1]['shapes']
+    reader = VersionReader(visname, name)
+
+    tb.open(visname, nomodify=False)
+    for key,sub,startrow,nrow in iter_chunks(tb):
+        shape = shapes[key]
+        flags = np.unpackbits(reader.packed(key), count=int(np.prod(shape))).astype(bool).reshape(shape)
+        sub.putcol('FLAG', flags, startrow=startrow, nrow=nrow)
+    tb.close()
+    reader.close()
+
+    logger.info("Restored flag version '{0}' of '{1}'.".format(name, visname))
+    forget_fingerprint(visname)
+
+def list_versions(visname):
+
+    """Log each saved version of an MS."""
+
+    for version in read_manifest(visname):
+        size = os.path.getsize(os.path.join(version_dir(visname), version['file'])) / 1024.0**2
+        logger.info('{0: <30} {1: <20} {2:.1f} MB ({3}) {4}'.format(version['name'], version['time'],
+                    size, 'diff' if version['parent'] != '' else 'snapshot', version['comment']))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] == '-h':
+        print(__doc__)
+        sys.exit(0)
+    elif len(sys.argv) < 4 or sys.argv[2] == 'list':
+        list_versions(sys.argv[1])
+    elif sys.argv[2] == 'save':
+        save(sys.argv[1], sys.argv[3])
+    elif sys.argv[2] == 'restore':
+        restore(sys.argv[1], sys.argv[3])
@@ -0,0 +1,166 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Express a flagging strategy as a list of flagdata commands, which is run in as few passes over the data as possible using
+flagdata in list mode. Agents that depend on the flags written by others (i.e. 'extend') and the summary are run in a
+second pass, and the flags are only backed up once, before the first pass, using the flag-version manager.
+
+Flagging an MMS is parallel over its sub-MSs, either by flagdata itself when running under casampi (i.e. via mpicasa), or
+otherwise by a pool of processes that each run both passes over one sub-MS. A plain MS can be partitioned by scan into an
+MMS first using ``partition_by_scan``.
+"""
+
+import os
+import glob
+from multiprocessing import Pool
+
+import config_parser
+import bookkeeping
+import flag_versions
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+
+#Modes that must see the flags written by all other agents
+DEPENDENT_MODES = ['extend', 'summary']
+
+def flag_cmd(mode, **params):
+
+    """Return a flagdata command string (as used in list mode) for a given mode and parameters.
+
+    Arguments:
+    ----------
+    mode : str
+        flagdata mode (e.g. 'manual', 'clip', 'tfcrop', 'rflag', 'extend').
+    params : dict
+        Parameters of this mode, excluding vis and those of the whole call (e.g. action and flagbackup).
+
+    Returns:
+    --------
+    cmd : str
+        Command string, e.g. "mode='clip' field='0,1' clipminmax=[0.0, 50.0]"."""
+
+    #Empty selections mean all data, so skip them
+    params = {key : val for key,val in params.items() if not (type(val) is str and val == '')}
+    return ' '.join(["mode='{0}'".format(mode)] + ['{0}={1}'.format(key,repr(val)) for key,val in params.items()])
+
+def mpi_enabled():
+
+    """Return whether this process is the client of a casampi (mpicasa) session, in which case CASA tasks parallelise over MMSs."""
+
+    try:
+        from casampi.MPIEnvironment import MPIEnvironment
+        return MPIEnvironment.is_mpi_enabled
+    except ImportError:
+        return False
+
+def partition_by_scan(visname, config=''):
+
+    """Partition a plain MS into an MMS with one sub-MS per scan, so it can be flagged in parallel. An MMS is returned as is.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS or MMS.
+    config : str, optional
+        Path to config file, in which the [data] vis is updated to the MMS (and the original MS written to [run] orig_vis).
+
+    Returns:
+    --------
+    mvis : str
+        Path to MMS."""
+
+    from casatasks import mstransform
+    from casatools import msmetadata
+    msmd = msmetadata()
+
+    visname = visname.rstrip('/ ')
+    if os.path.exists('{0}/SUBMSS'.format(visname)):
+        return visname
+
+    mvis = '{0}.mms'.format(os.path.splitext(visname)[0])
+    if not os.path.exists(mvis):
+        msmd.open(visname)
+        nscan = msmd.nscans()
+        msmd.done()
+
+        logger.info('Partitioning "{0}" into "{1}" with {2} sub-MSs (one per scan) for parallel flagging.'.format(visname,mvis,nscan))
+        mstransform(vis=visname, outputvis=mvis, createmms=True, separationaxis='scan', numsubms=nscan,
+                    datacolumn='all', keepflags=True, usewtspectrum=True)
+
+    if config != '':
+        config_parser.overwrite_config(config, conf_sec='data', conf_dict={'vis' : "'{0}'".format(mvis)})
+        config_parser.overwrite_config(config, conf_sec='run', sec_comment='# Internal variables for pipeline execution', conf_dict={'orig_vis' : "'{0}'".format(visname)})
+
+    return mvis
+
+def target_flag_cmds(field, datacolumn='corrected'):
+
+    """Return the tfcrop and rflag commands for moderate flagging of the target field(s) of calibrated data, with more
+    flagging done in the self-calibration cycles."""
+
+    cmds = [flag_cmd("tfcrop", datacolumn=datacolumn,
+            field=field, ntime="scan", timecutoff=6.0, freqcutoff=5.0,
+            timefit="poly", freqfit="line", flagdimension="freqtime",
+            extendflags=False, timedevscale=5.0, freqdevscale=5.0,
+            extendpols=False, growaround=False)]
+
+    cmds.append(flag_cmd("rflag", datacolumn=datacolumn,
+            field=field, timecutoff=5.0, freqcutoff=5.0, timefit="poly",
+            freqfit="poly", flagdimension="freqtime", extendflags=False,
+            timedevscale=5.0, freqdevscale=5.0, spectralmax=500.0,
+            extendpols=False, growaround=False, flagneartime=False,
+            flagnearfreq=False))
+
+    return cmds
+
+def run_passes(visname, passes):
+
+    """Run each pass (list of command strings) over an MS in turn."""
+
+    from casatasks import flagdata
+
+    for i,inpfile in enumerate(passes):
+        if len(inpfile) > 0:
+            logger.info('Running flagging pass {0} over "{1}" with {2} agent(s):\n{3}'.format(i+1,visname,len(inpfile),'\n'.join(inpfile)))
+            flagdata(vis=visname, mode='list', inpfile=inpfile, action='apply',
+                    flagbackup=False, savepars=False, writeflags=True)
+
+def run_flag_cmds(visname, cmds, version='', nproc=0):
+
+    """Run a list of flagdata commands, with independent agents in one pass and dependent agents in a second pass.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS or MMS.
+    cmds : list
+        List of command strings, from ``flag_cmd``.
+    version : str, optional
+        Name of flag version under which to save the flags (once) before the first pass. Use '' to skip backing up.
+    nproc : int, optional
+        Number of processes over which to flag the sub-MSs of an MMS when not running under casampi. Use 0 for one per available CPU."""
+
+    passes = [[cmd for cmd in cmds if cmd.split()[0] not in ["mode='{0}'".format(mode) for mode in DEPENDENT_MODES]],
+              [cmd for cmd in cmds if cmd.split()[0] in ["mode='{0}'".format(mode) for mode in DEPENDENT_MODES]]]
+
+    if version != '':
+        flag_versions.save(visname, version, comment='Before running {0} flagging agents'.format(len(cmds)))
+
+    #Sub-MSs are independent, so each process runs both passes over its own sub-MS
+    vislist = sorted(glob.glob('{0}/SUBMSS/*'.format(visname.rstrip('/ '))))
+    if len(vislist) > 1 and not mpi_enabled():
+        nproc = min(len(vislist), nproc if nproc > 0 else len(os.sched_getaffinity(0)))
+        logger.info('Flagging {0} sub-MSs of "{1}" over {2} processes.'.format(len(vislist),visname,nproc))
+        with Pool(processes=nproc) as pool:
+            pool.starmap(run_passes, [(vis, passes) for vis in vislist])
+    else:
+        run_passes(visname, passes)
+
+    #The flags have changed, so any memoised fingerprint of this MS is stale
+    bookkeeping.forget_fingerprint(visname)
@@ -0,0 +1,162 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Lightweight MeasurementSet metadata reader, using python-casacore instead of a CASA container. Only the small subtables
+(FIELD, SPECTRAL_WINDOW, ANTENNA, POLARIZATION, STATE, OBSERVATION) and a strided read of the scalar FIELD_ID, SCAN_NUMBER,
+STATE_ID and TIME columns of the main table are opened, so this can run directly on a login node.
+"""
+
+import os
+import numpy as np
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+
+def available():
+
+    """Is python-casacore importable?"""
+
+    try:
+        import casacore.tables
+    except ImportError:
+        return False
+    return True
+
+class MSMetadata(object):
+
+    """Subset of the ``casatools.msmetadata`` interface used while building the config file.
+
+    Arguments:
+    ----------
+    vis : str, optional
+        Input MeasurementSet (relative or absolute path). If input, it is opened immediately."""
+
+    def __init__(self, vis=''):
+
+        self.vis = ''
+        if vis != '':
+            self.open(vis)
+
+    def _getcol(self, subtable, column, cells=False):
+
+        from casacore.tables import table
+
+        tb = table(os.path.join(self.vis, subtable), ack=False, readonly=True)
+        if tb.nrows() == 0 or column not in tb.colnames():
+            col = np.array([])
+        elif cells:
+            #Array columns may have a different shape in each row (e.g. number of channels per SPW)
+            col = [tb.getcell(column, row) for row in range(tb.nrows())]
+        else:
+            col = tb.getcol(column)
+        tb.close()
+        return col
+
+    def open(self, vis):
+
+        """Read the subtables and index the main table of the input MS."""
+
+        from casacore.tables import table
+
+        self.vis = vis.rstrip('/ ')
+        self._fieldnames = list(self._getcol('FIELD', 'NAME'))
+        self._antnames = list(self._getcol('ANTENNA', 'NAME'))
+        self._antpos = self._getcol('ANTENNA', 'POSITION')
+        self._chanfreqs = self._getcol('SPECTRAL_WINDOW', 'CHAN_FREQ', cells=True)
+        self._ncorr = [int(n) for n in self._getcol('POLARIZATION', 'NUM_CORR')]
+        self._obsmodes = [str(mode).split(',') for mode in self._getcol('STATE', 'OBS_MODE')]
+        self._telescopes = list(self._getcol('OBSERVATION', 'TELESCOPE_NAME'))
+
+        #All baselines within a dump share their field, scan, state and time, so only sample a couple of rows per dump. This
+        #assumes the rows are in time order, so if the sampled times aren't sorted, read every row instead
+        nant = len(self._antnames)
+        rowincr = max(1, nant*(nant-1)//4)
+
+        tb = table(self.vis, ack=False, readonly=True)
+        self._time = tb.getcol('TIME', rowincr=rowincr)
+        if rowincr > 1 and np.any(np.diff(self._time) < 0):
+            logger.info("Rows of '{0}' aren't in time order. Reading the full FIELD_ID, SCAN_NUMBER, STATE_ID and TIME columns.".format(self.vis))
+            rowincr = 1
+            self._time = tb.getcol('TIME')
+
+        self._field = tb.getcol('FIELD_ID', rowincr=rowincr)
+        self._scan = tb.getcol('SCAN_NUMBER', rowincr=rowincr)
+        self._state = tb.getcol('STATE_ID', rowincr=rowincr) if 'STATE_ID' in tb.colnames() else np.full(self._field.shape, -1)
+        tb.close()
+
+    def done(self):
+
+        self.vis = ''
+
+    def close(self):
+
+        self.done()
+
+    def fieldnames(self):
+
+        return self._fieldnames
+
+    def namesforfields(self, fieldids):
+
+        if np.isscalar(fieldids):
+            fieldids = [fieldids]
+        return [self._fieldnames[int(fid)] for fid in fieldids]
+
+    def fieldsforname(self, name):
+
+        return np.array([fid for fid,fname in enumerate(self._fieldnames) if fname == name])
+
+    def intents(self):
+
+        return sorted(set([intent for modes in self._obsmodes for intent in modes if intent != '']))
+
+    def fieldsforintent(self, intent):
+
+        states = [i for i,modes in enumerate(self._obsmodes) if intent in modes]
+        return np.unique(self._field[np.isin(self._state, states)])
+
+    def scansforfield(self, fieldid):
+
+        return np.unique(self._scan[self._field == int(fieldid)])
+
+    def timesforfield(self, fieldid):
+
+        return np.unique(self._time[self._field == int(fieldid)])
+
+    def antennanames(self):
+
+        return self._antnames
+
+    def antennaids(self):
+
+        return np.arange(len(self._antnames))
+
+    def antennapositions(self):
+
+        return self._antpos
+
+    def ncorrforpol(self):
+
+        return np.array(self._ncorr)
+
+    def nspw(self):
+
+        return len(self._chanfreqs)
+
+    def chanfreqs(self, spw):
+
+        return np.asarray(self._chanfreqs[spw])
+
+    def meanfreq(self, spw, unit='Hz'):
+
+        scale = {'Hz' : 1, 'kHz' : 1e3, 'MHz' : 1e6, 'GHz' : 1e9}[unit]
+        return np.mean(self.chanfreqs(spw)) / scale
+
+    def observatorynames(self):
+
+        return self._telescopes
@@ -0,0 +1,149 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Solve for channel-based calibration (e.g. bandpass or polcal with poltype='Dflls') in parallel, since the solutions of each
+channel are independent. The channels of each SPW are split into chunks, the solver is run on each chunk in a separate process,
+and the resulting tables are merged into one table, with the channels of each SPW concatenated in the SPECTRAL_WINDOW subtable.
+"""
+
+import os
+import shutil
+import numpy as np
+from multiprocessing import Pool
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+
+#Columns of a caltable with one value per channel, concatenated when merging
+CHANNEL_COLUMNS = ['CPARAM', 'FPARAM', 'PARAMERR', 'FLAG', 'SNR', 'WEIGHT']
+
+#Columns of the SPECTRAL_WINDOW subtable with one value per channel
+SPW_CHANNEL_COLUMNS = ['CHAN_FREQ', 'CHAN_WIDTH', 'EFFECTIVE_BW', 'RESOLUTION']
+
+def chunk_selections(visname, nchunks):
+
+    """Return a CASA SPW selection (e.g. '0:0~511,1:0~511') for each chunk of channels, over all SPWs."""
+
+    from casatools import msmetadata
+    msmd = msmetadata()
+
+    msmd.open(visname)
+    nchans = [msmd.nchan(spw) for spw in range(msmd.nspw())]
+    msmd.done()
+
+    nchunks = min(nchunks, min(nchans))
+    selections = []
+    for i in range(nchunks):
+        chunk = []
+        for spw,nchan in enumerate(nchans):
+            edges = np.linspace(0, nchan, nchunks+1).astype(int)
+            chunk.append('{0}:{1}~{2}'.format(spw, edges[i], edges[i+1]-1))
+        selections.append(','.join(chunk))
+    return selections
+
+def run_chunk(task, kwargs):
+
+    import casatasks
+    getattr(casatasks, task)(**kwargs)
+    return os.path.exists(kwargs['caltable'])
+
+def row_keys(tb):
+
+    return list(zip(np.round(tb.getcol('TIME'), 3), tb.getcol('SPECTRAL_WINDOW_ID'), tb.getcol('ANTENNA1'), tb.getcol('FIELD_ID')))
+
+def merge_tables(tables, caltable):
+
+    """Merge caltables solved over different channels of the same data into one table.
+
+    Arguments:
+    ----------
+    tables : list
+        Paths to caltables, in order of channel.
+    caltable : str
+        Path to merged caltable."""
+
+    from casatools import table
+    tb = table()
+
+    #Read each chunk, checking they contain the same solutions (i.e. rows)
+    chunks = []
+    for fname in tables:
+        tb.open(fname)
+        if tb.nrows() == 0:
+            tb.close()
+            raise ValueError('Caltable "{0}" contains no solutions, so cannot be merged.'.format(fname))
+        #Only (polarisation, channel) cells are per channel
+        cols = [col for col in CHANNEL_COLUMNS if col in tb.colnames() and tb.getcell(col, 0).ndim == 2]
+        chunk = {'keys' : row_keys(tb), 'columns' : {col : [tb.getcell(col, row) for row in range(tb.nrows())] for col in cols}}
+        tb.close()
+        tb.open(os.path.join(fname, 'SPECTRAL_WINDOW'))
+        chunk['spw'] = {col : [tb.getcell(col, row) for row in range(tb.nrows())] for col in SPW_CHANNEL_COLUMNS}
+        tb.close()
+        if len(chunks) > 0 and chunk['keys'] != chunks[0]['keys']:
+            raise ValueError('Caltables "{0}" and "{1}" contain different solutions, so cannot be merged.'.format(tables[0], fname))
+        chunks.append(chunk)
+
+    if os.path.exists(caltable):
+        shutil.rmtree(caltable)
+    shutil.copytree(tables[0], caltable)
+
+    #Concatenate along the channel axis (axis 1 of the main table cells, axis 0 of the SPECTRAL_WINDOW cells)
+    tb.open(caltable, nomodify=False)
+    for col in chunks[0]['columns'].keys():
+        for row in range(tb.nrows()):
+            tb.putcell(col, row, np.concatenate([chunk['columns'][col][row] for chunk in chunks], axis=1))
+    tb.close()
+
+    tb.open(os.path.join(caltable, 'SPECTRAL_WINDOW'), nomodify=False)
+    for row in range(tb.nrows()):
+        for col in SPW_CHANNEL_COLUMNS:
+            tb.putcell(col, row, np.concatenate([chunk['spw'][col][row] for chunk in chunks]))
+        freqs = tb.getcell('CHAN_FREQ', row)
+        tb.putcell('NUM_CHAN', row, freqs.size)
+        tb.putcell('TOTAL_BANDWIDTH', row, float(np.sum(tb.getcell('CHAN_WIDTH', row))))
+    tb.close()
+
+def solve(task, nchunks, **kwargs):
+
+    """Run a CASA solver task over chunks of channels in parallel, and merge the results into one caltable. Falls back to a
+    single solve if the data can't be chunked (e.g. an SPW selection is input), or the chunks can't be merged.
+
+    Arguments:
+    ----------
+    task : str
+        Name of CASA task in ``casatasks`` (e.g. 'bandpass' or 'polcal').
+    nchunks : int
+        Number of chunks of channels, each solved in a separate process.
+    kwargs : dict
+        Keyword arguments passed into the task, including vis and caltable."""
+
+    selections = chunk_selections(kwargs['vis'], nchunks) if nchunks > 1 and kwargs.get('spw', '') == '' and not kwargs.get('append', False) else []
+    if len(selections) < 2:
+        run_chunk(task, kwargs)
+        return
+
+    caltable = kwargs['caltable']
+    tables = ['{0}.chunk{1}'.format(caltable, i) for i in range(len(selections))]
+    args = [(task, dict(kwargs, spw=spw, caltable=fname)) for spw,fname in zip(selections, tables)]
+
+    logger.info('Running {0} over {1} chunks of channels in parallel -> {2}'.format(task, len(selections), caltable))
+    with Pool(processes=len(selections)) as pool:
+        written = pool.starmap(run_chunk, args)
+
+    try:
+        if not all(written):
+            raise ValueError('Not all chunks of "{0}" were written.'.format(caltable))
+        merge_tables(tables, caltable)
+    except (ValueError, RuntimeError) as err:
+        #RuntimeError is raised by the CASA table tool on unreadable chunks
+        logger.warning('{0} Solving over all channels at once instead.'.format(err))
+        run_chunk(task, kwargs)
+    finally:
+        for fname in tables:
+            if os.path.exists(fname):
+                shutil.rmtree(fname)
@@ -0,0 +1,217 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Fast deterministic pre-flagger, applying the rules that don't need CASA's flagging agents directly to the FLAG and DATA
+columns: bad frequency ranges, bad antennas, autocorrelations, exact zeros, and amplitudes outside a clip range (flagging all
+correlations if any is clipped). Each sub-MS of an MMS is processed in chunks of rows by a separate process, and the new flags
+are OR'd into the FLAG column in place.
+"""
+
+import os
+import re
+import glob
+import numpy as np
+from multiprocessing import Pool
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+
+#Memory budget (bytes) of the rows read at once by each process
+CHUNK_BYTES = 256 * 1024**2
+
+#Bytes per visibility of a chunk, from complex64 DATA, float32 amplitudes and the boolean FLAG and working masks
+VIS_BYTES = 8 + 4 + 3
+
+UNITS = {'hz' : 1, 'khz' : 1e3, 'mhz' : 1e6, 'ghz' : 1e9}
+
+def parse_freqranges(badfreqranges):
+
+    """Return a list of (low, high) frequencies in Hz from a list of CASA frequency ranges (e.g. ['933~960MHz'])."""
+
+    ranges = []
+    for freqrange in badfreqranges:
+        match = re.match(r'\s*([\d.]+)\s*~\s*([\d.]+)\s*([a-zA-Z]*)', freqrange.replace('*:',''))
+        if match is None:
+            logger.warning("Can't parse bad frequency range '{0}'. Ignoring it.".format(freqrange))
+            continue
+        scale = UNITS.get(match.group(3).lower(), 1e6) #MHz by default
+        ranges.append((float(match.group(1)) * scale, float(match.group(2)) * scale))
+    return ranges
+
+def parse_list(values):
+
+    """Return a list from either a list or a comma-separated string (e.g. "[1, 'm005']")."""
+
+    if type(values) is str:
+        values = values.split('#')[0].strip(' []')
+        values = [val.strip(" '\"") for val in values.split(',') if val.strip(" '\"") != '']
+    return values
+
+def resolve_ids(visname, subtable, values):
+
+    """Return the row IDs in a subtable (e.g. 'ANTENNA' or 'FIELD') of the input values, which may be given as IDs or names."""
+
+    from casatools import table
+    tb = table()
+    tb.open('{0}/{1}'.format(visname,subtable))
+    names = list(tb.getcol('NAME'))
+    tb.close()
+
+    ids = []
+    for val in parse_list(values):
+        if str(val).isdigit():
+            ids.append(int(val))
+        elif val in names:
+            ids.append(names.index(val))
+        else:
+            logger.warning("'{0}' not found in {1} table of '{2}'.".format(val,subtable,visname))
+    return np.array(ids, dtype=int)
+
+def preflag_ms(visname, freqranges, badants, fields, clip, autocorr=True, zeros=True, chunkbytes=CHUNK_BYTES):
+
+    """Apply the deterministic flagging rules to a single MS (or sub-MS).
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    freqranges : list
+        List of (low, high) bad frequency ranges in Hz.
+    badants : list
+        List of bad antenna IDs.
+    fields : list
+        List of field IDs to clip (and flag zeros). Use [] for all fields.
+    clip : list
+        Range [min, max] of amplitudes outside which data are flagged. Use None to skip clipping.
+    autocorr : bool, optional
+        Flag autocorrelations?
+    zeros : bool, optional
+        Flag visibilities that are exactly zero?
+    chunkbytes : int, optional
+        Memory budget (bytes) of the rows read at once.
+
+    Returns:
+    --------
+    nflagged : int
+        Number of newly flagged visibilities.
+    total : int
+        Total number of visibilities."""
+
+    from casatools import table
+    tb = table()
+
+    #Map each data description to its bad channels
+    tb.open('{0}/DATA_DESCRIPTION'.format(visname))
+    spws = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    tb.open('{0}/SPECTRAL_WINDOW'.format(visname))
+    badchans = []
+    for spw in spws:
+        freqs = tb.getcell('CHAN_FREQ', int(spw))
+        mask = np.zeros(freqs.size, dtype=bool)
+        for low,high in freqranges:
+            mask |= (freqs >= low) & (freqs <= high)
+        badchans.append(mask)
+    tb.close()
+
+    nflagged = total = 0
+    tb.open(visname, nomodify=False)
+
+    for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+        sub = tb.query('DATA_DESC_ID=={0}'.format(ddid))
+        nrows = sub.nrows()
+        if nrows == 0:
+            sub.close()
+            continue
+        nchunk = max(1, int(chunkbytes // (sub.getcell('FLAG', 0).size * VIS_BYTES)))
+
+        for startrow in range(0, nrows, nchunk):
+            nrow = min(nchunk, nrows - startrow)
+            ant1 = sub.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+            ant2 = sub.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+            field = sub.getcol('FIELD_ID', startrow=startrow, nrow=nrow)
+            flag = sub.getcol('FLAG', startrow=startrow, nrow=nrow)
+
+            #Whole rows, then channels, then individual visibilities
+            new = np.zeros(flag.shape, dtype=bool)
+            new[:,:,np.isin(ant1, badants) | np.isin(ant2, badants)] = True
+            if autocorr:
+                new[:,:,ant1 == ant2] = True
+            new[:,badchans[ddid],:] = True
+
+            #Only read the data when needed, and only clip (and flag zeros in) the selected fields, as with flagdata
+            selected = np.isin(field, fields) if len(fields) > 0 else np.ones(nrow, dtype=bool)
+            if (zeros or clip is not None) and np.any(selected):
+                amp = np.abs(sub.getcol('DATA', startrow=startrow, nrow=nrow))
+                if zeros:
+                    new[:,:,selected] |= amp[:,:,selected] == 0
+                if clip is not None:
+                    clipped = (amp < clip[0]) | (amp > clip[1])
+                    clipped[:,:,~selected] = False
+                    new |= np.any(clipped, axis=0)[np.newaxis]
+
+            nflagged += np.count_nonzero(new & ~flag)
+            total += flag.size
+            sub.putcol('FLAG', flag | new, startrow=startrow, nrow=nrow)
+
+        sub.close()
+    tb.close()
+
+    return nflagged, total
+
+def preflag(visname, badfreqranges=[], badants=[], fields=[], clip=[0., 50.], autocorr=True, zeros=True, nproc=0):
+
+    """Apply the deterministic flagging rules to an MS, or to each sub-MS of an MMS in parallel.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS or MMS.
+    badfreqranges : list, optional
+        List of CASA frequency ranges to flag (e.g. ['933~960MHz']).
+    badants : list or str, optional
+        List of antenna IDs or names to flag.
+    fields : list or str, optional
+        List of field IDs or names to clip (and flag zeros). Use [] for all fields.
+    clip : list, optional
+        Range [min, max] of amplitudes outside which data are flagged. Use None to skip clipping.
+    autocorr : bool, optional
+        Flag autocorrelations?
+    zeros : bool, optional
+        Flag visibilities that are exactly zero?
+    nproc : int, optional
+        Number of processes. Use 0 for one per available CPU."""
+
+    visname = visname.rstrip('/ ')
+    freqranges = parse_freqranges(badfreqranges)
+    antids = resolve_ids(visname, 'ANTENNA', badants)
+    fields = list(resolve_ids(visname, 'FIELD', fields))
+
+    if os.path.exists('{0}/SUBMSS'.format(visname)):
+        vislist = sorted(glob.glob('{0}/SUBMSS/*'.format(visname)))
+    else:
+        vislist = [visname]
+
+    logger.info('Pre-flagging {0} (sub-)MS(s) of "{1}" with bad frequency ranges {2}, bad antennas {3}, autocorrelations={4}, zeros={5} and clip range {6}.'.format(len(vislist),visname,badfreqranges,list(antids),autocorr,zeros,clip))
+
+    args = [(vis, freqranges, antids, fields, clip, autocorr, zeros) for vis in vislist]
+    if len(vislist) > 1:
+        nproc = min(len(vislist), nproc if nproc > 0 else len(os.sched_getaffinity(0)))
+        #Share the memory budget between processes
+        args = [arg + (CHUNK_BYTES // nproc,) for arg in args]
+        with Pool(processes=nproc) as pool:
+            counts = pool.starmap(preflag_ms, args)
+    else:
+        counts = [preflag_ms(*args[0])]
+
+    nflagged = sum([count[0] for count in counts])
+    total = sum([count[1] for count in counts])
+    logger.info('Pre-flagging flagged {0:.2f}% of the data.'.format(100.0 * nflagged / max(total, 1)))
+
+    import bookkeeping
+    bookkeeping.forget_fingerprint(visname)
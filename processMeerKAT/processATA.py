@@ -65,13 +65,13 @@ SPW_PREFIX = '*:'
 
 #Set global values for field, crosscal and SLURM arguments copied to config file, and some of their default values
 FIELDS_CONFIG_KEYS = ['fluxfield','bpassfield','phasecalfield','targetfields','extrafields']
-CROSSCAL_CONFIG_KEYS = ['minbaselines','chanbin','width','timeavg','createmms','keepmms','spw','nspw','calcrefant','refant','standard','badants','badfreqranges']
+CROSSCAL_CONFIG_KEYS = ['minbaselines','chanbin','width','timeavg','createmms','keepmms','spw','nspw','calcrefant','refant','standard','badants','badfreqranges','rfimask','usescratch','solvetimebin','solvechanbin','onthefly','incremental','solvechunks','calqa','bdatolerance','dropflagged','antflagthreshold']
 SELFCAL_CONFIG_KEYS = ['nloops','loop','cell','robust','imsize','wprojplanes','niter','threshold','uvrange','nterms','gridder','deconvolver','solint','calmode','discard_nloops','gaintype','outlier_threshold','flag','outlier_radius']
 IMAGING_CONFIG_KEYS = ['cell', 'robust', 'imsize', 'wprojplanes', 'niter', 'threshold', 'multiscale', 'nterms', 'gridder', 'deconvolver', 'restoringbeam', 'stokes', 'mask', 'rmsmap','outlierfile', 'pbthreshold', 'pbband']
 
 RUN_CONFIG_KEYS = ['verbose', 'scripts']
-PRECAL_SCRIPTS = [('calc_refant.py',False,''),('partition.py',True,'')] #Scripts run before calibration at top level directory when nspw > 1
-POSTCAL_SCRIPTS = [('concat.py',False,''),('plotcal_spw.py', False, ''),('selfcal_part1.py',True,''),('selfcal_part2.py',False,''),('science_image.py', True, '')] #Scripts run after calibration at top level directory when nspw > 1
+PRECAL_SCRIPTS = [('calc_refant.py',False,''),('flag_summary.py',False,''),('partition.py',True,'')] #Scripts run before calibration at top level directory when nspw > 1
+POSTCAL_SCRIPTS = [('concat.py',False,''),('merge_caltables.py',False,''),('plotcal_spw.py', False, ''),('selfcal_part1.py',True,''),('selfcal_part2.py',False,''),('science_image.py', True, '')] #Scripts run after calibration at top level directory when nspw > 1
 SCRIPTS = [ ('validate_input.py',False,''),
             ('flag_round_1.py',True,''),
             ('calc_refant.py',False,''),
@@ -263,14 +263,14 @@ if __name__ == "<run_path>":
 
     dopol = config['run']['dopol']
     refant = config['crosscal']['refant'].split()[0].strip("'")
-    fields = read_ms.get_fields(msmd, config)
+    fields = read_ms.get_fields(msmd, config, CONFIG_PATH)
     print(fields)
-    logger.info('[fields] section written to "{0}". Edit this section if you need to change field IDs (comma-seperated string for multiple IDs, not supported for calibrators).'.format(config))
+    logger.info('[fields] section written to "{0}". Edit this section if you need to change field IDs (comma-seperated string for multiple IDs, not supported for calibrators).'.format(CONFIG_PATH))
 
     npol = msmd.ncorrforpol()[0]
     parang = 0
-    if 'polcalfield' in fields:
-        calfield = msmd.fieldsforname(fields['polcalfield'][1:-1])[0] #remove '' from field and convert to int
+    if fields.get('polcalfield','') != '':
+        calfield = msmd.fieldsforname(fields['polcalfield'])[0]
         parang = read_ms.parang_coverage(visname, calfield, msmd=msmd)
 
     if npol < 4:
@@ -285,8 +285,9 @@ if __name__ == "<run_path>":
     msmd.done()
 
     ############ FLAGGING ROUND 1 ############
-    # print("flag round 1")
-    # execfile(filename='/home/cchoza/pipelines/processMeerKAT/crosscal_scripts/flag_round_1.py', globals=globals())
+    # Partitions the MS by scan (if not already an MMS) and flags in parallel, over MPI when run with mpicasa
+    print("flag round 1")
+    execfile(filename='/home/cchoza/pipelines/processMeerKAT/crosscal_scripts/flag_round_1.py', globals=globals())
 
     print("setjy")
     execfile(filename='/home/cchoza/pipelines/processMeerKAT/crosscal_scripts/setjy.py', globals=globals())
@@ -297,7 +298,12 @@ if __name__ == "<run_path>":
     print("xx_yy_apply")
     execfile(filename='/home/cchoza/pipelines/processMeerKAT/crosscal_scripts/xx_yy_apply.py', globals=globals())
 
-    split(taskvals['data']['vis'], outputvis=f"{visname.split('.')[0]}_xx_yy_calibrated.ms", datacolumn='CORRECTED')
+    calfiles, caldir = bookkeeping.bookkeeping(visname)
+    callib = bookkeeping.callib_file(visname, caldir)
+    if taskvals['crosscal'].get('onthefly', False) and os.path.exists(callib):
+        mstransform(vis=taskvals['data']['vis'], outputvis=f"{visname.split('.')[0]}_xx_yy_calibrated.ms", datacolumn='corrected', docallib=True, callib=callib)
+    else:
+        split(taskvals['data']['vis'], outputvis=f"{visname.split('.')[0]}_xx_yy_calibrated.ms", datacolumn='CORRECTED')
 
     print("flag round 2")
     execfile(filename='/home/cchoza/pipelines/processMeerKAT/crosscal_scripts/flag_round_2.py', globals=globals())
@@ -27,6 +27,8 @@ import sys
 import re
 import config_parser
 import bookkeeping
+import run_state
+import flag_stats
 from shutil import copyfile
 from copy import deepcopy
 import logging
@@ -52,20 +54,21 @@ AUX_SCRIPTS_DIR = 'aux_scripts'
 SELFCAL_SCRIPTS_DIR = 'selfcal_scripts'
 CONFIG = 'default_config.txt'
 TMP_CONFIG = '.config.tmp'
+FULLY_FLAGGED = 0.999 #Flagged fraction above which SPWs aren't processed
 MASTER_SCRIPT = 'submit_pipeline.sh'
 SPW_PREFIX = '*:'
 
 #Set global values for field, crosscal and SLURM arguments copied to config file, and some of their default values
 FIELDS_CONFIG_KEYS = ['fluxfield','bpassfield','phasecalfield','targetfields','extrafields']
-CROSSCAL_CONFIG_KEYS = ['minbaselines','chanbin','width','timeavg','createmms','keepmms','spw','nspw','calcrefant','refant','standard','badants','badfreqranges']
+CROSSCAL_CONFIG_KEYS = ['minbaselines','chanbin','width','timeavg','createmms','keepmms','spw','nspw','calcrefant','refant','standard','badants','badfreqranges','rfimask','usescratch','solvetimebin','solvechanbin','onthefly','incremental','solvechunks','calqa','bdatolerance','dropflagged','antflagthreshold']
 SELFCAL_CONFIG_KEYS = ['nloops','loop','cell','robust','imsize','wprojplanes','niter','threshold','uvrange','nterms','gridder','deconvolver','solint','calmode','discard_nloops','gaintype','outlier_threshold','flag','outlier_radius']
 IMAGING_CONFIG_KEYS = ['cell', 'robust', 'imsize', 'wprojplanes', 'niter', 'threshold', 'multiscale', 'nterms', 'gridder', 'deconvolver', 'restoringbeam', 'stokes', 'mask', 'rmsmap','outlierfile', 'pbthreshold', 'pbband']
 SLURM_CONFIG_STR_KEYS = ['container','mpi_wrapper','partition','time','name','dependencies','exclude','account','reservation']
 SLURM_CONFIG_KEYS = ['nodes','ntasks_per_node','mem','plane','submit','precal_scripts','postcal_scripts','scripts','verbose','modules'] + SLURM_CONFIG_STR_KEYS
 CONTAINER = '/idia/software/containers/casa-6.5.0-modular.sif'
 MPI_WRAPPER = 'mpirun'
-PRECAL_SCRIPTS = [('calc_refant.py',False,''),('partition.py',True,'')] #Scripts run before calibration at top level directory when nspw > 1
-POSTCAL_SCRIPTS = [('concat.py',False,''),('plotcal_spw.py', False, ''),('selfcal_part1.py',True,''),('selfcal_part2.py',False,''),('science_image.py', True, '')] #Scripts run after calibration at top level directory when nspw > 1
+PRECAL_SCRIPTS = [('calc_refant.py',False,''),('flag_summary.py',False,''),('partition.py',True,'')] #Scripts run before calibration at top level directory when nspw > 1
+POSTCAL_SCRIPTS = [('concat.py',False,''),('merge_caltables.py',False,''),('plotcal_spw.py', False, ''),('selfcal_part1.py',True,''),('selfcal_part2.py',False,''),('science_image.py', True, '')] #Scripts run after calibration at top level directory when nspw > 1
 SCRIPTS = [ ('validate_input.py',False,''),
             ('flag_round_1.py',True,''),
             ('calc_refant.py',False,''),
@@ -467,6 +470,9 @@ def write_sbatch(script,args,nodes=1,tasks=16,mem=MEM_PER_NODE_GB_LIMIT,name="jo
     params['cpus'] = 1
     if 'tclean' in script or 'selfcal' in script or 'partition' in script or 'image' in script:
         params['cpus'] = int(CPUS_PER_NODE_LIMIT/tasks)
+    #Use one CPU per chunk of channels for parallel bandpass and leakage solves
+    if 'solve' in script and config_parser.has_key(TMP_CONFIG, 'crosscal', 'solvechunks'):
+        params['cpus'] = max(1, min(int(config_parser.get_key(TMP_CONFIG, 'crosscal', 'solvechunks')), int(CPUS_PER_NODE_LIMIT/tasks)))
     #hard-code for 2/4 polarisations
     if 'partition' in script:
         dopol = config_parser.get_key(TMP_CONFIG, 'run', 'dopol')
@@ -573,6 +579,9 @@ def write_spw_master(filename,config,SPWs,precal_scripts,postcal_scripts,submit,
     slurm_kwargs : list, optional
         Parameters parsed from [slurm] section of config."""
 
+    #Create run-state database at top level, so it's used by the pipeline within each SPW directory
+    run_state.start_run(run_state.find_db())
+
     master = open(filename,'w')
     master.write('#!/bin/bash\n')
     SPWs = SPWs.replace(SPW_PREFIX,'')
@@ -740,6 +749,8 @@ def write_master(filename,config,scripts=[],submit=False,dir='jobScripts',pad_le
     slurm_kwargs : list, optional
         Parameters parsed from [slurm] section of config."""
 
+    run_state.start_run(run_state.find_db())
+
     master = open(filename,'w')
     master.write('#!/bin/bash\n')
     timestamp = config_parser.get_key(config,'run','timestamp')
@@ -840,6 +851,7 @@ def write_all_bash_jobs_scripts(master,extn,IDs,dir='jobScripts',echo=True,prefi
     #Add time as extn to this pipeline run, to give unique filenames
     killScript = prefix + 'killJobs'
     summaryScript = prefix + 'summary'
+    statusScript = prefix + 'status'
     errorScript = prefix + 'findErrors'
     timingScript = prefix + 'displayTimes'
     cleanupScript = prefix + 'cleanup'
@@ -848,6 +860,8 @@ def write_all_bash_jobs_scripts(master,extn,IDs,dir='jobScripts',echo=True,prefi
     write_bash_job_script(master, killScript, extn, 'echo scancel ${0}'.format(IDs), 'kill all the jobs', dir=dir, echo=echo)
     do = """echo sacct -j ${0} --units=G -o "JobID%-15,JobName%-{1},Partition,Elapsed,NNodes%6,NTasks%6,NCPUS%5,MaxDiskRead,MaxDiskWrite,NodeList%20,TotalCPU,CPUTime,MaxRSS,State,ExitCode" \$@ """.format(IDs,15+pad_length)
     write_bash_job_script(master, summaryScript, extn, do, 'view the progress', dir=dir, echo=echo)
+    do = 'echo python3 {0}/run_state.py summary'.format(os.path.abspath(SCRIPT_DIR))
+    write_bash_job_script(master, statusScript, extn, do, 'view the state of each pipeline step from the run-state database \(without querying SLURM\)', dir=dir, echo=echo)
     do = """echo "for ID in {$%s,}; do files=\$(ls %s/*\$ID* 2>/dev/null | wc -l); if [ \$((files)) != 0 ]; then ls %s/*\$ID*; cat %s/*\$ID* | grep -i 'severe\|error' | grep -vi 'mpi\|The selected table has zero rows\|MeasTable::dUTC(Double)'; else echo %s/*\$ID* logs don\\'t exist \(yet\); fi; done" """ % (IDs,LOG_DIR,LOG_DIR,LOG_DIR,LOG_DIR)
     write_bash_job_script(master, errorScript, extn, do, 'find errors \(after pipeline has run\)', dir=dir, echo=echo)
     do = """echo "for ID in {$%s,}; do files=\$(ls %s/*\$ID* 2>/dev/null | wc -l); if [ \$((files)) != 0 ]; then logs=\$(ls %s/*\$ID* | sort -V); ls -f \$logs; cat \$(ls -tU \$logs) | grep INFO | head -n 1 | cut -d 'I' -f1; cat \$(ls -tr \$logs) | grep INFO | tail -n 1 | cut -d 'I' -f1; else echo %s/*\$ID* logs don\\'t exist \(yet\); fi; done" """ % (IDs,LOG_DIR,LOG_DIR,LOG_DIR)
@@ -1053,6 +1067,26 @@ def default_config(arg_dict):
         config_parser.overwrite_config(filename, conf_dict={'postcal_scripts' : scripts}, conf_sec='slurm')
 
     if not arg_dict['nofields']:
+        #Identify fields within this process using python-casacore or casatools if available, avoiding the srun call
+        import ms_metadata
+        msmd = None
+        if ms_metadata.available():
+            logger.info('Extracting field IDs from MeasurementSet "{0}" using python-casacore.'.format(MS))
+            msmd = ms_metadata.MSMetadata()
+        else:
+            try:
+                from casatools import msmetadata
+                logger.info('Extracting field IDs from MeasurementSet "{0}" using CASA.'.format(MS))
+                msmd = msmetadata()
+            except ImportError:
+                pass
+
+    if not arg_dict['nofields'] and msmd is not None:
+        import read_ms
+        msmd.open(MS)
+        read_ms.write_fields(msmd, MS, filename, dopol=arg_dict['dopol'])
+        msmd.done()
+    elif not arg_dict['nofields']:
         #Don't call srun if option --local used
         if arg_dict['local']:
             mpi_wrapper = ''
@@ -1294,6 +1328,11 @@ def format_args(config,submit,quiet,dependencies,justrun):
         if pop_script(kwargs,'calc_refant.py'):
             kwargs['num_precal_scripts'] -= 1
 
+    #Pop script to summarise flags before partition if no flagged data are dropped
+    if not crosscal_kwargs.get('dropflagged', False) and crosscal_kwargs.get('antflagthreshold', 0) <= 0:
+        if pop_script(kwargs,'flag_summary.py') and nspw > 1:
+            kwargs['num_precal_scripts'] -= 1
+
     #Replace empty containers with default container and remove unwanted kwargs
     for i in range(len(kwargs['containers'])):
         if kwargs['containers'][i] == '':
@@ -1417,7 +1456,10 @@ def spw_split(spw,nspw,config,mem,badfreqranges,MS,partition,createmms=True,remo
         logger.error("Can't split into {0} SPWs using SPW format '{1}'. Using nspw=1 in '{2}'.".format(nspw,spw,config))
         return 1
 
-    #Remove any SPWs completely encompassed by bad frequency ranges
+    #Use flag statistics of the input MS if they've been computed
+    stats = flag_stats.load(MS) if flag_stats.exists(MS) else None
+
+    #Remove any SPWs completely encompassed by bad frequency ranges, or already entirely flagged
     i=0
     while i < nspw:
         badfreq = False
@@ -1429,6 +1471,9 @@ def spw_split(spw,nspw,config,mem,badfreqranges,MS,partition,createmms=True,remo
                     logger.info("Won't process spw '{0}{1}~{2}{3}', since it's completely encompassed by bad frequency range '{3}'.".format(SPW_PREFIX,low,high,unit,freq))
                     badfreq = True
                     break
+            if not badfreq and stats is not None and stats.frequency_fraction(low*1e6, high*1e6) >= FULLY_FLAGGED:
+                logger.info("Won't process spw '{0}{1}~{2}{3}', since it's entirely flagged according to '{4}'.".format(SPW_PREFIX,low,high,unit,flag_stats.stats_file(MS)))
+                badfreq = True
         if badfreq:
             SPWs.pop(i)
             i -= 1
@@ -4,62 +4,227 @@
 #!/usr/bin/env python3
 import sys
 import os
+import time
 import numpy as np
 
 import processMeerKAT
 import config_parser
-
-from casatasks import *
-from casatools import msmetadata,table,measures,quanta
+import bookkeeping
 
 logger = processMeerKAT.logger
 
-def get_fields(msmd=None, config=None):
+#Intents (or substrings of intents) used to identify each field, in order of preference
+FIELD_INTENTS = {'fluxfield' : ['CALIBRATE_FLUX'],
+                 'bpassfield' : ['CALIBRATE_BANDPASS'],
+                 'phasecalfield' : ['CALIBRATE_PHASE','CALIBRATE_AMPLI'],
+                 'polcalfield' : ['CALIBRATE_POL'],
+                 'targetfields' : ['TARGET']}
+
+def index_fields(msmd):
 
-    """Extract field numbers from config file, including calibrators for bandpass, flux, phase & amplitude, and the target. Only the
-    target allows for multiple field IDs, while all others extract the field with the most scans and put all other IDs as target fields.
+    """Index the scan intents, number of scans and total integration time of every field, querying the metadata only once.
 
     Arguments:
     ----------
-    MS : str
-        Input MeasurementSet (relative or absolute path).
+    msmd : class ``msmetadata``
+        Metadata tool, opened on the input MeasurementSet.
+
+    Returns:
+    --------
+    index : dict
+        names : list
+            Field names, indexed by field ID.
+        intents : dict
+            Field IDs for each intent.
+        nscans : dict
+            Number of scans for each field ID.
+        inttime : dict
+            Total integration time (in seconds) for each field ID."""
+
+    names = list(msmd.fieldnames())
+    index = {'names' : names, 'intents' : {}, 'nscans' : {}, 'inttime' : {}}
+
+    for intent in msmd.intents():
+        index['intents'][intent] = [int(fid) for fid in msmd.fieldsforintent(intent)]
+
+    for fid in range(len(names)):
+        index['nscans'][fid] = len(msmd.scansforfield(fid))
+        times = np.asarray(msmd.timesforfield(fid))
+        if times.size > 1:
+            #Median spacing is the dump time, which is robust to gaps between scans
+            index['inttime'][fid] = times.size * np.median(np.diff(np.sort(times)))
+        else:
+            index['inttime'][fid] = 0.0
+
+    return index
+
+def rank_fields(index, fids):
+
+    """Sort field IDs by number of scans and then total integration time, in descending order."""
+
+    return sorted(fids, key=lambda fid: (index['nscans'][fid], index['inttime'][fid]), reverse=True)
+
+def fields_for_intent(index, intents):
+
+    """Return the ranked field IDs whose intents contain any of the input intents."""
+
+    fids = set()
+    for intent in index['intents']:
+        if any([i in intent for i in intents]):
+            fids.update(index['intents'][intent])
+
+    return rank_fields(index, fids)
+
+def identify_fields(msmd):
+
+    """Identify the calibrators and targets from the scan intents, picking the field with the most scans and longest integration time
+    for each calibrator. Fall back to the known calibrator names for the flux and polarisation calibrators when no intents are present.
+
+    Arguments:
+    ----------
+    msmd : class ``msmetadata``
+        Metadata tool, opened on the input MeasurementSet.
+
+    Returns:
+    --------
+    fields : dict
+        Field names for keys 'fluxfield', 'bpassfield', 'phasecalfield', 'polcalfield', 'targetfields' and 'extrafields'.
+        Multiple target and extra fields are comma-separated."""
+
+    start = time.time()
+    index = index_fields(msmd)
+    names = index['names']
+    candidates = {key : fields_for_intent(index, FIELD_INTENTS[key]) for key in FIELD_INTENTS}
+
+    if len(candidates['fluxfield']) == 0:
+        for aliases in [bookkeeping.FLUXCAL_NAMES] + bookkeeping.POLCAL_NAMES:
+            name = bookkeeping.find_known_field(names, aliases)
+            if name != '':
+                candidates['fluxfield'] = [names.index(name)]
+                break
+
+    if len(candidates['polcalfield']) == 0:
+        for aliases in bookkeeping.POLCAL_NAMES:
+            name = bookkeeping.find_known_field(names, aliases)
+            if name != '':
+                candidates['polcalfield'] = [names.index(name)]
+                break
+
+    fields = {key : '' for key in list(FIELD_INTENTS) + ['extrafields']}
+    if len(candidates['fluxfield']) == 0:
+        logger.error('No field with intent {0} or known flux calibrator found.'.format(FIELD_INTENTS['fluxfield']))
+        return fields
+
+    flux = candidates['fluxfield'][0]
+    bpass = candidates['bpassfield'][0] if len(candidates['bpassfield']) > 0 else flux
+    phasecal = candidates['phasecalfield'][0] if len(candidates['phasecalfield']) > 0 else flux
+    calibrators = set([flux, bpass, phasecal])
+    if len(candidates['polcalfield']) > 0:
+        calibrators.add(candidates['polcalfield'][0])
+        fields['polcalfield'] = names[candidates['polcalfield'][0]]
+
+    #Without a TARGET intent, take every observed field that isn't a calibrator
+    targets = candidates['targetfields']
+    if len(targets) == 0:
+        targets = rank_fields(index, [fid for fid in range(len(names)) if fid not in calibrators and index['nscans'][fid] > 0])
+    targets = [fid for fid in targets if fid not in calibrators]
+
+    #Any other calibrator is kept as an extra field
+    extra = set()
+    for intent in index['intents']:
+        if 'CALIBRATE' in intent:
+            extra.update(index['intents'][intent])
+    extra = rank_fields(index, extra - calibrators - set(targets))
+
+    fields['fluxfield'] = names[flux]
+    fields['bpassfield'] = names[bpass]
+    fields['phasecalfield'] = names[phasecal]
+    fields['targetfields'] = ','.join([names[fid] for fid in targets])
+    fields['extrafields'] = ','.join([names[fid] for fid in extra])
+
+    logger.debug('Identified fields {0} in {1:.3f} seconds.'.format(fields,time.time()-start))
+    return fields
+
+def get_fields(msmd=None, config=None, filename=''):
+
+    """Extract field names from config file, including calibrators for bandpass, flux, phase & amplitude, polarisation, and the target.
+    Any field left empty in the config file is identified from the scan intents of the MS (see ``identify_fields``). Only the target and
+    extra fields allow for multiple fields.
+
+    Arguments:
+    ----------
+    msmd : class ``msmetadata``
+        Metadata tool, opened on the input MeasurementSet.
+    config : class ``configparser.ConfigParser``
+        Parsed config file.
+    filename : str, optional
+        Path to config file. If input, identified fields are written into its [fields] section.
 
     Returns:
     --------
     fieldIDs : dict
-        fluxfield : int
+        fluxfield : str
             Field for total flux calibration.
-        bpassfield : int
+        bpassfield : str
             Field for bandpass calibration.
-        phasecalfield : int
+        phasecalfield : str
             Field for phase calibration.
-        targetfields : int
-            Target field."""
+        polcalfield : str
+            Field for polarisation calibration.
+        targetfields : str
+            Target field(s).
+        extrafields : str
+            Extra field(s)."""
 
     fieldIDs = {}
+    for key in list(FIELD_INTENTS) + ['extrafields']:
+        val = config['fields'][key] if key in config['fields'] else ''
+        fieldIDs[key] = val.split('#')[0].strip().strip("'")
 
-    #Set default for any missing intent as field for intent CALIBRATE_FLUX
+    missing = [key for key in fieldIDs if fieldIDs[key] == '' and key != 'extrafields']
+    if len(missing) > 0:
+        identified = identify_fields(msmd)
+        for key in missing + ['extrafields']:
+            if fieldIDs[key] == '':
+                fieldIDs[key] = identified[key]
 
-    fluxcal = config['fields']['fluxfield']
-    if fluxcal == '':
-        logger.error('A flux calibrator must be set in the config file.')
-        return fieldIDs
-    else:
-        default = fluxcal
-
-    fieldIDs['fluxfield'] = fluxcal.strip("'")
-    fieldIDs['bpassfield'] = config["fields"]["bpassfield"].strip("'")
-    fieldIDs['phasecalfield'] = config["fields"]["phasecalfield"].strip("'")
-    fieldIDs['targetfields'] = config["fields"]["targetfields"].strip("'")
-    fieldIDs['polfield'] = config["fields"]["polcalfield"].strip("'")
-        
-    # fieldIDs['fluxfield'] = get_field(MS,'CALIBRATE_FLUX','fluxfield',extra_fields)
-    # fieldIDs['bpassfield'] = get_field(MS,'CALIBRATE_BANDPASS','bpassfield',extra_fields,default=default)
-    # fieldIDs['phasecalfield'] = get_field(MS,phasecal_intent,'phasecalfield',extra_fields,default=default)
-    # fieldIDs['targetfields'] = get_field(MS,'TARGET','targetfields',extra_fields,default=default,multiple=True)
+        if fieldIDs['fluxfield'] == '':
+            logger.error('A flux calibrator must be set in the config file.')
+            return {}
+
+        if filename != '':
+            conf_dict = {key : "'{0}'".format(fieldIDs[key]) for key in fieldIDs}
+            config_parser.overwrite_config(filename, conf_dict=conf_dict, conf_sec='fields')
 
     return fieldIDs
 
+def write_fields(msmd, MS, filename, dopol=False):
+
+    """Identify fields from the MS and write them into the [fields] section of the config file, forcing dopol=False in [run]
+    section when fewer than four polarisations are present.
+
+    Arguments:
+    ----------
+    msmd : class ``msmetadata``
+        Metadata tool, opened on the input MeasurementSet.
+    MS : str
+        Input MeasurementSet (relative or absolute path).
+    filename : str
+        Path to config file.
+    dopol : bool, optional
+        Was polarisation calibration requested?"""
+
+    config = config_parser.parse_config(filename)[1]
+    fields = get_fields(msmd, config, filename)
+    logger.info('[fields] section written to "{0}". Edit this section if you need to change field IDs (comma-seperated string for multiple IDs, not supported for calibrators).'.format(filename))
+
+    npol = msmd.ncorrforpol()[0]
+    if dopol and npol < 4:
+        logger.warning("Only {0} polarisations present in '{1}'. Any attempted polarisation calibration will fail, so setting dopol=False in [run] section of '{2}'.".format(npol,MS,filename))
+        config_parser.overwrite_config(filename, conf_dict={'dopol' : False}, conf_sec='run', sec_comment='# Internal variables for pipeline execution')
+
+    return fields
+
 def check_refant(MS, refant,config,msmd=None, warn=True):
 
     """Check if reference antenna exists, otherwise throw an error or display a warning.
@@ -111,6 +276,10 @@ def parang_coverage(vis, calfield, msmd=None):
     delta_parang : float
         The parallactic angle coverage of the phase calibrator field."""
 
+    from casatools import table,measures
+    tb = table()
+    me = measures()
+
     tb.open(vis+'::ANTENNA')
     pos = tb.getcol('POSITION')
     meanpos = np.mean(pos, axis=1)
@@ -186,4 +355,20 @@ def get_xy_field(visname, fields, msmd=None):
     else:
         xyfield = fields.dpolfield
 
-    return xyfield
\ No newline at end of file
+    return xyfield
+
+def main():
+
+    """Identify fields from the MS when launched via srun within the CASA container during the [-B --build] step."""
+
+    from casatools import msmetadata
+
+    args = processMeerKAT.parse_args()
+    processMeerKAT.setup_logger(args.config,args.verbose)
+    msmd = msmetadata()
+    msmd.open(args.MS)
+    write_fields(msmd, args.MS, args.config, dopol=args.dopol)
+    msmd.done()
+
+if __name__ == "__main__":
+    main()
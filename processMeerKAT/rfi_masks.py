@@ -0,0 +1,163 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Library of static RFI masks for each receiver band, applied during partition. Frequency ranges contaminated all of the
+time ('full') are excluded from the channel selection where they lie at the edges of an SPW, so they're never written. The
+selection of each SPW stays one contiguous range of channels (so partition writes one output SPW per input SPW), so full ranges
+within an SPW are flagged instead, as are ranges contaminated some of the time ('partial'). Masks are versioned, so a run can
+be reproduced with an older mask.
+"""
+
+import numpy as np
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+
+#Masks per version and band, as (low MHz, high MHz, contamination, description)
+RFI_MASKS = {
+    '2024.1' : {
+        'UHF' : [(544, 694, 'partial', 'Digital terrestrial television'),
+                 (758, 790, 'partial', 'LTE 800 downlink'),
+                 (925, 960, 'full', 'GSM 900 downlink'),
+                 (1025, 1035, 'partial', 'Aviation SSR interrogation (1030 MHz)'),
+                 (1085, 1095, 'partial', 'Aviation SSR replies / ADS-B (1090 MHz)')],
+        'L' : [(925, 960, 'full', 'GSM 900 downlink'),
+               (1025, 1035, 'partial', 'Aviation SSR interrogation (1030 MHz)'),
+               (1085, 1095, 'partial', 'Aviation SSR replies / ADS-B (1090 MHz)'),
+               (1163, 1299, 'full', 'GNSS (GPS L2/L5, Galileo E5/E6, GLONASS G2, BeiDou B2/B3)'),
+               (1380, 1383, 'partial', 'GPS L3'),
+               (1525, 1630, 'full', 'GNSS L1/E1/G1, Inmarsat, Iridium and Thuraya downlinks')],
+        'S' : [(1805, 1880, 'full', 'GSM 1800 downlink'),
+               (2110, 2170, 'full', 'UMTS downlink'),
+               (2400, 2483.5, 'partial', 'ISM (WiFi, Bluetooth)'),
+               (2483.5, 2500, 'full', 'Globalstar downlink'),
+               (2620, 2690, 'partial', 'LTE 2600 downlink'),
+               (3400, 3600, 'partial', 'Fixed wireless access')],
+        'ATA' : [(728, 756, 'full', 'LTE 700 downlink'),
+                 (869, 894, 'full', 'Cellular 850 downlink'),
+                 (1025, 1035, 'partial', 'Aviation SSR interrogation (1030 MHz)'),
+                 (1085, 1095, 'partial', 'Aviation SSR replies / ADS-B (1090 MHz)'),
+                 (1164, 1300, 'full', 'GNSS (GPS L2/L5, Galileo E5/E6, GLONASS G2, BeiDou B2/B3)'),
+                 (1525, 1630, 'full', 'GNSS L1/E1/G1, Inmarsat, Iridium and Globalstar downlinks'),
+                 (1930, 1995, 'full', 'PCS 1900 downlink'),
+                 (2110, 2200, 'full', 'AWS downlink'),
+                 (2300, 2360, 'partial', 'WCS and SDARS satellite radio'),
+                 (2400, 2483.5, 'partial', 'ISM (WiFi, Bluetooth)'),
+                 (3700, 4200, 'full', 'C-band satellite downlink and 5G'),
+                 (5150, 5850, 'partial', 'Unlicensed national information infrastructure (WiFi)'),
+                 (10700, 12700, 'partial', 'Ku-band satellite downlink')]}
+    }
+
+LATEST = sorted(RFI_MASKS.keys())[-1]
+
+def get_mask(rfimask, msmd=None):
+
+    """Return the mask for a band.
+
+    Arguments:
+    ----------
+    rfimask : str
+        Band ('L', 'UHF', 'S' or 'ATA'), optionally with a version (e.g. 'L:2024.1'), or 'auto' to select the band from the
+        telescope and frequency coverage of the MS. Use '' to return no mask.
+    msmd : class ``casatools.msmetadata``, optional
+        Open msmetadata object, needed when rfimask='auto'.
+
+    Returns:
+    --------
+    mask : list
+        List of (low MHz, high MHz, contamination, description)."""
+
+    if rfimask == '':
+        return []
+
+    band, version = rfimask.split(':') if ':' in rfimask else (rfimask, LATEST)
+    if version not in RFI_MASKS:
+        raise ValueError("RFI mask version '{0}' doesn't exist. Versions are {1}.".format(version, list(RFI_MASKS.keys())))
+
+    if band == 'auto':
+        freqs = np.concatenate([msmd.chanfreqs(spw) for spw in range(msmd.nspw())]) / 1e6
+        telescope = msmd.observatorynames()[0].upper()
+        if 'ATA' in telescope:
+            band = 'ATA'
+        elif freqs.max() < 1100:
+            band = 'UHF'
+        elif freqs.min() > 1700:
+            band = 'S'
+        else:
+            band = 'L'
+        logger.info("Using RFI mask for band '{0}' (version {1}) for telescope '{2}'.".format(band, version, telescope))
+
+    if band not in RFI_MASKS[version]:
+        raise ValueError("No RFI mask for band '{0}' in version {1}. Bands are {2}.".format(band, version, list(RFI_MASKS[version].keys())))
+
+    return RFI_MASKS[version][band]
+
+def freqranges(mask, contamination):
+
+    """Return the ranges of a mask with a given contamination ('full' or 'partial'), as CASA frequency ranges (e.g. '925~960MHz')."""
+
+    return ['{0}~{1}MHz'.format(low, high) for low,high,cont,desc in mask if cont == contamination]
+
+def masked_spw_selection(visname, spw, mask):
+
+    """Return a channel selection equivalent to the input SPW selection, but excluding channels within fully contaminated ranges
+    at the edges of each SPW. Each SPW keeps one contiguous range of channels, so fully contaminated ranges between selected
+    channels must be flagged.
+
+    Arguments:
+    ----------
+    visname : str
+        Path to MS.
+    spw : str
+        CASA SPW selection (e.g. '0', '*:880~1680MHz' or '0:100~3000').
+    mask : list
+        RFI mask, from ``get_mask``.
+
+    Returns:
+    --------
+    selection : str
+        CASA SPW selection by channel index (e.g. '0:100~3000'), or the input selection if no channels are excluded."""
+
+    from casatools import ms, msmetadata
+    myms = ms()
+    msmd = msmetadata()
+
+    full = [(low*1e6, high*1e6) for low,high,cont,desc in mask if cont == 'full']
+    if len(full) == 0:
+        return spw
+
+    #Each row is [spw, start, end, step]
+    selected = myms.msseltoindex(vis=visname, spw=spw)['channel']
+    msmd.open(visname)
+
+    selections = []
+    nexcluded = 0
+    for spwid,start,end,step in selected:
+        freqs = msmd.chanfreqs(int(spwid))
+        chans = np.zeros(freqs.size, dtype=bool)
+        chans[start:end+1] = True
+        for low,high in full:
+            chans &= ~((freqs >= low) & (freqs <= high))
+
+        #Keep the span from the first to the last clean channel, so only the edges are excluded
+        clean = np.where(chans)[0]
+        if len(clean) > 0:
+            nexcluded += (end - start + 1) - (clean[-1] - clean[0] + 1)
+            selections.append('{0}:{1}~{2}'.format(spwid, clean[0], clean[-1]))
+        else:
+            nexcluded += end - start + 1
+    msmd.done()
+
+    if nexcluded == 0:
+        return spw
+    if len(selections) == 0:
+        raise ValueError("All channels of SPW selection '{0}' lie within fully contaminated frequency ranges {1}.".format(spw, freqranges(mask, 'full')))
+
+    selection = ','.join(selections)
+    logger.info("Excluding {0} channels within fully contaminated frequency ranges {1} at the edges of the band. Using SPW selection '{2}'.".format(nexcluded, freqranges(mask, 'full'), selection))
+    return selection
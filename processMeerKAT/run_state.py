@@ -0,0 +1,215 @@
+#Copyright (C) 2022 Inter-University Institute for Data Intensive Astronomy
+#See processMeerKAT.py for license details.
+
+#!/usr/bin/env python3
+
+"""
+Run-state store for a pipeline run, held in a SQLite database (WAL mode) in the top-level run directory. Each pipeline step
+records its SPW, SLURM job ID, state, timings and artifacts, and a failed step sets an 'abort' flag that is read by all
+subsequent steps (in all SPW directories). Status queries read this database rather than querying the SLURM controller.
+
+Usage: run_state.py [summary|failed|kill|resume]
+"""
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+
+import logging
+from time import gmtime
+logging.Formatter.converter = gmtime
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=logging.INFO)
+
+DB_NAME = 'run_state.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rundir TEXT,
+    step TEXT,
+    spw TEXT,
+    jobid TEXT,
+    host TEXT,
+    state TEXT,
+    start REAL,
+    end REAL,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    step_id INTEGER REFERENCES steps(id),
+    path TEXT
+);
+CREATE TABLE IF NOT EXISTS flags (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS steps_state ON steps(state);
+"""
+
+def find_db(path='.'):
+
+    """Return the path to the run-state database used from this directory. The database of the top-level run directory is
+    found from within its SPW directories, otherwise one in this directory is used (whether or not it exists yet).
+
+    Arguments:
+    ----------
+    path : str, optional
+        Directory from which to search.
+
+    Returns:
+    --------
+    db : str
+        Path to database."""
+
+    path = os.path.abspath(path)
+    for dir in [path, os.path.dirname(path)]:
+        db = os.path.join(dir, DB_NAME)
+        if os.path.exists(db):
+            return db
+    return os.path.join(path, DB_NAME)
+
+def connect(db=''):
+
+    """Open the run-state database, creating it if it doesn't exist.
+
+    Arguments:
+    ----------
+    db : str, optional
+        Path to database. If not input, it is found via ``find_db``.
+
+    Returns:
+    --------
+    conn : class ``sqlite3.Connection``
+        Open connection in autocommit mode."""
+
+    if db == '':
+        db = find_db()
+    #Many array tasks write at once, so wait on locks rather than failing
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+def job_id():
+
+    """Return the SLURM job ID of this process (including the array task ID), or the PID if not run within SLURM."""
+
+    if 'SLURM_ARRAY_JOB_ID' in os.environ:
+        return '{SLURM_ARRAY_JOB_ID}_{SLURM_ARRAY_TASK_ID}'.format(**os.environ)
+    return os.environ.get('SLURM_JOB_ID', 'pid{0}'.format(os.getpid()))
+
+def start_run(db=''):
+
+    """Clear the abort flag, so steps of a newly submitted run will execute."""
+
+    conn = connect(db)
+    conn.execute("DELETE FROM flags WHERE key='abort'")
+    conn.close()
+
+def aborted(db=''):
+
+    """Return the message left by the step that aborted this run, or '' if the run hasn't been aborted."""
+
+    db = db if db != '' else find_db()
+    if not os.path.exists(db):
+        return ''
+    conn = connect(db)
+    row = conn.execute("SELECT value FROM flags WHERE key='abort'").fetchone()
+    conn.close()
+    return row[0] if row is not None else ''
+
+def abort(message, db=''):
+
+    """Set the abort flag so all subsequent steps of this run are skipped."""
+
+    conn = connect(db)
+    conn.execute("INSERT OR REPLACE INTO flags (key, value) VALUES ('abort', ?)", (message,))
+    conn.close()
+
+def step_started(step, spw='', db=''):
+
+    """Record that a step has started and return its row ID."""
+
+    conn = connect(db)
+    cur = conn.execute('INSERT INTO steps (rundir, step, spw, jobid, host, state, start) VALUES (?,?,?,?,?,?,?)',
+                       (os.getcwd(), step, spw, job_id(), socket.gethostname(), 'RUNNING', time.time()))
+    conn.close()
+    return cur.lastrowid
+
+def step_finished(step_id, state, message='', artifacts=[], db=''):
+
+    """Record the final state (e.g. 'COMPLETED', 'FAILED' or 'SKIPPED') of a step, and any artifacts it wrote."""
+
+    conn = connect(db)
+    conn.execute('BEGIN')
+    conn.execute('UPDATE steps SET state=?, end=?, message=? WHERE id=?', (state, time.time(), message, step_id))
+    conn.executemany('INSERT INTO artifacts (step_id, path) VALUES (?,?)', [(step_id, path) for path in artifacts])
+    conn.execute('COMMIT')
+    conn.close()
+
+def get_steps(state='', db=''):
+
+    """Return rows (rundir, step, spw, jobid, host, state, start, end, message) of all recorded steps, optionally of a given state."""
+
+    conn = connect(db)
+    query = 'SELECT rundir, step, spw, jobid, host, state, start, end, message FROM steps'
+    if state != '':
+        rows = conn.execute(query + ' WHERE state=? ORDER BY id', (state,)).fetchall()
+    else:
+        rows = conn.execute(query + ' ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+def summary(db=''):
+
+    """Print one line per recorded step."""
+
+    rows = get_steps(db=db)
+    top = os.path.dirname(db if db != '' else find_db())
+    print('{0:<20} {1:<28} {2:<16} {3:<12} {4:>10}  {5}'.format('SPW','Step','JobID','State','Elapsed','Host'))
+    for rundir,step,spw,jobid,host,state,start,end,message in rows:
+        elapsed = (end if end is not None else time.time()) - start
+        if spw == '':
+            spw = os.path.relpath(rundir, top)
+        print('{0:<20} {1:<28} {2:<16} {3:<12} {4:>10}  {5}'.format(spw,step,jobid,state,time.strftime('%H:%M:%S', time.gmtime(elapsed)),host))
+    message = aborted(db)
+    if message != '':
+        print('Run aborted: {0}'.format(message))
+
+def failed(db=''):
+
+    """Print the directory, job ID and message of each failed step."""
+
+    for rundir,step,spw,jobid,host,state,start,end,message in get_steps('FAILED', db):
+        print('{0}: {1} ({2}) - {3}'.format(rundir,step,jobid,message))
+
+def kill(db=''):
+
+    """Abort the run, so queued steps exit as soon as they start, and cancel the running steps."""
+
+    abort('Killed by user.', db)
+    jobids = [row[3] for row in get_steps('RUNNING', db) if not row[3].startswith('pid')]
+    if len(jobids) > 0:
+        os.system('scancel {0}'.format(' '.join(jobids)))
+    logger.info('Aborted run and cancelled {0} running job(s).'.format(len(jobids)))
+
+def resume(db=''):
+
+    """Clear the abort flag and list the steps that failed, which can then be resubmitted."""
+
+    start_run(db)
+    for rundir,step,spw,jobid,host,state,start,end,message in get_steps('FAILED', db):
+        logger.info('Step "{0}" failed in "{1}" (job {2}): {3}'.format(step,rundir,jobid,message))
+
+if __name__ == '__main__':
+
+    commands = {'summary' : summary, 'failed' : failed, 'kill' : kill, 'resume' : resume}
+    command = sys.argv[1] if len(sys.argv) > 1 else 'summary'
+    if command not in commands:
+        print(__doc__)
+        sys.exit(1)
+    commands[command]()
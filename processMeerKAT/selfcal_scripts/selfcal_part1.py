@@ -9,6 +9,7 @@ import re
 import config_parser
 from config_parser import validate_args as va
 import bookkeeping
+import flag_versions
 
 from casatasks import *
 logfile=casalog.logfile()
@@ -50,21 +51,22 @@ def selfcal_part1(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
     if os.path.exists(outlierfile) and open(outlierfile).read() == '':
         outlierfile = ''
 
-    #Add model column with MPI rather than in selfcal_part2 without MPI.
+    #Add model column with MPI rather than in selfcal_part2 without MPI, unless using virtual models.
     #Assumes you've split out your corrected data from crosscal
     if loop == 0:
-        clearcal(vis=vis, addmodel=True)
+        clearcal(vis=vis, addmodel=bookkeeping.get_selfcal_context().usescratch)
 
     if 1 <= loop <= nloops:
         if len(prev_caltables) > 0 and calmode[loop-1] != '':
             applycal(vis=vis, selectdata=False, gaintable=prev_caltables, parang=False, interp='linear,linearflag')
 
             if flag[loop-1]:
+                flag_versions.save(vis, 'selfcal_loop{0}'.format(loop), comment='Before rflag on residuals')
                 flagdata(vis=vis, mode='rflag', datacolumn='RESIDUAL', field='', timecutoff=5.0,
                         freqcutoff=5.0, timefit='line', freqfit='line', flagdimension='freqtime',
                         extendflags=False, timedevscale=3.0, freqdevscale=3.0, spectralmax=500,
                         extendpols=False, growaround=False, flagneartime=False, flagnearfreq=False,
-                        action='apply', flagbackup=True, overwrite=True, writeflags=True)
+                        action='apply', flagbackup=False, overwrite=True, writeflags=True)
 
         if (not flag[loop-1] or len(prev_caltables) == 0) and gridder[loop] == gridder[loop-1] and robust[loop] == robust[loop-1] and nterms[loop] == nterms[loop-1] and imsize[loop] == imsize[loop-1] and cell[loop] == cell[loop-1]:
             # Assumes it's safe to re-use previous PSF for outliers if position has slightly changed
@@ -49,7 +49,7 @@ def selfcal_part2(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
                     wprojplanes = wprojplanes[loop], deconvolver = deconvolver[loop],
                     weighting='briggs', robust = robust[loop], threshold=threshold[loop],
                     nterms=nterms[loop], pblimit=-1, mask=pixmask, outlierfile=outlierfile,
-                    niter=0, savemodel='modelcolumn', restart=True, # cfcache=cfcache,
+                    niter=0, savemodel='modelcolumn' if bookkeeping.get_selfcal_context().usescratch else 'virtual', restart=True, # cfcache=cfcache,
                     restoration=False, calcpsf=False, calcres=False, parallel = False)
 
             solnorm = 'a' in calmode[loop]
@@ -122,12 +122,7 @@ def find_outliers(vis, refant, dopol, nloops, loop, cell, robust, imsize, wprojp
             #from astropy.table import vstack
 
             #Open MS and extract first target centre; use first sub-MS for speed if MMS
-            if os.path.exists('{0}/SUBMSS'.format(vis)):
-                tmpvis = glob.glob('{0}/SUBMSS/*'.format(vis))[0]
-            else:
-                tmpvis = vis
-
-            msmd.open(tmpvis)
+            msmd.open(bookkeeping.get_selfcal_context(vis).tmpvis)
             dir=msmd.sourcedirs()[str(targetfield)]
             ra=qa.convert(dir['m0'],'deg')['value']
             dec=qa.convert(dir['m1'],'deg')['value']